@@ -0,0 +1,356 @@
+"""วัดจำนวน API call, ขนาดข้อมูล และเวลา ของการเปิดหน้า/บันทึกข้อมูล กับ Google Sheets จำลอง
+
+รันฟังก์ชันข้อมูลของแอป (streamlit_app_cloud.py) ตรงๆ โดยใช้ fake_gsheets แทน Google Sheets จริง
+แล้วเขียนผลเป็น JSON เพื่อเทียบย้อนหลังเวลาปรับชั้น I/O
+
+    python bench_cloud.py --latency-ms 100 --output bench_results.json
+
+สถานการณ์ "cold start" รันใน process ใหม่ (เหมือน container เพิ่งเริ่ม) เพื่อวัดเวลาจนหน้าแรกพร้อม
+และตรวจว่าโมดูลหนัก (กราฟ/สรุป) ยังไม่ถูกโหลดจนกว่าจะเปิดแท็บสรุป, client ของชีตถูกสร้างใน thread warmup
+และยังไม่สร้าง template รายงาน รวมถึงจำนวน API call ของทุกสถานการณ์ไม่เกิน MAX_CALLS
+ถ้าไม่ผ่านจะจบด้วย exit code ไม่เป็นศูนย์
+"""
+import argparse
+import datetime as dt
+import json
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from pathlib import Path
+
+import fake_gsheets
+
+SHEET_ID = "bench"
+BENCH_EXPENSE_ITEMS = [f"รายการที่ {i}" for i in range(1, 25)]
+# โมดูลที่หน้าแรก (ฟอร์มรายรับ/รายจ่าย) ไม่ควรต้องโหลด
+# (streamlit.components.v1 ถูก streamlit โหลดเอง gspread/google-auth ถูก fake_gsheets โหลด จึงดูจาก sys.modules ไม่ได้)
+DEFERRED_MODULES = ["altair"]
+# ชื่อที่ต้องไม่อยู่ใน namespace ของแอปหลัง import: โมดูลหนักต้อง import ในฟังก์ชันที่ใช้
+DEFERRED_TOP_LEVEL_NAMES = ["alt", "altair", "components", "gspread", "Credentials", "AuthorizedSession", "HTTPClient"]
+# จำนวน API call สูงสุดของแต่ละสถานการณ์ (ไม่ขึ้นกับ latency) ถ้าเกินถือว่าชั้น I/O ถอยหลัง
+MAX_CALLS = {
+    "cold start (new process)": 5,
+    "cold open": 5,
+    "warm rerun": 0,
+    "rerun after cache TTL": 1,
+    "save income": 5,
+    "save 20 expenses": 5,
+    "switch month": 3,
+    "past month after restart": 2,
+    "yearly summary (cold)": 7,
+    "yearly summary (warm store)": 0,
+}
+# สรุปรวมทุกสาขา: สาขาแรกเท่ากับ "yearly summary (cold)" สาขาอื่นมีแค่ชีตพื้นฐานจึงใช้น้อยกว่า
+MAX_CALLS_PER_EXTRA_BRANCH = 5
+
+
+def _branch_sheet_ids(branches: int):
+    return [SHEET_ID] + [f"{SHEET_ID}-{i}" for i in range(2, branches + 1)]
+
+
+def _configure_streamlit(workdir: Path, latency_ms: float, branches: int = 1):
+    """ตั้ง secrets ให้แอปใช้ fake_gsheets และไฟล์แคชในโฟลเดอร์ชั่วคราว แล้วปิด log ของโหมด bare
+
+    branches > 1 ตั้ง sheet_ids เป็นหลายสาขา (สาขาแรกคือ SHEET_ID)
+    """
+    from streamlit import config
+    from streamlit.logger import set_log_level
+
+    secrets_path = workdir / "secrets.toml"
+    secrets_path.write_text(
+        "\n".join([
+            f'sheet_id = "{SHEET_ID}"',
+            f"sheet_ids = {json.dumps(_branch_sheet_ids(branches))}",
+            # วัดจำนวน call และ latency ไม่ใช่ quota: ไม่ให้ rate limiter หน่วงเมื่อรันหลายสถานการณ์ติดกัน
+            "sheets_requests_per_minute = 100000",
+            f'aggregate_db_path = "{(workdir / "aggregates.sqlite3").as_posix()}"',
+            f'write_queue_path = "{(workdir / "write_queue.sqlite3").as_posix()}"',
+            f'month_archive_path = "{(workdir / "archive").as_posix()}"',
+            "[fake_gsheets]",
+            f"latency_ms = {latency_ms}",
+        ]),
+        encoding="utf-8",
+    )
+    config.set_option("secrets.files", [str(secrets_path)])
+    set_log_level("error")
+    warnings.filterwarnings("ignore")
+
+
+def restart_process(app):
+    """ล้างแคชในหน่วยความจำของแอป เหมือน container เริ่มใหม่บนดิสก์เดิม (ไฟล์ในเครื่องยังอยู่)"""
+    app.get_month_cache.clear()
+    app.get_shared_cache.clear()
+    app._worksheet_registry.clear()
+    app._open_workbook.clear()
+    app._sheet_provisioner.clear()
+    for branch in app.get_branches():
+        with app.use_branch(branch):
+            app.get_storage_backend()._forget_version()
+
+
+def reset_caches(app):
+    """ล้างแคชทุกชั้นของแอป เหมือน container เพิ่งเริ่มบนเครื่องใหม่ (ข้อมูลในชีตจำลองยังอยู่)"""
+    restart_process(app)
+    everything = (dt.date(2000, 1, 1), dt.date(2100, 12, 31))
+    for branch in app.get_branches():
+        with app.use_branch(branch):
+            app.get_aggregate_store().invalidate_range(*everything)
+            app.get_month_archive().invalidate_range(*everything)
+
+
+def page_load(app, ref_date: dt.date):
+    """ฟังก์ชันข้อมูลที่หน้าแอปเรียกในหนึ่ง rerun (ทุกแท็บใช้วันที่ ref_date และสรุปแบบรายเดือน)"""
+    app.prefetch_months([("income", ref_date), ("expense", ref_date)])
+    app.load_income_df(ref_date)
+    app.load_expense_matrix(ref_date)
+    start = dt.date(ref_date.year, ref_date.month, 1)
+    end = (start + dt.timedelta(days=32)).replace(day=1) - dt.timedelta(days=1)
+    app.build_daily_summary(start, end, ref_date)
+    app.build_income_pie(start, end, ref_date)
+    app.build_expense_pie(start, end, ref_date)
+
+
+def wait_synced(app, timeout: float = 60.0):
+    """รอจนคิวงานเขียนว่าง (ตัวซิงก์เบื้องหลังส่งไปชีตครบแล้ว)"""
+    deadline = time.monotonic() + timeout
+    app.get_write_flusher().wake()
+    while app.get_write_queue().status()["pending"]:
+        if time.monotonic() > deadline:
+            raise TimeoutError("write queue did not drain")
+        time.sleep(0.01)
+
+
+def measure(server, name: str, fn):
+    server.reset_counters()
+    t0 = time.perf_counter()
+    extra = fn() or {}
+    wall = time.perf_counter() - t0
+    return {
+        "scenario": name,
+        "api_calls": server.total_calls,
+        "calls_by_method": dict(sorted(server.calls.items())),
+        "bytes_sent": server.bytes_sent,
+        "bytes_received": server.bytes_received,
+        "wall_seconds": round(wall, 4),
+        **extra,
+    }
+
+
+def _timed(fn):
+    t0 = time.perf_counter()
+    fn()
+    return round(time.perf_counter() - t0, 4)
+
+
+def run_scenarios(app, server, today: dt.date):
+    last_month = (today.replace(day=1) - dt.timedelta(days=1)).replace(day=15)
+    expenses = [(item, today.day, 10.0 + i) for i, item in enumerate(BENCH_EXPENSE_ITEMS[:20])]
+
+    def save_income():
+        ui = _timed(lambda: app.update_income_row(today, 1200, 850, 0, 430, 0, 260))
+        wait_synced(app)
+        return {"ui_seconds": ui}
+
+    def save_expenses():
+        ui = _timed(lambda: app.update_expense_cells(today, expenses))
+        wait_synced(app)
+        return {"ui_seconds": ui}
+
+    def ttl_reload():
+        # แคชรายเดือนหมดอายุทั้งหมดแต่ข้อมูลในชีตไม่เปลี่ยน (ซิงก์เฉพาะส่วนควรเหลือแค่ถาม modifiedTime)
+        cache = app.get_month_cache()
+        ttl, cache.ttl = cache.ttl, 0
+        app.get_storage_backend()._forget_version()
+        try:
+            page_load(app, today)
+        finally:
+            cache.ttl = ttl
+
+    def past_month_after_restart():
+        # เดือนที่ปิดแล้วควรมาจาก MonthArchive (Parquet) ไม่ต้องดาวน์โหลดชีตซ้ำ
+        restart_process(app)
+        page_load(app, last_month)
+
+    def year_summary():
+        app.build_daily_summary(dt.date(today.year, 1, 1), dt.date(today.year, 12, 31), today)
+
+    def year_summary_all_branches():
+        # ยอดรวมทุกสาขา: โหลดทุกเดือนของทุกสาขาพร้อมกัน เวลาไม่ควรเพิ่มตามจำนวนสาขา
+        app.build_daily_summary(dt.date(today.year, 1, 1), dt.date(today.year, 12, 31), today, app.get_branches())
+
+    def year_summary_warm_store():
+        # ล้างเฉพาะแคชรายเดือนในหน่วยความจำ เดือนที่ปิดแล้วควรมาจากตารางสรุปรายวัน
+        app.get_month_cache.clear()
+        year_summary()
+
+    results = []
+    reset_caches(app)
+    results.append(measure(server, "cold open", lambda: page_load(app, today)))
+    results.append(measure(server, "warm rerun", lambda: page_load(app, today)))
+    results.append(measure(server, "rerun after cache TTL", ttl_reload))
+    results.append(measure(server, "save income", save_income))
+    results.append(measure(server, "save 20 expenses", save_expenses))
+    results.append(measure(server, "switch month", lambda: page_load(app, last_month)))
+    # ให้เดือนก่อนมีชีตของเดือนนั้นจริง (เดือนที่ fallback ไปชีตพื้นฐานไม่ถูกเก็บลง archive) แล้วเปิดดูหนึ่งครั้ง
+    app.update_income_row(last_month, 900, 400, 0, 0, 120, 0)
+    app.update_expense_cells(last_month, expenses[:5])
+    wait_synced(app)
+    page_load(app, last_month)
+    results.append(measure(server, "past month after restart", past_month_after_restart))
+    reset_caches(app)
+    results.append(measure(server, "yearly summary (cold)", year_summary))
+    results.append(measure(server, "yearly summary (warm store)", year_summary_warm_store))
+    reset_caches(app)
+    branches = len(app.get_branches())
+    results.append(measure(server, f"yearly summary, {branches} branches (cold)", year_summary_all_branches))
+    return results
+
+
+def cold_start_child(latency_ms: float):
+    """ส่วนที่รันใน process ใหม่: import แอป (รันหน้าแรกแบบ bare mode) แล้วพิมพ์ผลเป็น JSON"""
+    t0 = time.perf_counter()
+    import pandas  # noqa: F401  (framework ที่ทุกเวอร์ชันของแอปต้องโหลดเหมือนกัน แยกเวลาออกมา)
+    import streamlit  # noqa: F401
+
+    framework_seconds = time.perf_counter() - t0
+
+    server = fake_gsheets.FakeSheetsServer(latency=latency_ms / 1000)
+    server.seed_demo(SHEET_ID, expense_items=BENCH_EXPENSE_ITEMS)
+    fake_gsheets.set_default_server(server)
+
+    # thread ที่สร้าง client ของชีต: ต้องเป็น thread warmup ไม่ใช่ thread ที่วาดหน้าแรก
+    client_threads = []
+    make_client = server.client
+
+    def client(*args, **kwargs):
+        client_threads.append(threading.current_thread().name)
+        return make_client(*args, **kwargs)
+
+    server.client = client
+
+    def first_page():
+        import streamlit_app_cloud as app  # แท็บสรุปปิดอยู่ในโหมด bare จึงวาดเฉพาะแท็บบันทึกข้อมูล
+
+        return {
+            "deferred_modules_loaded": [m for m in DEFERRED_MODULES if m in sys.modules],
+            "deferred_names_at_top_level": [n for n in DEFERRED_TOP_LEVEL_NAMES if n in vars(app)],
+            "client_threads": client_threads,
+            "report_template_built": any(
+                isinstance(name, tuple) and name[0] == "report_template" for name in app.get_asset_cache()._entries
+            ),
+        }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure_streamlit(Path(tmp), latency_ms)
+        sys.path.insert(0, str(Path(__file__).parent))
+        result = measure(server, "cold start (new process)", first_page)
+        result["framework_import_seconds"] = round(framework_seconds, 4)
+        # เวลาที่ผู้ใช้จ่ายเพิ่มตอนเปิดแท็บสรุปครั้งแรก
+        result["summary_import_seconds"] = _timed(lambda: __import__("altair"))
+    print(json.dumps(result, ensure_ascii=False))
+
+
+def cold_start_failures(result):
+    """สิ่งที่หน้าแรกทำเกินกว่าที่ควร (list ว่างถ้าผ่าน)"""
+    failures = []
+    if result["deferred_modules_loaded"]:
+        failures.append(f"หน้าแรกโหลดโมดูลที่ควรเลื่อนไว้: {', '.join(result['deferred_modules_loaded'])}")
+    if result["deferred_names_at_top_level"]:
+        failures.append(f"แอป import ที่ระดับโมดูล: {', '.join(result['deferred_names_at_top_level'])}")
+    if result["client_threads"] != ["whale-workbook-warmup"]:
+        failures.append(f"client ของชีตควรถูกสร้างครั้งเดียวใน thread warmup แต่ได้ {result['client_threads']}")
+    if result["report_template_built"]:
+        failures.append("หน้าแรกสร้าง template รายงานทั้งที่ยังไม่ได้เปิดแท็บสรุป")
+    return failures
+
+
+def call_count_failures(results, branches: int):
+    """สถานการณ์ที่ใช้ API call เกิน MAX_CALLS (list ว่างถ้าผ่าน)"""
+    budget = dict(MAX_CALLS)
+    budget[f"yearly summary, {branches} branches (cold)"] = (
+        MAX_CALLS["yearly summary (cold)"] + MAX_CALLS_PER_EXTRA_BRANCH * (branches - 1)
+    )
+    failures = []
+    for r in results:
+        limit = budget.get(r["scenario"])
+        if limit is None:
+            failures.append(f"{r['scenario']}: ไม่มีค่าใน MAX_CALLS")
+        elif r["api_calls"] > limit:
+            failures.append(f"{r['scenario']}: {r['api_calls']} calls (สูงสุด {limit}) {r['calls_by_method']}")
+    return failures
+
+
+def measure_cold_start(latency_ms: float):
+    """รัน cold_start_child ใน interpreter ใหม่ แล้วคืนผลพร้อมเวลาทั้ง process (รวมการเริ่ม Python)"""
+    t0 = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, str(Path(__file__).resolve()), "--cold-start-child", "--latency-ms", str(latency_ms)],
+        capture_output=True,
+        text=True,
+        encoding="utf-8",
+        check=True,
+    )
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    result["process_seconds"] = round(time.perf_counter() - t0, 4)
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--latency-ms", type=float, default=100.0, help="latency ต่อ request ของชีตจำลอง")
+    parser.add_argument("--output", default="bench_results.json", help="ไฟล์ JSON สำหรับเก็บผล")
+    parser.add_argument("--branches", type=int, default=3, help="จำนวนสาขา (ไฟล์ชีต) สำหรับสรุปรวมทุกสาขา")
+    parser.add_argument("--cold-start-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.cold_start_child:
+        cold_start_child(args.latency_ms)
+        return
+
+    # วัดก่อน import แอปใน process นี้ (process ลูกเริ่มจากศูนย์อยู่แล้ว แต่ให้ลำดับผลตรงกับการใช้งานจริง)
+    results = [measure_cold_start(args.latency_ms)]
+
+    server = fake_gsheets.FakeSheetsServer(latency=args.latency_ms / 1000)
+    for sheet_id in _branch_sheet_ids(args.branches):
+        server.seed_demo(sheet_id, expense_items=BENCH_EXPENSE_ITEMS)
+    fake_gsheets.set_default_server(server)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        _configure_streamlit(Path(tmp), args.latency_ms, args.branches)
+        sys.path.insert(0, str(Path(__file__).parent))
+        import streamlit_app_cloud as app  # รันหน้าแอปหนึ่งรอบแบบ bare mode ตอน import
+
+        results += run_scenarios(app, server, dt.date.today())
+
+    report = {
+        "created_at": dt.datetime.now().isoformat(timespec="seconds"),
+        "latency_ms": args.latency_ms,
+        "branches": args.branches,
+        "results": results,
+    }
+    Path(args.output).write_text(json.dumps(report, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    print(f"{'scenario':<36}{'calls':>7}{'sent':>10}{'received':>10}{'wall s':>9}{'ui s':>8}")
+    for r in results:
+        ui = f"{r['ui_seconds']:.3f}" if "ui_seconds" in r else "-"
+        print(
+            f"{r['scenario']:<36}{r['api_calls']:>7}{r['bytes_sent']:>10}{r['bytes_received']:>10}"
+            f"{r['wall_seconds']:>9.3f}{ui:>8}"
+        )
+    cold = results[0]
+    print(
+        f"\ncold start: หน้าแรก {cold['wall_seconds']:.3f}s (import framework {cold['framework_import_seconds']:.3f}s,"
+        f" ทั้ง process {cold['process_seconds']:.3f}s), เปิดแท็บสรุปครั้งแรก +{cold['summary_import_seconds']:.3f}s"
+    )
+    print(f"\nผลถูกเขียนลง {args.output}")
+
+    failures = cold_start_failures(cold) + call_count_failures(results, args.branches)
+    if failures:
+        sys.exit("\n".join(["benchmark ไม่ผ่าน:"] + failures))
+
+
+if __name__ == "__main__":
+    main()
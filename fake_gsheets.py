@@ -0,0 +1,452 @@
+"""Google Sheets จำลองในหน่วยความจำ สำหรับทดสอบและวัดประสิทธิภาพแอปโดยไม่ต้องต่อเน็ต
+
+รองรับเฉพาะส่วนของ gspread ที่แอปใช้ (client / spreadsheet / worksheet)
+ทุกการเรียกที่เทียบเท่ากับ 1 request ของ Google API จะถูกนับไว้ใน FakeSheetsServer.calls
+และจำลอง latency กับ error 429 (quota เต็ม) ได้
+
+ใช้กับแอปโดยใส่ใน secrets:
+
+    [fake_gsheets]
+    latency_ms = 150      # หน่วงทุก request
+    error_rate = 0.05     # โอกาสที่ request จะได้ 429
+    seed_demo = true      # สร้างชีตพื้นฐานตัวอย่างให้ sheet_id ที่ตั้งไว้
+"""
+import datetime as dt
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+from gspread.utils import a1_range_to_grid_range, absolute_range_name, rowcol_to_a1
+
+DEMO_EXPENSE_ITEMS = ["ค่าเช่าร้าน", "วัตถุดิบ", "ค่าไฟ", "ค่าน้ำ", "ค่าแรง", "บรรจุภัณฑ์", "ค่าแก๊ส", "อื่นๆ"]
+
+
+class _FakeResponse:
+    """ทำหน้าที่แทน requests.Response เพื่อสร้าง gspread APIError"""
+
+    def __init__(self, code: int, message: str, status: str):
+        self.status_code = code
+        self.text = message
+        self._error = {"code": code, "message": message, "status": status}
+
+    def json(self):
+        return {"error": self._error}
+
+
+def _format_value(value):
+    """แปลงค่าที่เขียนให้เหมือนค่าที่ Google Sheets แสดงกลับมา (USER_ENTERED)"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return "" if value is None else str(value)
+
+
+def _trim(rows):
+    """ตัดช่องว่างท้ายแถว และแถวว่างท้ายตาราง เหมือน response ของ Sheets API"""
+    trimmed = []
+    for row in rows:
+        row = list(row)
+        while row and row[-1] == "":
+            row.pop()
+        trimmed.append(row)
+    while trimmed and not trimmed[-1]:
+        trimmed.pop()
+    return trimmed
+
+
+_A1_CELLS = re.compile(r"[A-Z]*[0-9]*(:[A-Z]*[0-9]*)?")
+
+
+def _invalid_range(name: str):
+    return APIError(_FakeResponse(400, f"Unable to parse range: {name}", "INVALID_ARGUMENT"))
+
+
+def _split_range(name: str):
+    """แยก range แบบ A1 เป็น (ชื่อชีต หรือ None, ส่วนของช่อง) ตามกติกาของ API
+
+    มีชื่อชีตนำหน้าได้ไม่เกินหนึ่งครั้ง ชื่อที่อยู่ในเครื่องหมาย ' ใช้ '' แทน ' ในชื่อ
+    range ที่ผิดรูปแบบ (เช่นมีชื่อชีตซ้อนสองชั้น 'ก'!'ก'!B5) ได้ APIError 400
+    """
+    if "!" not in name:
+        return None, name
+    sheet, cells = name.rsplit("!", 1)
+    if len(sheet) >= 2 and sheet[0] == sheet[-1] == "'":
+        title = sheet[1:-1]
+        if "'" in title.replace("''", ""):
+            raise _invalid_range(name)
+        title = title.replace("''", "'")
+    elif "'" in sheet or "!" in sheet or not sheet:
+        raise _invalid_range(name)
+    else:
+        title = sheet
+    return title, cells
+
+
+def _payload_size(obj) -> int:
+    """ขนาดโดยประมาณ (ไบต์) ของ payload JSON ที่ส่ง/รับกับ API"""
+    return len(json.dumps(obj, ensure_ascii=False).encode("utf-8")) if obj is not None else 0
+
+
+class FakeSheetsServer:
+    """เก็บ spreadsheet ทั้งหมดในหน่วยความจำ พร้อมตัวนับ request, latency และ error ที่จำลองได้
+
+    latency: วินาทีที่หน่วงทุก request
+    error_rate: โอกาส (0-1) ที่ request จะได้ APIError 429
+    bytes_sent / bytes_received: ขนาด payload JSON โดยประมาณที่แอปส่งไป/ได้รับกลับ
+    """
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._fail_next = []
+        self._spreadsheets = {}
+        self.transport = None
+
+    # ---------- จัดการข้อมูล ----------
+    def create_spreadsheet(self, key: str, sheets=None, title: str = "วาฬวาฬ"):
+        """สร้าง spreadsheet ใหม่ sheets: dict ของ {ชื่อชีต: ตารางค่า (list ของแถว)}"""
+        with self._lock:
+            spreadsheet = FakeSpreadsheet(self, key, title)
+            for sheet_title, values in (sheets or {}).items():
+                spreadsheet._add(sheet_title, [list(map(_format_value, row)) for row in values])
+            self._spreadsheets[key] = spreadsheet
+            return spreadsheet
+
+    def seed_demo(self, key: str, expense_items=DEMO_EXPENSE_ITEMS):
+        """สร้างไฟล์ตัวอย่างที่มีชีตพื้นฐาน 'รายรับ' และ 'รายจ่าย' แบบเดียวกับไฟล์จริงของร้าน"""
+        income = [["วันที่", "เงินสด", "สแกน", "คนละครึ่ง", "Grab", "Shopee", "LINE Man"]]
+        income += [[str(day)] + [""] * 6 for day in range(1, 32)]
+        expense = [["รายการรายจ่าย/วันที่"] + [str(day) for day in range(1, 32)]]
+        expense += [[item] + [""] * 31 for item in expense_items]
+        expense.append(["รวมทั้งเดือน"] + [""] * 31)
+        return self.create_spreadsheet(key, {"รายรับ": income, "รายจ่าย": expense})
+
+    def has_spreadsheet(self, key: str) -> bool:
+        return key in self._spreadsheets
+
+    def client(self, transport=None):
+        """client แบบ gspread ของ server นี้
+
+        transport: ฟังก์ชัน transport(send, repeatable) ที่ทุก request ผ่าน (ทำหน้าที่แทน http_client ของ gspread
+        เช่น SheetsRateLimiter.send) send() ส่ง request นั้นหนึ่งครั้ง repeatable บอกว่าส่งซ้ำได้ปลอดภัยหรือไม่
+        """
+        if transport is not None:
+            self.transport = transport
+        return FakeClient(self)
+
+    # ---------- ตัวนับ / error ----------
+    def fail_next(self, count: int = 1, code: int = 429, request: str = None):
+        """ให้ request ถัดไป count ครั้งได้ APIError ตาม code ที่กำหนด
+        request: ชื่อ request ใน calls (เช่น "values_batch_update") ถ้าให้มาจะนับเฉพาะ request ชื่อนั้น
+        """
+        with self._lock:
+            self._fail_next.extend([(code, request)] * count)
+
+    def reset_counters(self):
+        with self._lock:
+            self.calls.clear()
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    # request ที่ไม่ควรส่งซ้ำเมื่อได้ 5xx (spreadsheets.batchUpdate เช่น addSheet/duplicateSheet)
+    NOT_REPEATABLE = {"add_worksheet", "spreadsheets_batch_update"}
+
+    def _request(self, name: str, payload=None):
+        """ส่ง request หนึ่งครั้ง ผ่าน transport ถ้ามี (เหมือน http_client ของ gspread)"""
+        if self.transport is None:
+            return self._send(name, payload)
+        return self.transport(lambda: self._send(name, payload), name not in self.NOT_REPEATABLE)
+
+    def _send(self, name: str, payload=None):
+        """นับ request หนึ่งครั้ง แล้วจำลอง latency และ error ตามที่ตั้งไว้"""
+        with self._lock:
+            self.calls[name] += 1
+            self.bytes_sent += _payload_size(payload)
+            code = None
+            for i, (fail_code, request) in enumerate(self._fail_next):
+                if request is None or request == name:
+                    code = fail_code
+                    del self._fail_next[i]
+                    break
+            if code is None and self.error_rate and self._random.random() < self.error_rate:
+                code = 429
+        if self.latency:
+            time.sleep(self.latency)
+        if code == 429:
+            raise APIError(_FakeResponse(429, "Quota exceeded for quota metric 'Requests'", "RESOURCE_EXHAUSTED"))
+        if code is not None:
+            raise APIError(_FakeResponse(code, "Fake server error", "INTERNAL"))
+
+    def _respond(self, result):
+        """นับขนาด response แล้วคืนค่าเดิม"""
+        with self._lock:
+            self.bytes_received += _payload_size(result)
+        return result
+
+
+class FakeClient:
+    def __init__(self, server: FakeSheetsServer):
+        self.server = server
+
+    def open_by_key(self, key: str):
+        self.server._request("open_by_key")
+        try:
+            spreadsheet = self.server._spreadsheets[key]
+        except KeyError:
+            raise SpreadsheetNotFound(key) from None
+        self.server._respond({"id": key, "title": spreadsheet.title})
+        return spreadsheet
+
+
+class FakeSpreadsheet:
+    def __init__(self, server: FakeSheetsServer, key: str, title: str):
+        self.server = server
+        self.id = key
+        self.title = title
+        self._sheets = []
+        self._next_sheet_id = 0
+        self._modified_at = dt.datetime.now(dt.timezone.utc)
+
+    def _touch(self):
+        """เลื่อนเวลาแก้ไขล่าสุดของไฟล์ (modifiedTime ใน Drive) ให้เปลี่ยนทุกครั้งที่มีการเขียน"""
+        now = dt.datetime.now(dt.timezone.utc)
+        self._modified_at = max(now, self._modified_at + dt.timedelta(milliseconds=1))
+
+    def _add(self, title: str, values, rows: int = 1000, cols: int = 26):
+        ws = FakeWorksheet(self, self._next_sheet_id, title, values, rows, cols)
+        self._next_sheet_id += 1
+        self._sheets.append(ws)
+        return ws
+
+    def _resolve_range(self, name: str, default):
+        """คืนค่า (worksheet, grid range) ของ range แบบ A1 ถ้าไม่มีชื่อชีตนำหน้าใช้ชีต default
+        ชีตที่ไม่มีอยู่จริงหรือช่องที่ผิดรูปแบบได้ APIError 400
+        """
+        title, cells = _split_range(name)
+        ws = default
+        if title is not None:
+            ws = next((w for w in self._sheets if w.title == title), None)
+            if ws is None:
+                raise _invalid_range(name)
+        if not cells or not _A1_CELLS.fullmatch(cells):
+            raise _invalid_range(name)
+        return ws, a1_range_to_grid_range(cells)
+
+    def _metadata(self):
+        return self.server._respond({"sheets": [ws._properties() for ws in self._sheets]})
+
+    def worksheets(self, exclude_hidden: bool = False):
+        self.server._request("fetch_sheet_metadata")
+        self._metadata()
+        return list(self._sheets)
+
+    def worksheet(self, title: str):
+        self.server._request("fetch_sheet_metadata")
+        self._metadata()
+        for ws in self._sheets:
+            if ws.title == title:
+                return ws
+        raise WorksheetNotFound(title)
+
+    def add_worksheet(self, title: str, rows: int, cols: int, index=None):
+        self.server._request("add_worksheet", {"title": title, "rows": rows, "cols": cols})
+        with self.server._lock:
+            if any(ws.title == title for ws in self._sheets):
+                raise APIError(_FakeResponse(
+                    400, f"A sheet with the name \"{title}\" already exists.", "INVALID_ARGUMENT"
+                ))
+            self._touch()
+            return self._add(title, [], rows, cols)
+
+    def batch_update(self, body):
+        """spreadsheets.batchUpdate รองรับ duplicateSheet และ updateCells แบบล้างค่า (ไม่มี rows)
+
+        ทุก request ใน body ทำงานแบบ all-or-nothing เหมือน API จริง ถ้ามีอันไหนผิดจะไม่มีอะไรเปลี่ยน
+        """
+        self.server._request("spreadsheets_batch_update", body)
+        with self.server._lock:
+            sheets, next_id = list(self._sheets), self._next_sheet_id
+            values = [[list(row) for row in ws._values] for ws in sheets]
+            replies = []
+            try:
+                for i, request in enumerate(body.get("requests", [])):
+                    replies.append(self._apply_request(i, request))
+            except APIError:
+                self._sheets, self._next_sheet_id = sheets, next_id
+                for ws, rows in zip(sheets, values):
+                    ws._values = rows
+                raise
+            self._touch()
+        return self.server._respond({"spreadsheetId": self.id, "replies": replies})
+
+    def _apply_request(self, i: int, request):
+        def invalid(message):
+            return APIError(_FakeResponse(400, f"Invalid requests[{i}]: {message}", "INVALID_ARGUMENT"))
+
+        if "duplicateSheet" in request:
+            spec = request["duplicateSheet"]
+            source = next((ws for ws in self._sheets if ws.id == spec["sourceSheetId"]), None)
+            if source is None:
+                raise invalid(f"No grid with id: {spec['sourceSheetId']}")
+            title = spec["newSheetName"]
+            if any(ws.title == title for ws in self._sheets):
+                raise invalid(f"A sheet with the name \"{title}\" already exists. Please enter another name.")
+            sheet_id = spec.get("newSheetId", self._next_sheet_id)
+            if any(ws.id == sheet_id for ws in self._sheets):
+                raise invalid(f"Sheet with id {sheet_id} already exists.")
+            ws = FakeWorksheet(self, sheet_id, title, source._values, source.row_count, source.col_count)
+            self._next_sheet_id = max(self._next_sheet_id, sheet_id + 1)
+            self._sheets.append(ws)
+            return {"duplicateSheet": {"properties": ws._properties()}}
+
+        if "updateCells" in request:
+            spec = request["updateCells"]
+            if "rows" in spec or spec.get("fields") != "userEnteredValue":
+                raise NotImplementedError("fake updateCells รองรับเฉพาะการล้างค่า (fields=userEnteredValue)")
+            rng = spec["range"]
+            ws = next((w for w in self._sheets if w.id == rng["sheetId"]), None)
+            if ws is None:
+                raise invalid(f"No grid with id: {rng['sheetId']}")
+            for r, row in enumerate(ws._values):
+                if rng.get("startRowIndex", 0) <= r < rng.get("endRowIndex", len(ws._values)):
+                    c0, c1 = rng.get("startColumnIndex", 0), rng.get("endColumnIndex", len(row))
+                    row[c0:c1] = [""] * len(row[c0:c1])
+            return {}
+
+        raise NotImplementedError(f"fake batch_update ไม่รองรับ {list(request)}")
+
+    def get_lastUpdateTime(self):
+        """modifiedTime ของไฟล์จาก Drive API (files.get)"""
+        self.server._request("drive_files_get")
+        with self.server._lock:
+            modified = self._modified_at.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+        self.server._respond({"modifiedTime": modified})
+        return modified
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet: FakeSpreadsheet, sheet_id: int, title: str, values, rows: int, cols: int):
+        self.spreadsheet = spreadsheet
+        self.id = sheet_id
+        self.title = title
+        self.row_count = max(rows, len(values))
+        self.col_count = max([cols] + [len(r) for r in values])
+        self._values = [list(r) for r in values]
+
+    @property
+    def _server(self):
+        return self.spreadsheet.server
+
+    def _properties(self):
+        return {"sheetId": self.id, "title": self.title, "rowCount": self.row_count, "columnCount": self.col_count}
+
+    # ---------- อ่าน ----------
+    def _slice(self, name: str):
+        ws, rng = self.spreadsheet._resolve_range(name, self)
+        r0 = rng.get("startRowIndex", 0)
+        r1 = rng.get("endRowIndex", len(ws._values))
+        c0 = rng.get("startColumnIndex", 0)
+        c1 = rng.get("endColumnIndex", ws.col_count)
+        return _trim([row[c0:c1] for row in ws._values[r0:r1]])
+
+    def get_all_values(self):
+        self._server._request("values_get")
+        with self._server._lock:
+            rows = _trim(self._values)
+        self._server._respond(rows)
+        width = max((len(r) for r in rows), default=0)
+        return [r + [""] * (width - len(r)) for r in rows]
+
+    def row_values(self, row: int):
+        self._server._request("values_get")
+        with self._server._lock:
+            return self._server._respond((self._slice(f"{row}:{row}") or [[]])[0])
+
+    def col_values(self, col: int):
+        self._server._request("values_get")
+        with self._server._lock:
+            return self._server._respond([r[col - 1] if len(r) >= col else "" for r in _trim(self._values)])
+
+    def batch_get(self, ranges, **kwargs):
+        # เหมือน gspread: ต่อชื่อชีตนำหน้าทุก range ก่อนส่ง
+        ranges = [absolute_range_name(self.title, name) for name in ranges]
+        self._server._request("values_batch_get", ranges)
+        with self._server._lock:
+            return self._server._respond([self._slice(name) for name in ranges])
+
+    # ---------- เขียน ----------
+    def _write(self, rng, values):
+        r0 = rng.get("startRowIndex", 0)
+        c0 = rng.get("startColumnIndex", 0)
+        for i, row in enumerate(values):
+            while len(self._values) <= r0 + i:
+                self._values.append([])
+            target = self._values[r0 + i]
+            for j, value in enumerate(row):
+                while len(target) <= c0 + j:
+                    target.append("")
+                target[c0 + j] = _format_value(value)
+        self.row_count = max(self.row_count, len(self._values))
+        self.col_count = max([self.col_count] + [len(r) for r in self._values])
+        self.spreadsheet._touch()
+
+    def _write_ranges(self, items):
+        """เขียนหลาย (range, values) แบบ all-or-nothing: ตรวจทุก range ก่อน ถ้ามีอันไหนผิดจะไม่มีอะไรเปลี่ยน"""
+        resolved = [(self.spreadsheet._resolve_range(name, self), values) for name, values in items]
+        for (ws, rng), values in resolved:
+            ws._write(rng, values)
+
+    def update(self, range_name, values=None, **kwargs):
+        # รองรับทั้ง update("A1", values) และ update(values, "A1") แบบ gspread 6
+        if isinstance(range_name, list):
+            range_name, values = values or "A1", range_name
+        range_name = absolute_range_name(self.title, range_name)
+        self._server._request("values_update", {"range": range_name, "values": values})
+        with self._server._lock:
+            self._write_ranges([(range_name, values)])
+
+    def update_cell(self, row: int, col: int, value):
+        range_name = absolute_range_name(self.title, rowcol_to_a1(row, col))
+        self._server._request("values_update", {"range": range_name, "values": [[value]]})
+        with self._server._lock:
+            self._write_ranges([(range_name, [[value]])])
+
+    def batch_update(self, data, **kwargs):
+        # เหมือน gspread: ต่อชื่อชีตนำหน้า range ในแต่ละ dict ของผู้เรียกโดยตรง (แก้ argument ในที่)
+        for item in data:
+            item["range"] = absolute_range_name(self.title, item["range"])
+        self._server._request("values_batch_update", data)
+        with self._server._lock:
+            self._write_ranges([(item["range"], item["values"]) for item in data])
+
+
+_default_server = None
+_default_server_lock = threading.Lock()
+
+
+def get_default_server(latency: float = 0.0, error_rate: float = 0.0, seed=None):
+    """server กลางของ process ที่แอปใช้เมื่อเปิดโหมด fake_gsheets (สร้างครั้งแรกตามค่าที่ส่งมา)"""
+    global _default_server
+    with _default_server_lock:
+        if _default_server is None:
+            _default_server = FakeSheetsServer(latency=latency, error_rate=error_rate, seed=seed)
+        return _default_server
+
+
+def set_default_server(server: FakeSheetsServer):
+    """ให้แอปใช้ server ที่สร้างไว้เอง (เช่น จากสคริปต์ benchmark)"""
+    global _default_server
+    with _default_server_lock:
+        _default_server = server
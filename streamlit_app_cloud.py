@@ -1,8 +1,26 @@
 import streamlit as st
 import pandas as pd
-import altair as alt
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import datetime as dt
 import base64
+import calendar
+import contextvars
+import copy
+import hmac
+import json
+import logging
+import os
+import random
+import sqlite3
+import string
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
 # --- รีเซ็ต session อัตโนมัติเมื่อเปลี่ยนวัน ---
 if "last_open_date" not in st.session_state:
     st.session_state.last_open_date = dt.date.today()
@@ -10,10 +28,9 @@ elif st.session_state.last_open_date != dt.date.today():
     st.session_state.clear()
     st.session_state.last_open_date = dt.date.today()
 # -------------------------------------------------
-import streamlit.components.v1 as components
-import gspread
-from google.oauth2.service_account import Credentials
-from gspread.exceptions import APIError, SpreadsheetNotFound, WorksheetNotFound
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+# altair, gspread, google-auth และ streamlit.components import ในฟังก์ชันที่ใช้ (ครั้งแรกที่เรียก)
+# เพราะใช้เวลารวมเกือบครึ่งวินาทีตอนเปิดเครื่องใหม่ และฟอร์มบันทึกข้อมูลไม่ต้องใช้
 
 from pathlib import Path
 
@@ -28,20 +45,622 @@ st.set_page_config(
 
 INCOME_SHEET_NAME = "รายรับ"
 EXPENSE_SHEET_NAME = "รายจ่าย"
+INCOME_COLUMNS = ["เงินสด", "สแกน", "คนละครึ่ง", "Grab", "Shopee", "LINE Man"]
+SHEET_NAMES = {"income": INCOME_SHEET_NAME, "expense": EXPENSE_SHEET_NAME}
+LOCAL_CACHE_DIR = Path(__file__).with_name(".whale_cache")
+# จำนวน connection ที่ client ของ Google Sheets เปิดค้างไว้ได้พร้อมกัน (ใช้ร่วมกันทุกสาขา)
+SHEETS_HTTP_POOL_SIZE = 16
+# error จากงานเบื้องหลัง (สร้างชีตล่วงหน้า, เปิดไฟล์ตอนเริ่ม) ที่ไม่มี rerun ไหนแสดงให้ผู้ใช้เห็น
+log = logging.getLogger("whale")
+
+# ------------------------------
+# INSTRUMENTATION (จับเวลาต่อ rerun)
+# ------------------------------
+class RerunMetrics:
+    """เก็บเวลาและจำนวนครั้งของแต่ละขั้นตอนใน rerun เดียว (บันทึกจากหลาย thread พร้อมกันได้)
+
+    เวลาของแต่ละขั้นตอนรวมขั้นตอนย่อยที่อยู่ข้างในด้วย และขั้นตอนที่รันขนานกันใน thread pool
+    อาจรวมกันแล้วเกินเวลาทั้ง rerun ได้
+    """
+
+    def __init__(self, scope: str = "page"):
+        self.scope = scope
+        self.started_at = dt.datetime.now()
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._steps = {}
+        self.total_seconds = None
+
+    def record(self, name: str, seconds: float):
+        with self._lock:
+            step = self._steps.setdefault(name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0})
+            step["count"] += 1
+            step["seconds"] += seconds
+            step["max_seconds"] = max(step["max_seconds"], seconds)
+
+    def finish(self):
+        self.total_seconds = time.perf_counter() - self._t0
+
+    def steps(self):
+        """คืนค่า {ชื่อขั้นตอน: {count, seconds, max_seconds}} เรียงจากใช้เวลามากไปน้อย"""
+        with self._lock:
+            items = sorted(self._steps.items(), key=lambda kv: kv[1]["seconds"], reverse=True)
+            return {name: dict(step) for name, step in items}
+
+    def api_calls(self) -> int:
+        return sum(step["count"] for name, step in self.steps().items() if name.startswith("gsheets."))
+
+    def to_record(self, session_id: str):
+        """ข้อมูลของ rerun นี้ในรูปแบบ dict สำหรับเขียน log แบบ JSON"""
+        return {
+            "event": "rerun",
+            "scope": self.scope,
+            "session": session_id,
+            "started_at": self.started_at.isoformat(timespec="milliseconds"),
+            "total_ms": round((self.total_seconds or 0.0) * 1000, 1),
+            "api_calls": self.api_calls(),
+            "steps": {
+                name: {
+                    "count": step["count"],
+                    "ms": round(step["seconds"] * 1000, 1),
+                    "max_ms": round(step["max_seconds"] * 1000, 1),
+                }
+                for name, step in self.steps().items()
+            },
+        }
+
+
+def _current_metrics():
+    """RerunMetrics ของ rerun ที่ thread นี้ทำงานให้ หรือ None ถ้าไม่ได้อยู่ใน rerun (เช่น ตัวซิงก์เบื้องหลัง)"""
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    return st.session_state.get("_perf_metrics")
+
+
+@contextmanager
+def track(name: str):
+    """จับเวลาโค้ดในบล็อก with แล้วบันทึกลง RerunMetrics ของ rerun ปัจจุบัน"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = _current_metrics()
+        if metrics is not None:
+            metrics.record(name, time.perf_counter() - t0)
+
+
+def timed(name: str):
+    """decorator จับเวลาทุกครั้งที่เรียกฟังก์ชัน (ใช้ track)"""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with track(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracedGsheet:
+    """หุ้ม Spreadsheet/Worksheet ของ gspread เพื่อจับเวลาและนับทุกการเรียก API เป็นขั้นตอน gsheets.<ชื่อเมธอด>
+
+    worksheet ที่ได้จาก worksheets()/worksheet()/add_worksheet() จะถูกหุ้มต่อให้ด้วย
+    attribute ที่ไม่ใช่เมธอด (เช่น title, id) อ่านผ่านไปยังออบเจกต์จริงตรงๆ
+    """
+
+    _RETURNS_WORKSHEETS = {"worksheets", "worksheet", "add_worksheet"}
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            with track(f"gsheets.{name}"):
+                result = attr(*args, **kwargs)
+            if name in self._RETURNS_WORKSHEETS:
+                if isinstance(result, list):
+                    return [TracedGsheet(ws) for ws in result]
+                return TracedGsheet(result)
+            return result
+
+        return call
+
+
+@st.cache_resource
+def get_perf_logger():
+    """logger "whale.perf" เขียนหนึ่งบรรทัด JSON ต่อ rerun ลง stderr
+    และต่อท้ายไฟล์ st.secrets["perf_log_path"] ด้วยถ้าตั้งไว้
+    """
+    logger = logging.getLogger("whale.perf")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    if not logger.handlers:
+        logger.addHandler(logging.StreamHandler())
+        log_path = st.secrets.get("perf_log_path")
+        if log_path:
+            Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+            logger.addHandler(logging.FileHandler(log_path, encoding="utf-8"))
+    return logger
+
+
+def start_rerun_metrics(scope: str = "page"):
+    st.session_state["_perf_metrics"] = RerunMetrics(scope)
+
+
+@contextmanager
+def fragment_run(name: str):
+    """จับเวลาเนื้อหาของ fragment เป็นขั้นตอน name
+
+    ถ้ารอบนี้เป็นการ rerun เฉพาะ fragment (ไม่ได้รันทั้งหน้า) จะเริ่มและปิด RerunMetrics ของรอบนั้นเอง
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    partial = ctx is not None and bool(ctx.fragment_ids_this_run)
+    if partial:
+        start_rerun_metrics(scope=name)
+    try:
+        with track(name):
+            yield
+    finally:
+        if partial:
+            finish_rerun_metrics()
+
+
+def finish_rerun_metrics(history_size: int = 20):
+    """ปิดการจับเวลาของ rerun นี้ เขียน log แบบ JSON และเก็บประวัติไว้ใน session
+
+    คืนค่า RerunMetrics ของ rerun นี้ หรือ None ถ้าไม่ได้รันผ่าน streamlit run
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    metrics = st.session_state.get("_perf_metrics")
+    if ctx is None or metrics is None:
+        return None
+    metrics.finish()
+    get_perf_logger().info(json.dumps(metrics.to_record(ctx.session_id), ensure_ascii=False))
+    history = st.session_state.setdefault("_perf_history", [])
+    history.append(metrics)
+    del history[:-history_size]
+    return metrics
+
+
+def is_admin_mode() -> bool:
+    """แสดงแผงวัดประสิทธิภาพเมื่อตั้ง admin_panel = true ใน secrets
+    หรือเปิดด้วย ?admin=<admin_token> เมื่อตั้ง admin_token ไว้ใน secrets (ไม่ตั้ง = เปิดผ่าน URL ไม่ได้)
+    แผงนี้แสดงเวลาภายในและชื่อไฟล์/ชีต จึงไม่ให้ใครก็ได้ที่รู้ URL เปิดดู
+    """
+    if st.secrets.get("admin_panel", False):
+        return True
+    token = str(st.secrets.get("admin_token", ""))
+    given = st.query_params.get("admin")
+    return bool(token) and given is not None and hmac.compare_digest(given.encode(), token.encode())
+
+
+start_rerun_metrics()
+
+# ------------------------------
+# STATIC ASSETS (โหลดครั้งเดียวต่อ process)
+# ------------------------------
+LOGO_PATH = Path(__file__).with_name("logo_whale.png")
+
+REPORT_HTML_TEMPLATE = """<html><head><meta charset='utf-8'>
+<style>
+body {{ font-family: -apple-system,BlinkMacSystemFont,"Segoe UI",sans-serif; padding:16px; color:#222; }}
+h2 {{ margin-top:0; }}
+table {{ border-collapse: collapse; width: 100%; margin-top: 12px; }}
+th, td {{ border: 1px solid #ddd; padding: 6px 8px; font-size: 13px; }}
+th {{ background:#f1f3ff; text-align:center; }}
+.summary-box {{ margin-top:12px; padding:10px 12px; background:#f7fbff; border-radius:8px; border:1px solid #dde7ff; }}
+.btn-print {{ padding:6px 12px; border-radius:6px; border:none; background:#ff4b4b; color:white; cursor:pointer; font-size:13px; }}
+.btn-print:hover {{ opacity:0.9; }}
+.header-row {{ display:flex; align-items:center; justify-content:space-between; gap:8px; margin-bottom:4px; }}
+.logo-box {{ display:flex; align-items:center; gap:8px; margin-bottom:6px; }}
+.logo-box img {{ max-height:60px; }}
+</style>
+</head>
+<body>
+<div class='logo-box'>
+  {logo_img_html}
+</div>
+<div class='header-row'>
+  <h2>รายงานสรุปรายรับ–รายจ่าย</h2>
+  <button class='btn-print' onclick='window.print()'>🖨️ พิมพ์รายงาน</button>
+</div>
+<div>ช่วงวันที่: <b>{period_text}</b></div>
+<div class='summary-box'>
+  <div>รวมรายรับ: <b>{total_income} บาท</b></div>
+  <div>รวมรายจ่าย: <b>{total_expense} บาท</b></div>
+  <div>กำไรสุทธิ: <b>{profit} บาท</b></div>
+</div>
+<table>
+    <thead>
+        <tr>
+            <th style='width:60px;'>วันที่</th>
+            <th>รวมรับ (บาท)</th>
+            <th>รวมจ่าย (บาท)</th>
+            <th>กำไรต่อวัน (บาท)</th>
+        </tr>
+    </thead>
+    <tbody>
+        {table_rows}
+    </tbody>
+</table>
+</body></html>"""
+
+
+class AssetCache:
+    """เก็บไฟล์ static ที่แปลงแล้ว (เช่น โลโก้ base64, template รายงาน) ไว้ตลอด process
+
+    แต่ละ entry จำ mtime ของไฟล์ต้นทางไว้ ถ้าไฟล์ถูกแก้ (mtime เปลี่ยน) จะโหลดและแปลงใหม่
+    ทุก rerun จึงเหลือแค่การ stat ไฟล์ ไม่ต้องอ่านไฟล์และเข้ารหัสซ้ำ
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, name, path: Path, build):
+        """คืนค่า (ค่าที่แปลงแล้ว, mtime) ของ asset ชื่อ name
+
+        build(path) สร้างค่าจากไฟล์ (path เป็น None ถ้าไม่มีไฟล์) จะถูกเรียกเฉพาะตอนที่ mtime เปลี่ยน
+        """
+        try:
+            mtime = path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry[1] != mtime:
+                entry = (build(path if mtime is not None else None), mtime)
+                self._entries[name] = entry
+            return entry
+
+
+@st.cache_resource
+def get_asset_cache():
+    return AssetCache()
+
+
+def get_logo_bytes():
+    """ไฟล์โลโก้ (bytes) หรือ None ถ้าไม่มีไฟล์"""
+    return get_asset_cache().get("logo", LOGO_PATH, lambda p: p.read_bytes() if p else None)[0]
+
+
+def compile_template(template: str, **static):
+    """แปลง format string เป็น list ของ (ข้อความคงที่, ชื่อช่อง) และแทนค่าช่องที่คงที่ (static) ไว้ล่วงหน้า
+
+    ตอน render เหลือแค่ต่อข้อความกับค่าของช่องที่เหลือ ไม่ต้อง parse template ใหม่
+    """
+    parts = []
+    text = ""
+    for literal, field, _, _ in string.Formatter().parse(template):
+        text += literal
+        if field is None:
+            continue
+        if field in static:
+            text += static[field]
+        else:
+            parts.append((text, field))
+            text = ""
+    parts.append((text, None))
+    return parts
+
+
+def render_template(parts, **values):
+    return "".join(text + (values[field] if field else "") for text, field in parts)
+
+
+def _build_report_template(logo_path):
+    logo_img_html = ""
+    if logo_path is not None:
+        logo_b64 = base64.b64encode(logo_path.read_bytes()).decode("utf-8")
+        logo_img_html = f"<img src='data:image/png;base64,{logo_b64}' alt='whale logo'>"
+    return compile_template(REPORT_HTML_TEMPLATE, logo_img_html=logo_img_html)
+
+
+def get_report_template():
+    """template รายงานที่ฝังโลโก้แล้ว คืนค่า (parts, version) โดย version เปลี่ยนเมื่อโลโก้หรือ template เปลี่ยน"""
+    name = ("report_template", hash(REPORT_HTML_TEMPLATE))
+    parts, mtime = get_asset_cache().get(name, LOGO_PATH, _build_report_template)
+    return parts, (name[1], mtime)
+
+
+# ------------------------------
+# RATE LIMIT (quota ของ Google Sheets API)
+# ------------------------------
+class TokenBucket:
+    """token bucket ที่ใช้ร่วมกันทุก session และทุก thread ในโปรเซส: หนึ่ง request ใช้หนึ่ง token
+
+    เก็บ token ได้สูงสุด capacity ใบ (ยิงติดกันได้เท่านี้) และเติมคืน refill_per_second ใบต่อวินาที
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self._lock = threading.Lock()
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+
+    def acquire(self) -> float:
+        """รอจนได้ token หนึ่งใบ คืนค่าเวลาที่ต้องรอ (วินาที)"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.refill_per_second)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.refill_per_second
+            time.sleep(delay)
+            waited += delay
+
+
+class SheetsRateLimiter:
+    """ทุกการเรียก Google Sheets API ผ่านตัวนี้
+
+    - send: ใช้ที่ชั้น HTTP (ดู rate_limited_http_client) ทีละ HTTP request
+      รอ token จาก TokenBucket ก่อนส่ง เพื่อไม่ให้ทุกเครื่องรวมกันเกิน quota ต่อนาที
+      ถ้าได้ 429 (quota เต็ม) หรือ 5xx ลองใหม่แบบ exponential backoff + jitter สูงสุด max_retries ครั้ง
+      (5xx ลองใหม่เฉพาะ request ที่ส่งซ้ำได้ปลอดภัย เช่น การอ่าน หรือการเขียนค่าลงช่องเดิมทับ)
+      การลองใหม่ส่ง request เดิมที่ gspread สร้างเสร็จแล้ว ไม่เรียกเมธอดของ gspread ซ้ำ
+      (บางเมธอด เช่น Worksheet.batch_update แก้ argument ของผู้เรียกในที่ เรียกซ้ำแล้ว range จะผิด)
+    - call: ใช้ที่ชั้นเมธอด (RateLimitedGsheet) การอ่านแบบเดียวกัน (object, เมธอด, arguments เดียวกัน)
+      ที่เกิดพร้อมกันจะส่งจริงแค่ครั้งเดียว ผู้ที่มาทีหลังรอผลของ request แรกแล้วได้สำเนาของผลนั้น
+      (ยกเว้น Spreadsheet/Worksheet ที่ใช้ตัวเดียวกันได้)
+    """
+
+    READ_METHODS = {
+        "get_all_values", "get_values", "get", "batch_get", "col_values", "row_values",
+        "worksheets", "worksheet", "get_lastUpdateTime", "fetch_sheet_metadata", "open_by_key",
+    }
+    RETURNS_HANDLES = {"open_by_key", "worksheets", "worksheet", "add_worksheet"}
+
+    def __init__(self, bucket: TokenBucket, max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 32.0):
+        self.bucket = bucket
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+    @staticmethod
+    def _retryable(error, repeatable: bool) -> bool:
+        code = getattr(error, "code", None)
+        if code == 429:
+            return True
+        return isinstance(code, int) and code >= 500 and repeatable
+
+    def send(self, fn, repeatable: bool = True):
+        """ส่ง HTTP request หนึ่งครั้ง (fn ไม่รับ argument) ผ่าน quota และลองใหม่เมื่อได้ 429/5xx"""
+        from gspread.exceptions import APIError
+
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            if waited:
+                _record_metric("quota.wait", waited)
+            try:
+                return fn()
+            except APIError as e:
+                if attempt >= self.max_retries or not self._retryable(e, repeatable):
+                    raise
+                delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+                _record_metric("quota.retry", delay)
+                time.sleep(delay)
+                attempt += 1
+
+    def call(self, target, method: str, fn, args, kwargs):
+        if method not in self.READ_METHODS:
+            return fn(*args, **kwargs)
+
+        key = (id(target), method, repr(args), repr(sorted(kwargs.items())))
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._in_flight[key] = {"done": threading.Event(), "result": None, "error": None}
+        if not leader:
+            flight["done"].wait()
+            _record_metric("quota.coalesced", 0.0)
+            if flight["error"] is not None:
+                raise flight["error"]
+            if method in self.RETURNS_HANDLES:
+                return flight["result"]
+            return copy.deepcopy(flight["result"])
+
+        try:
+            flight["result"] = fn(*args, **kwargs)
+            return flight["result"]
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            flight["done"].set()
+
+
+def rate_limited_http_client(limiter: SheetsRateLimiter):
+    """คลาส HTTPClient ของ gspread (ส่งให้ gspread.authorize(http_client=...)) ที่ทุก HTTP request ผ่าน limiter.send
+
+    request ที่ไม่ควรส่งซ้ำเมื่อได้ 5xx: spreadsheets.batchUpdate (เช่น addSheet) และ values.append
+    """
+    from gspread.http_client import HTTPClient
+
+    class RateLimitedHTTPClient(HTTPClient):
+        def request(self, method, endpoint, *args, **kwargs):
+            repeatable = method.lower() == "get" or ("/values" in endpoint and ":append" not in endpoint)
+            return limiter.send(lambda: HTTPClient.request(self, method, endpoint, *args, **kwargs), repeatable)
+
+    return RateLimitedHTTPClient
+
+
+class RateLimitedGsheet:
+    """หุ้ม client/Spreadsheet/Worksheet ของ gspread ให้การอ่านที่ซ้ำกันพร้อมกันส่งจริงครั้งเดียว (SheetsRateLimiter.call)
+
+    Spreadsheet/Worksheet ที่ได้จากการเรียก (เช่น open_by_key, worksheets) จะถูกหุ้มต่อให้ด้วย
+    """
+
+    def __init__(self, target, limiter: SheetsRateLimiter):
+        self._target = target
+        self._limiter = limiter
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        @wraps(attr)
+        def call(*args, **kwargs):
+            result = self._limiter.call(self._target, name, attr, args, kwargs)
+            if name in SheetsRateLimiter.RETURNS_HANDLES:
+                if isinstance(result, list):
+                    return [RateLimitedGsheet(item, self._limiter) for item in result]
+                return RateLimitedGsheet(result, self._limiter)
+            return result
+
+        return call
+
+
+def _record_metric(name: str, seconds: float):
+    metrics = _current_metrics()
+    if metrics is not None:
+        metrics.record(name, seconds)
+
+
+@st.cache_resource
+def get_rate_limiter():
+    """ตัวจำกัดอัตราที่ใช้ร่วมกันทุก session
+
+    secrets: sheets_requests_per_minute (ค่าเริ่มต้น 60 ตาม quota ต่อผู้ใช้ของ Sheets API)
+    และ sheets_burst (จำนวน request ที่ยิงติดกันได้ ค่าเริ่มต้นเท่ากับ quota ต่อนาที)
+    """
+    per_minute = float(st.secrets.get("sheets_requests_per_minute", 60))
+    burst = float(st.secrets.get("sheets_burst", per_minute))
+    return SheetsRateLimiter(TokenBucket(capacity=burst, refill_per_second=per_minute / 60))
+
+
+# ------------------------------
+# BRANCHES (หลายสาขา แต่ละสาขามีไฟล์ Google Sheets ของตัวเอง)
+# ------------------------------
+class Branch:
+    """สาขาหนึ่ง = ไฟล์ Google Sheets หนึ่งไฟล์
+
+    key ใช้แยกแคชและไฟล์ในเครื่องของแต่ละสาขา (คือ sheet_id หรือ "local" ถ้าไม่มี)
+    สาขาที่ตรงกับ sheet_id เดิม (legacy) ใช้ไฟล์ในเครื่องชื่อเดิม งานที่ค้างในคิวจากก่อนเพิ่มสาขาจึงยังถูกส่ง
+    """
+
+    def __init__(self, name: str, sheet_id, legacy: bool):
+        self.name = name
+        self.sheet_id = sheet_id
+        self.key = sheet_id or "local"
+        self.legacy = legacy
+
+    def local_path(self, path) -> Path:
+        """ไฟล์/โฟลเดอร์ในเครื่องของสาขานี้ สาขาที่ไม่ใช่ legacy ต่อท้ายชื่อด้วย key เช่น write_queue-<key>.sqlite3"""
+        path = Path(path)
+        if self.legacy:
+            return path
+        return self.cache_path(path)
+
+    def cache_path(self, path) -> Path:
+        """ไฟล์/โฟลเดอร์แคชของข้อมูลในชีต ต่อท้ายชื่อด้วย key เสมอ (รวมสาขา legacy)
+        เปลี่ยน sheet_id ไปไฟล์อื่นแล้วจึงไม่ได้ยอดของไฟล์เดิมกลับมา
+        """
+        path = Path(path)
+        return path.with_name(f"{path.stem}-{self.key}{path.suffix}")
+
+
+@st.cache_resource
+def get_branches():
+    """สาขาทั้งหมดจาก st.secrets["sheet_ids"] (ชื่อจาก "branch_names" ถ้ามี)
+
+    ถ้าไม่ได้ตั้ง sheet_ids จะเป็นสาขาเดียวตาม sheet_id เดิม
+    """
+    legacy_id = get_sheet_id_from_secrets()
+    sheet_ids = list(st.secrets.get("sheet_ids", [])) or [legacy_id]
+    names = list(st.secrets.get("branch_names", []))
+    return [
+        Branch(
+            names[i] if i < len(names) else f"สาขา {i + 1}",
+            sheet_id,
+            legacy=len(sheet_ids) == 1 or sheet_id == legacy_id,
+        )
+        for i, sheet_id in enumerate(sheet_ids)
+    ]
+
+
+def get_branch(key: str) -> Branch:
+    return next(branch for branch in get_branches() if branch.key == key)
+
+
+_active_branch = contextvars.ContextVar("whale_branch", default=None)
+
+
+def current_branch() -> Branch:
+    """สาขาที่โค้ดตรงนี้ทำงานให้ (ตั้งด้วย use_branch) ถ้าไม่ได้ตั้งคือสาขาแรก"""
+    return _active_branch.get() or get_branches()[0]
+
+
+@contextmanager
+def use_branch(branch: Branch):
+    """ให้การอ่าน/เขียนข้อมูลทั้งหมดในบล็อกนี้ใช้ไฟล์ชีต แคช และคิวงานเขียนของสาขา branch"""
+    token = _active_branch.set(branch)
+    try:
+        yield branch
+    finally:
+        _active_branch.reset(token)
+
+
+def selected_branch() -> Branch:
+    """สาขาที่เลือกใน sidebar (แท็บบันทึกข้อมูลใช้สาขานี้)"""
+    branches = get_branches()
+    name = st.session_state.get("branch")
+    return next((branch for branch in branches if branch.name == name), branches[0])
+
 
 # ------------------------------
 # GOOGLE SHEETS
 # ------------------------------
 @st.cache_resource
 def get_gsheet_client():
+    fake_cfg = st.secrets.get("fake_gsheets")
+    if fake_cfg is not None:
+        # โหมดทดสอบ/benchmark: ใช้ Google Sheets จำลองในหน่วยความจำ (fake_gsheets.py) แทนของจริง
+        import fake_gsheets
+
+        server = fake_gsheets.get_default_server(
+            latency=float(fake_cfg.get("latency_ms", 0)) / 1000,
+            error_rate=float(fake_cfg.get("error_rate", 0)),
+            seed=fake_cfg.get("seed"),
+        )
+        if fake_cfg.get("seed_demo", False):
+            for branch in get_branches():
+                if branch.sheet_id and not server.has_spreadsheet(branch.sheet_id):
+                    server.seed_demo(branch.sheet_id)
+        return RateLimitedGsheet(server.client(transport=get_rate_limiter().send), get_rate_limiter())
+
     sa_info = st.secrets["gcp_service_account"]
     scopes = [
         "https://www.googleapis.com/auth/spreadsheets",
         "https://www.googleapis.com/auth/drive",
     ]
+    import gspread
+    from google.auth.transport.requests import AuthorizedSession
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+
     creds = Credentials.from_service_account_info(sa_info, scopes=scopes)
-    client = gspread.authorize(creds)
-    return client
+    # session เดียวที่มี connection pool ใหญ่พอให้โหลดหลายสาขาพร้อมกันได้โดยไม่ต้องเปิด connection ใหม่
+    session = AuthorizedSession(creds)
+    session.mount("https://", HTTPAdapter(pool_connections=SHEETS_HTTP_POOL_SIZE, pool_maxsize=SHEETS_HTTP_POOL_SIZE))
+    limiter = get_rate_limiter()
+    client = gspread.authorize(None, http_client=rate_limited_http_client(limiter), session=session)
+    return RateLimitedGsheet(client, limiter)
 
 
 def get_sheet_id_from_secrets():
@@ -52,16 +671,24 @@ def get_sheet_id_from_secrets():
     return sheet_id
 
 
-@st.cache_resource
 def get_workbook():
+    """ไฟล์ Google Sheets ของสาขาปัจจุบัน"""
+    return _open_workbook(current_branch().sheet_id)
+
+
+@st.cache_resource
+def _open_workbook(sheet_id):
+    """เปิดไฟล์ครั้งเดียวต่อ sheet_id ทุกสาขาใช้ client (และ rate limiter) ตัวเดียวกัน"""
+    from gspread.exceptions import APIError, SpreadsheetNotFound
+
     client = get_gsheet_client()
-    sheet_id = get_sheet_id_from_secrets()
     if not sheet_id:
         st.error("ไม่พบค่า sheet_id ใน Secrets")
         st.stop()
 
     try:
-        sh = client.open_by_key(sheet_id)
+        with track("gsheets.open_by_key"):
+            sh = client.open_by_key(sheet_id)
     except SpreadsheetNotFound:
         st.error("หาไฟล์ Google Sheets ไม่เจอจาก sheet_id นี้")
         st.stop()
@@ -73,11 +700,11 @@ def get_workbook():
     except Exception as e:
         st.error(f"เกิดข้อผิดพลาดขณะเชื่อมต่อ Google Sheets: {e}")
         st.stop()
-    return sh
+    # ทุกการเรียก API ผ่าน workbook นี้ (รวมถึง worksheet ที่ได้จากมัน) จะถูกจับเวลาในแผงวัดประสิทธิภาพ
+    return TracedGsheet(sh)
 
 
-def ws_to_df(ws):
-    data = ws.get_all_values()
+def values_to_df(data):
     if not data:
         return pd.DataFrame()
     header = [str(h).strip() for h in data[0]]
@@ -87,268 +714,1906 @@ def ws_to_df(ws):
     return df
 
 
-def _get_monthly_sheet_title(base_name: str, ref_date: dt.date) -> str:
-    """สร้างชื่อชีตตามเดือน เช่น รายรับ_2025_11"""
-    return f"{base_name}_{ref_date.year}_{ref_date.month:02d}"
+def _get_monthly_sheet_title(base_name: str, ref_date: dt.date) -> str:
+    """สร้างชื่อชีตตามเดือน เช่น รายรับ_2025_11"""
+    return f"{base_name}_{ref_date.year}_{ref_date.month:02d}"
+
+
+class WorksheetRegistry:
+    """จำ worksheet ทุกแผ่นในไฟล์ (ชื่อชีต -> worksheet) จากการเรียก sh.worksheets() ครั้งเดียว
+
+    จะดึงรายชื่อชีตใหม่เฉพาะตอนที่หาชื่อไม่เจอ และถ้าเพิ่งดึงมาไม่เกิน missing_ttl วินาที
+    จะถือว่าชีตนั้นไม่มีจริง เพื่อให้เดือนที่ต้อง fallback ไปชีตพื้นฐานไม่ต้องถาม metadata ซ้ำทุกครั้ง
+    """
+
+    def __init__(self, sh, missing_ttl: float = 60):
+        self._sh = sh
+        self.missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        self._by_title = {}
+        self._refreshed_at = None
+
+    def get(self, title: str, refresh: bool = False):
+        """คืนค่า worksheet ตามชื่อ หรือ None ถ้าไม่มีชีตนี้ในไฟล์
+
+        refresh=True บังคับให้ดึงรายชื่อชีตใหม่ถ้าหาไม่เจอ (ใช้ก่อนสร้างชีตใหม่)
+        """
+        with self._lock:
+            ws = self._by_title.get(title)
+            if ws is not None:
+                return ws
+            recently_refreshed = (
+                self._refreshed_at is not None and time.monotonic() - self._refreshed_at < self.missing_ttl
+            )
+            if recently_refreshed and not refresh:
+                return None
+            self._by_title = {w.title: w for w in self._sh.worksheets()}
+            self._refreshed_at = time.monotonic()
+            return self._by_title.get(title)
+
+    def add(self, ws):
+        """ลงทะเบียนชีตที่เพิ่งสร้างใหม่"""
+        with self._lock:
+            self._by_title[ws.title] = ws
+
+
+def get_worksheet_registry():
+    return _worksheet_registry(current_branch().sheet_id)
+
+
+@st.cache_resource
+def _worksheet_registry(sheet_id):
+    return WorksheetRegistry(_open_workbook(sheet_id))
+
+
+def get_worksheet_for_month(base_name: str, ref_date: dt.date, kind: str, create_if_missing: bool):
+    """
+    คืนค่า worksheet ของเดือนที่ต้องการ (หาผ่าน WorksheetRegistry)
+
+    - ถ้า create_if_missing=False:
+        ถ้าไม่พบชีตตามเดือน จะ fallback ไปใช้ชีตพื้นฐาน (base_name)
+    - ถ้า create_if_missing=True:
+        ถ้าไม่พบ จะสร้างชีตใหม่โดยใช้ชีตพื้นฐานเป็น template ถ้ามี
+
+    kind: "income" หรือ "expense" เพื่อกำหนด header เริ่มต้นเมื่อไม่มี template
+    """
+    registry = get_worksheet_registry()
+    monthly_title = _get_monthly_sheet_title(base_name, ref_date)
+
+    # ลองหาชีตตามเดือนก่อน
+    ws = registry.get(monthly_title)
+    if ws is not None:
+        return ws
+
+    # ถ้าไม่ต้องสร้างใหม่ ให้ fallback ไปใช้ชีตพื้นฐาน (ถ้ามี)
+    if not create_if_missing:
+        base_ws = registry.get(base_name)
+        if base_ws is None:
+            st.error(f"ไม่พบชีต '{monthly_title}' หรือชีตพื้นฐาน '{base_name}' ในไฟล์ Google Sheets")
+            st.stop()
+        return base_ws
+
+    # ต้องการสร้างใหม่: โคลนชีตพื้นฐานฝั่งเซิร์ฟเวอร์ (SheetProvisioner กันการสร้างซ้ำให้)
+    return get_sheet_provisioner().provision(base_name, monthly_title, kind)
+
+
+class SheetProvisioner:
+    """สร้างชีตของเดือนใหม่ใน Google Sheets
+
+    ถ้ามีชีตพื้นฐานจะโคลนฝั่งเซิร์ฟเวอร์ด้วย spreadsheets.batchUpdate ครั้งเดียว (duplicateSheet แล้วล้างค่า
+    ทุกช่องยกเว้นหัวตารางและคอลัมน์แรกใน request เดียวกัน) ไม่ต้องดาวน์โหลดแล้วอัปโหลด template เอง
+    กันการสร้างซ้ำ 2 ชั้น: ในโปรเซสเดียวกันใช้ lock ต่อชื่อชีต ส่วนระหว่างเครื่องใช้ sheetId ที่คำนวณจากชื่อชีต
+    ถ้าอีกเครื่องสร้างไปก่อน request จะได้ error "already exists" ซึ่งถือว่าสำเร็จแล้วใช้ชีตที่มีอยู่
+    """
+
+    def __init__(self, sh, registry: WorksheetRegistry):
+        self._sh = sh
+        self._registry = registry
+        self._lock = threading.Lock()
+        self._title_locks = {}
+
+    def _title_lock(self, title: str):
+        with self._lock:
+            return self._title_locks.setdefault(title, threading.Lock())
+
+    @staticmethod
+    def stable_sheet_id(title: str) -> int:
+        """sheetId ที่ได้จากชื่อชีต ทุกเครื่องที่สร้างเดือนเดียวกันจะขอ id เดียวกัน"""
+        return zlib.crc32(title.encode("utf-8")) & 0x7FFFFFFF
+
+    @staticmethod
+    def _clone_requests(template_id: int, title: str, sheet_id: int):
+        return [
+            {"duplicateSheet": {"sourceSheetId": template_id, "newSheetId": sheet_id, "newSheetName": title}},
+            {"updateCells": {
+                "range": {"sheetId": sheet_id, "startRowIndex": 1, "startColumnIndex": 1},
+                "fields": "userEnteredValue",
+            }},
+        ]
+
+    @staticmethod
+    def _already_exists(error) -> bool:
+        return getattr(error, "code", None) == 400 and "already exists" in str(error)
+
+    def provision(self, base_name: str, title: str, kind: str):
+        """คืนค่า worksheet ชื่อ title โดยสร้างใหม่ถ้ายังไม่มี"""
+        from gspread.exceptions import APIError
+
+        with self._title_lock(title):
+            # ดึงรายชื่อชีตล่าสุดก่อน เผื่อเครื่องอื่นเพิ่งสร้างชีตของเดือนนี้ไปแล้ว
+            ws = self._registry.get(title, refresh=True)
+            if ws is not None:
+                return ws
+
+            template = self._registry.get(base_name)
+            if template is None:
+                return self._create_blank(title, kind)
+
+            # ครั้งแรกใช้ id จากชื่อชีต ถ้าบังเอิญชนกับชีตอื่นที่ไม่ใช่เดือนนี้ ลองใหม่ด้วย id สุ่ม
+            for sheet_id in (self.stable_sheet_id(title), random.randint(1, 0x7FFFFFFF)):
+                try:
+                    with track("provision.duplicate_sheet"):
+                        self._sh.batch_update({"requests": self._clone_requests(template.id, title, sheet_id)})
+                except APIError as e:
+                    if not self._already_exists(e):
+                        raise
+                ws = self._registry.get(title, refresh=True)
+                if ws is not None:
+                    return ws
+            raise RuntimeError(f"สร้างชีต '{title}' ไม่สำเร็จ")
+
+    def _create_blank(self, title: str, kind: str):
+        """ไม่มีชีตพื้นฐานให้โคลน: สร้างชีตเปล่าแล้วใส่โครงพื้นฐานตาม kind"""
+        from gspread.exceptions import APIError
+
+        new_data, rows, cols = _new_month_grid([], kind)
+        try:
+            ws = self._sh.add_worksheet(title=title, rows=rows, cols=cols)
+        except APIError as e:
+            if not self._already_exists(e):
+                raise
+            return self._registry.get(title, refresh=True)
+        self._registry.add(ws)
+        ws.update("A1", new_data)
+        return ws
+
+
+def get_sheet_provisioner():
+    return _sheet_provisioner(current_branch().sheet_id)
+
+
+@st.cache_resource
+def _sheet_provisioner(sheet_id):
+    return SheetProvisioner(_open_workbook(sheet_id), _worksheet_registry(sheet_id))
+
+
+class MonthPrecreator:
+    """thread เบื้องหลังที่สร้างตารางของเดือนถัดไปไว้ล่วงหน้า เมื่อเหลือไม่เกิน days_ahead วันจะสิ้นเดือน
+
+    ทำให้การบันทึกครั้งแรกของเดือนใหม่ไม่ต้องรอสร้างชีต เช็กทุก interval วินาที
+    (ถ้าชีตมีอยู่แล้วจะเจอใน WorksheetRegistry โดยไม่ต้องเรียก API)
+    """
+
+    def __init__(self, days_ahead: int, branch: Branch, interval: float = 3600.0):
+        self.days_ahead = days_ahead
+        self.branch = branch
+        self.interval = interval
+        self._thread = threading.Thread(target=self._run, name="whale-month-precreator", daemon=True)
+        self._thread.start()
+
+    def due_month(self, today: dt.date):
+        """วันที่ 1 ของเดือนที่ควรสร้างไว้แล้ว ณ วันนี้ หรือ None ถ้ายังไม่ถึงเวลา"""
+        ahead = today + dt.timedelta(days=self.days_ahead)
+        if (ahead.year, ahead.month) == (today.year, today.month):
+            return None
+        return dt.date(ahead.year, ahead.month, 1)
+
+    def run_once(self, today: dt.date = None):
+        month_start = self.due_month(today or dt.date.today())
+        if month_start is None:
+            return None
+        backend = get_storage_backend()
+        for kind in ("income", "expense"):
+            backend.create_month(kind, month_start)
+        return month_start
+
+    def _run(self):
+        while True:
+            try:
+                with use_branch(self.branch):
+                    self.run_once()
+            except Exception:
+                # ลองใหม่รอบหน้า ถ้ายังไม่ได้สร้าง การบันทึกครั้งแรกของเดือนจะสร้างเองเหมือนเดิม
+                # (กรณีเครื่องอื่นสร้างชีตไปก่อน provisioner จัดการเองแล้ว ไม่มาถึงตรงนี้)
+                log.exception("สร้างชีตล่วงหน้าของสาขา %s ไม่สำเร็จ", self.branch.key)
+            time.sleep(self.interval)
+
+
+def get_month_precreator():
+    return _month_precreator(current_branch().key)
+
+
+@st.cache_resource
+def _month_precreator(branch_key: str):
+    """เริ่ม MonthPrecreator ของสาขานั้น ถ้าตั้ง st.secrets["precreate_days_ahead"] ไว้มากกว่า 0
+
+    ค่าเริ่มต้นคือปิด (0) เพราะจะสร้างชีตใหม่ในไฟล์ของผู้ใช้เอง ต้องเปิดเองใน secrets เช่น 3 วัน
+    """
+    days_ahead = int(st.secrets.get("precreate_days_ahead", 0))
+    return MonthPrecreator(days_ahead, get_branch(branch_key)) if days_ahead > 0 else None
+
+
+@st.cache_resource
+def start_workbook_warmup():
+    """เปิดไฟล์ Google Sheets ของทุกสาขาและดึงรายชื่อชีตใน thread เบื้องหลังครั้งแรกที่ container เริ่ม
+
+    การยืนยันตัวตน/เปิดไฟล์ (รวมการ import gspread และ google-auth) จึงทำไปพร้อมกับการวาด sidebar
+    ถ้า rerun แรกเรียกถึง get_worksheet_registry ก่อนเสร็จ จะรอผลเดียวกันจาก cache_resource ไม่ได้เปิดซ้ำ
+    """
+    if st.secrets.get("storage_backend", "gsheets") != "gsheets":
+        return []
+
+    def warm(sheet_id):
+        try:
+            _worksheet_registry(sheet_id).get(_get_monthly_sheet_title(INCOME_SHEET_NAME, dt.date.today()))
+        except Exception:
+            # rerun ที่ใช้ชีตจริงจะเจอ error เดียวกันและแสดงให้ผู้ใช้เห็นเอง
+            log.exception("เปิดไฟล์ %s ล่วงหน้าไม่สำเร็จ", sheet_id)
+
+    threads = [
+        threading.Thread(target=warm, args=(branch.sheet_id,), name="whale-workbook-warmup", daemon=True)
+        for branch in get_branches()
+    ]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def _new_month_grid(template_data, kind: str):
+    """สร้างตารางเริ่มต้นของเดือนใหม่ คืนค่า (values, จำนวนแถว, จำนวนคอลัมน์) ของชีตที่จะสร้าง
+
+    ถ้ามี template จะคัดลอกหัวตารางและคอลัมน์แรก (วันที่/ชื่อรายการ) ค่าอื่นเคลียร์ว่าง
+    ถ้าไม่มี template เลย จะสร้างโครงพื้นฐานตาม kind
+    """
+    if template_data:
+        header_row = template_data[0]
+        num_cols = len(header_row)
+        new_data = [header_row]
+
+        # คัดลอกเฉพาะชื่อแถว/วันที่ในคอลัมน์แรก ค่าอื่นให้เคลียร์ว่าง
+        for row in template_data[1:]:
+            first_col = row[0] if row else ""
+            new_row = [first_col] + [""] * (num_cols - 1)
+            new_data.append(new_row)
+        return new_data, len(new_data) + 5, num_cols + 5
+
+    # กรณีไม่มี template เลย สร้างโครงพื้นฐานใหม่
+    if kind == "income":
+        header = ["วันที่"] + INCOME_COLUMNS
+        # ใส่วันที่ 1-31 ในคอลัมน์แรก
+        return [header] + [[str(i)] + [""] * len(INCOME_COLUMNS) for i in range(1, 32)], 32, len(header)
+    else:
+        header = ["รายการรายจ่าย/วันที่"] + [str(i) for i in range(1, 32)]
+        return [header], 50, len(header)
+
+
+# ------------------------------
+# STORAGE BACKENDS
+# ------------------------------
+class StorageBackend:
+    """ที่เก็บข้อมูลรายเดือน ส่วนอื่นของแอปเรียกผ่าน interface นี้เท่านั้น
+
+    ตารางของแต่ละเดือนมีรูปแบบเหมือนชีตใน Google Sheets (แถวแรกเป็นหัวตาราง)
+    cells ที่เขียนเป็น list ของ (วัน, target, ค่า) โดย target คือช่องทางรายรับ หรือชื่อรายการรายจ่าย
+    ใช้ได้ทั้งการบันทึกรายรับทั้งแถว และรายจ่ายหลายรายการ
+    """
+
+    def load_values(self, kind: str, month_start: dt.date):
+        """คืนค่า (ตารางค่าทั้งหมดของเดือนนั้นเป็น list ของแถว, ชื่อชีตที่อ่านมา)
+        ถ้าไม่มีของเดือนนั้นจะ fallback ไปชีตพื้นฐาน
+        """
+        raise NotImplementedError
+
+    def has_month(self, kind: str, month_start: dt.date) -> bool:
+        """มีตารางของเดือนนั้นเองแล้วหรือไม่ (ไม่นับชีตพื้นฐานที่ใช้ fallback)"""
+        raise NotImplementedError
+
+    def version(self):
+        """ค่าที่เปลี่ยนทุกครั้งที่ข้อมูลในที่เก็บถูกแก้ (ใช้เช็กว่าต้องโหลดใหม่หรือไม่) หรือ None ถ้าบอกไม่ได้"""
+        return None
+
+    def write_cells(self, kind: str, month_start: dt.date, cells):
+        """เขียน cells ลงเดือนนั้น (สร้างเดือนให้ถ้ายังไม่มี) คืนค่า list ของ (วัน, target) ที่หาตำแหน่งไม่เจอ"""
+        raise NotImplementedError
+
+    def create_month(self, kind: str, month_start: dt.date):
+        """สร้างตารางของเดือนนั้นจาก template ถ้ายังไม่มี"""
+        raise NotImplementedError
+
+
+class GoogleSheetsBackend(StorageBackend):
+    """เวอร์ชันของข้อมูลคือ modifiedTime ของไฟล์จาก Drive API (request เล็กๆ ครั้งเดียวต่อทั้งไฟล์)
+    ผลจะถูกใช้ซ้ำ version_max_age วินาที เพื่อให้การโหลดหลายเดือนพร้อมกันถาม Drive แค่ครั้งเดียว
+    """
+
+    def __init__(self, version_max_age: float = 2.0):
+        self.version_max_age = version_max_age
+        self._version_lock = threading.Lock()
+        self._version = None
+        self._version_checked_at = None
+
+    def load_values(self, kind, month_start):
+        ws = get_worksheet_for_month(SHEET_NAMES[kind], month_start, kind=kind, create_if_missing=False)
+        return ws.get_all_values(), ws.title
+
+    def has_month(self, kind, month_start):
+        return get_worksheet_registry().get(_get_monthly_sheet_title(SHEET_NAMES[kind], month_start)) is not None
+
+    def version(self):
+        with self._version_lock:
+            fresh = (
+                self._version_checked_at is not None
+                and time.monotonic() - self._version_checked_at < self.version_max_age
+            )
+            if not fresh:
+                try:
+                    self._version = get_workbook().get_lastUpdateTime()
+                except Exception:
+                    # เช่น ยังไม่ได้เปิด Drive API ให้ Service Account: กลับไปโหลดเต็มทุกครั้งเหมือนเดิม
+                    self._version = None
+                self._version_checked_at = time.monotonic()
+            return self._version
+
+    def write_cells(self, kind, month_start, cells):
+        from gspread.utils import ValueInputOption, rowcol_to_a1
+
+        ws = get_worksheet_for_month(SHEET_NAMES[kind], month_start, kind=kind, create_if_missing=True)
+        header, first_col = _read_header_and_column(ws)
+        if kind == "income" and "วันที่" in header and header.index("วันที่") != 0:
+            first_col = ws.col_values(header.index("วันที่") + 1)
+        data, missing = _locate_cells(kind, header, first_col, cells)
+        if data:
+            ws.batch_update(
+                [{"range": rowcol_to_a1(r, c), "values": [[v]]} for r, c, v in data],
+                value_input_option=ValueInputOption.user_entered,
+            )
+            self._forget_version()
+        return missing
+
+    def _forget_version(self):
+        """ไฟล์เพิ่งถูกเขียน เวอร์ชันที่จำไว้ใช้ไม่ได้แล้ว ครั้งหน้าให้ถาม Drive ใหม่"""
+        with self._version_lock:
+            self._version_checked_at = None
+
+    def create_month(self, kind, month_start):
+        title = _get_monthly_sheet_title(SHEET_NAMES[kind], month_start)
+        if get_worksheet_registry().get(title) is None:
+            get_worksheet_for_month(SHEET_NAMES[kind], month_start, kind=kind, create_if_missing=True)
+            self._forget_version()
+
+
+class SQLiteBackend(StorageBackend):
+    """เก็บทุกเดือนไว้ในไฟล์ SQLite บนเครื่อง ในรูปตาราง (ชื่อชีต, แถว, คอลัมน์, ค่า)
+
+    ใช้ชื่อชีตแบบเดียวกับ Google Sheets (เช่น รายรับ_2025_11) และมีชีตพื้นฐานเป็น template
+    เหมาะกับร้านที่เน็ตช้า หรือใช้ทดสอบแอปโดยไม่ต้องต่อเน็ต
+    """
+
+    def __init__(self, path: Path, expense_items=()):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS cells ("
+                " sheet TEXT, row INTEGER, col INTEGER, value TEXT,"
+                " PRIMARY KEY (sheet, row, col))"
+            )
+            con.execute("CREATE TABLE IF NOT EXISTS meta (version INTEGER)")
+            if con.execute("SELECT 1 FROM meta").fetchone() is None:
+                con.execute("INSERT INTO meta VALUES (0)")
+        # เตรียมชีตพื้นฐานไว้เป็น template ตั้งแต่เปิดครั้งแรก
+        if not self._has_sheet(INCOME_SHEET_NAME):
+            self._save_grid(INCOME_SHEET_NAME, _new_month_grid([], "income")[0])
+        if not self._has_sheet(EXPENSE_SHEET_NAME):
+            header = _new_month_grid([], "expense")[0][0]
+            self._save_grid(EXPENSE_SHEET_NAME, [header] + [[item] for item in expense_items])
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _has_sheet(self, title: str) -> bool:
+        with self._connect() as con:
+            return con.execute("SELECT 1 FROM cells WHERE sheet=? LIMIT 1", (title,)).fetchone() is not None
+
+    def _load_grid(self, title: str):
+        with self._connect() as con:
+            found = con.execute("SELECT row, col, value FROM cells WHERE sheet=?", (title,)).fetchall()
+        if not found:
+            return []
+        n_rows = max(r for r, _, _ in found)
+        n_cols = max(c for _, c, _ in found)
+        grid = [[""] * n_cols for _ in range(n_rows)]
+        for r, c, v in found:
+            grid[r - 1][c - 1] = v
+        return grid
+
+    def _save_grid(self, title: str, grid):
+        with self._connect() as con:
+            con.executemany(
+                "INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)",
+                [
+                    (title, r, c, str(v))
+                    for r, row in enumerate(grid, start=1)
+                    for c, v in enumerate(row, start=1)
+                    if v != ""
+                ],
+            )
+            self._bump_version(con)
+
+    def load_values(self, kind, month_start):
+        title = _get_monthly_sheet_title(SHEET_NAMES[kind], month_start)
+        if not self._has_sheet(title):
+            title = SHEET_NAMES[kind]
+        return self._load_grid(title), title
+
+    def has_month(self, kind, month_start):
+        return self._has_sheet(_get_monthly_sheet_title(SHEET_NAMES[kind], month_start))
+
+    def version(self):
+        with self._connect() as con:
+            return con.execute("SELECT version FROM meta").fetchone()[0]
+
+    def _bump_version(self, con):
+        con.execute("UPDATE meta SET version = version + 1")
+
+    def write_cells(self, kind, month_start, cells):
+        title = _get_monthly_sheet_title(SHEET_NAMES[kind], month_start)
+        with self._lock:
+            self.create_month(kind, month_start)
+            grid = self._load_grid(title)
+            header = [str(h).strip() for h in grid[0]] if grid else []
+            data, missing = _locate_cells(kind, header, [row[0] for row in grid], cells)
+            with self._connect() as con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO cells VALUES (?, ?, ?, ?)",
+                    [(title, r, c, str(v)) for r, c, v in data],
+                )
+                self._bump_version(con)
+        return missing
+
+    def create_month(self, kind, month_start):
+        title = _get_monthly_sheet_title(SHEET_NAMES[kind], month_start)
+        if not self._has_sheet(title):
+            self._save_grid(title, _new_month_grid(self._load_grid(SHEET_NAMES[kind]), kind)[0])
+
+
+def get_storage_backend():
+    return _storage_backend(current_branch().key)
+
+
+@st.cache_resource
+def _storage_backend(branch_key: str):
+    """เลือกที่เก็บข้อมูลจาก st.secrets["storage_backend"]: "gsheets" (ค่าเริ่มต้น) หรือ "sqlite" """
+    if st.secrets.get("storage_backend", "gsheets") == "sqlite":
+        return SQLiteBackend(
+            get_branch(branch_key).local_path(st.secrets.get("sqlite_path", LOCAL_CACHE_DIR / "whale.sqlite3")),
+            expense_items=st.secrets.get("expense_items", []),
+        )
+    return GoogleSheetsBackend()
+
+
+# ------------------------------
+# MONTH CACHE
+# ------------------------------
+class MonthCache:
+    """แคช DataFrame รายเดือนที่ใช้ร่วมกันทุก session โดยใช้ key (kind, year, month)
+
+    แต่ละ entry จำชื่อชีตที่อ่านมา (source_title) ไว้ด้วย เพื่อให้รู้ว่าเป็นข้อมูลจากชีตของเดือนนั้นจริง
+    หรือเป็นข้อมูลที่ fallback มาจากชีตพื้นฐาน
+    และจำตารางค่าดิบ (grid) กับเวอร์ชันของที่เก็บข้อมูลตอนที่อ่าน เพื่อใช้ซิงก์แบบเฉพาะส่วนที่เปลี่ยนเมื่อหมดอายุ
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        """คืนค่า (สำเนา DataFrame, source_title) ของ key หรือ None ถ้าไม่มี/หมดอายุ"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry["fetched_at"] > self.ttl:
+                return None
+            return entry["df"].copy(), entry["source_title"]
+
+    def has(self, key) -> bool:
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and time.monotonic() - entry["fetched_at"] <= self.ttl
+
+    def put(self, key, df, source_title: str, grid=None, version=None):
+        with self._lock:
+            self._entries[key] = {
+                "df": df,
+                "source_title": source_title,
+                "fetched_at": time.monotonic(),
+                "grid": grid,
+                "version": version,
+            }
+
+    def snapshot(self, key):
+        """คืนค่า entry ล่าสุดของ key แม้จะหมดอายุแล้ว (dict ที่มี df, source_title, grid, version) หรือ None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def touch(self, key):
+        """ต่ออายุ entry โดยไม่โหลดใหม่ (ใช้เมื่อรู้แล้วว่าข้อมูลต้นทางไม่เปลี่ยน)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["fetched_at"] = time.monotonic()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def patch(self, key, source_title: str, apply):
+        """แก้ DataFrame ที่แคชไว้ด้วยค่าที่เพิ่งเขียนลงชีต
+
+        apply(df) แก้ df ในที่และคืนค่า False ถ้าแก้ไม่ได้ (เช่น ไม่พบแถว/คอลัมน์)
+        ถ้าแก้ไม่ได้ หรือ entry มาจากชีตอื่น (fallback) จะลบ entry นั้นทิ้งแทน
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if entry["source_title"] != source_title or apply(entry["df"]) is False:
+                self._entries.pop(key, None)
+            else:
+                entry.pop("derived", None)
+
+    def derived(self, key, name: str, build):
+        """ค่าที่คำนวณจากข้อมูลของ entry (เช่น Ledger) สร้างครั้งเดียวต่อข้อมูลหนึ่งชุด
+
+        คืนค่า (ค่า, source_title) หรือ None ถ้าไม่มี entry/หมดอายุ
+        ค่าจะถูกล้างเมื่อ entry ถูกแทนที่ (put) หรือแก้ (patch)
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry["fetched_at"] > self.ttl:
+                return None
+            derived = entry.setdefault("derived", {})
+            if name not in derived:
+                derived[name] = build(entry["df"])
+            return derived[name], entry["source_title"]
+
+
+@st.cache_resource
+def get_month_cache():
+    return MonthCache(ttl=60)
+
+
+def _month_key(kind: str, ref_date: dt.date):
+    return (current_branch().key, kind, ref_date.year, ref_date.month)
+
+
+# ------------------------------
+# SHARED CACHE (ใช้ร่วมกันทุก session และทุกเครื่องที่ชี้ไปไฟล์เดียวกัน)
+# ------------------------------
+class SharedCache:
+    """แคชตารางค่าดิบของแต่ละเดือน (values, source_title, version) ที่อยู่ใต้ MonthCache อีกชั้น
+
+    โหลดแบบ single-flight: ถ้าหลาย session ต้องการ key เดียวกันพร้อมกัน จะมีแค่ตัวแรกที่โหลดจริง
+    ตัวอื่นรอผลของตัวแรก ส่วนการกันระหว่างเครื่อง (replica) ใช้ lease ตาม backend
+    subclass ต้องมี get/put และถ้าใช้ร่วมกันหลายโปรเซสได้ ให้ override _acquire_lease/_release_lease
+    """
+
+    def __init__(self, lease_seconds: float = 30.0, poll_interval: float = 0.1):
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self._flights_lock = threading.Lock()
+        self._flights = {}
+
+    def get(self, key: str):
+        """คืนค่า entry (dict ที่มี value, version, stored_at) หรือ None"""
+        raise NotImplementedError
+
+    def put(self, key: str, value, version):
+        raise NotImplementedError
+
+    def _acquire_lease(self, key: str) -> bool:
+        return True
+
+    def _release_lease(self, key: str):
+        pass
+
+    def load(self, key: str, fetch, accept):
+        """คืนค่า entry ของ key โดยใช้ entry ที่มีอยู่ถ้า accept(entry) เป็นจริง ไม่งั้นเรียก fetch()
+
+        fetch() คืนค่า (value, version) และถูกเรียกครั้งเดียวต่อ key ต่อช่วงเวลาที่โหลดพร้อมกัน
+        """
+        entry = self.get(key)
+        if entry is not None and accept(entry):
+            return entry
+
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = {"done": threading.Event(), "entry": None, "error": None}
+        if not leader:
+            flight["done"].wait()
+            _record_metric("shared_cache.waited", 0.0)
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["entry"]
+
+        try:
+            flight["entry"] = self._load_as_leader(key, fetch)
+            return flight["entry"]
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight["done"].set()
+
+    def _load_as_leader(self, key: str, fetch):
+        started_at = time.time()
+        deadline = time.monotonic() + self.lease_seconds
+        contended = False
+        while not self._acquire_lease(key):
+            # เครื่องอื่นกำลังโหลด key นี้อยู่ รอผลที่เครื่องนั้นเขียนลงแคช
+            contended = True
+            entry = self.get(key)
+            if entry is not None and entry["stored_at"] >= started_at:
+                return entry
+            if time.monotonic() > deadline:
+                # เครื่องที่ถือ lease อาจค้างหรือหยุดไปแล้ว โหลดเองเลย
+                break
+            time.sleep(self.poll_interval)
+        try:
+            if contended:
+                # เครื่องที่โหลดอยู่อาจเขียนผลแล้วคืน lease ระหว่างที่เรารอรอบล่าสุด
+                entry = self.get(key)
+                if entry is not None and entry["stored_at"] >= started_at:
+                    return entry
+            value, version = fetch()
+            self.put(key, value, version)
+            return {"value": value, "version": version, "stored_at": time.time()}
+        finally:
+            self._release_lease(key)
+
+
+class MemorySharedCache(SharedCache):
+    """เก็บใน dict ของโปรเซส ใช้ร่วมกันทุก session ในเครื่องเดียว"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, key):
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key, value, version):
+        with self._lock:
+            self._entries[key] = {"value": value, "version": version, "stored_at": time.time()}
+
+
+class SQLiteSharedCache(SharedCache):
+    """เก็บเป็น JSON ในไฟล์ SQLite ถ้าหลาย replica ชี้ไปไฟล์เดียวกัน (เช่น volume ที่แชร์กัน) จะใช้แคชร่วมกันได้
+
+    lease คือแถวในตาราง leases ที่มีเจ้าของและเวลาหมดอายุ เครื่องที่ใส่แถวได้ก่อนเป็นผู้โหลด
+    """
+
+    def __init__(self, path: Path, **kwargs):
+        super().__init__(**kwargs)
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._owner = f"{os.getpid()}-{id(self)}"
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT, version TEXT, stored_at REAL)"
+            )
+            con.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT, expires_at REAL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key):
+        with self._connect() as con:
+            row = con.execute("SELECT value, version, stored_at FROM entries WHERE key=?", (key,)).fetchone()
+        if row is None:
+            return None
+        return {"value": json.loads(row[0]), "version": json.loads(row[1]), "stored_at": row[2]}
+
+    def put(self, key, value, version):
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), json.dumps(version), time.time()),
+            )
+
+    def _acquire_lease(self, key):
+        now = time.time()
+        with self._connect() as con:
+            con.execute("DELETE FROM leases WHERE key=? AND expires_at < ?", (key, now))
+            inserted = con.execute(
+                "INSERT OR IGNORE INTO leases VALUES (?, ?, ?)", (key, self._owner, now + self.lease_seconds)
+            ).rowcount
+        return inserted == 1
+
+    def _release_lease(self, key):
+        with self._connect() as con:
+            con.execute("DELETE FROM leases WHERE key=? AND owner=?", (key, self._owner))
+
+
+@st.cache_resource
+def get_shared_cache():
+    """เลือกแคชร่วมจาก st.secrets["shared_cache"]: "memory" (ค่าเริ่มต้น) หรือ "sqlite"
+
+    แบบ sqlite ใช้ไฟล์ st.secrets["shared_cache_path"] ให้ทุก replica ชี้ไปที่เดียวกัน
+    """
+    if st.secrets.get("shared_cache", "memory") == "sqlite":
+        return SQLiteSharedCache(st.secrets.get("shared_cache_path", LOCAL_CACHE_DIR / "shared_cache.sqlite3"))
+    return MemorySharedCache()
+
+
+def _shared_month_key(kind: str, month_start: dt.date) -> str:
+    return f"{current_branch().key}:{kind}:{month_start.year}-{month_start.month:02d}"
+
+
+# ------------------------------
+# AGGREGATE STORE (เดือนที่ปิดแล้ว)
+# ------------------------------
+class AggregateStore:
+    """เก็บยอดรวมรายวันของเดือนที่ปิดแล้วไว้ในไฟล์ SQLite บนเครื่อง
+
+    เก็บเป็นแถว (kind, ปี, เดือน, วัน, ประเภท/รายการ, ยอด) เพื่อให้รายงานหลายเดือน/รายปี
+    ไม่ต้องดาวน์โหลดชีตของเดือนเก่าซ้ำทุกครั้ง ตาราง months ใช้จำว่าเดือนไหนเก็บไว้แล้ว
+    และเดือนนั้นมีชีตอยู่จริงหรือไม่ (เดือนที่ไม่มีชีตก็เก็บไว้ จะได้ไม่ต้องถามชีตซ้ำ)
+    เดือนที่ปิดแล้วถือว่าไม่เปลี่ยน ยอดของเดือนหนึ่งจะถูกล้างเมื่อแอปเขียนลงเดือนนั้นเอง
+    หรือผู้ใช้กดรีเฟรชในแท็บสรุป (เช่น หลังแก้ชีตเดือนเก่าโดยตรง)
+    ไม่ผูกกับ modifiedTime ของไฟล์ เพราะค่านั้นเปลี่ยนทุกครั้งที่บันทึกเดือนปัจจุบัน
+    Ledger ที่สร้างจากแถวของแต่ละเดือนถูกจำไว้ในหน่วยความจำจนกว่าเดือนนั้นจะถูกบันทึกใหม่หรือล้าง
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._ledgers = {}
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS months ("
+                " kind TEXT, year INTEGER, month INTEGER, has_sheet INTEGER, synced_at TEXT,"
+                " PRIMARY KEY (kind, year, month))"
+            )
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS daily_totals ("
+                " kind TEXT, year INTEGER, month INTEGER, day INTEGER, category TEXT, amount REAL,"
+                " PRIMARY KEY (kind, year, month, day, category))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def has_month(self, kind: str, month_start: dt.date) -> bool:
+        with self._connect() as con:
+            return con.execute(
+                "SELECT 1 FROM months WHERE kind=? AND year=? AND month=?",
+                (kind, month_start.year, month_start.month),
+            ).fetchone() is not None
+
+    def load_month(self, kind: str, month_start: dt.date):
+        """คืนค่า (has_sheet, list ของ (วัน, ประเภท, ยอด)) ของเดือนนั้น หรือ None ถ้ายังไม่เคยเก็บ"""
+        key = (kind, month_start.year, month_start.month)
+        with self._connect() as con:
+            found = con.execute(
+                "SELECT has_sheet FROM months WHERE kind=? AND year=? AND month=?", key
+            ).fetchone()
+            if found is None:
+                return None
+            rows = con.execute(
+                "SELECT day, category, amount FROM daily_totals WHERE kind=? AND year=? AND month=?", key
+            ).fetchall()
+            return bool(found[0]), rows
+
+    def load_ledger(self, kind: str, month_start: dt.date):
+        """Ledger ของเดือนนั้นจากยอดที่เก็บไว้ หรือ None ถ้ายังไม่เคยเก็บ"""
+        key = (kind, month_start.year, month_start.month)
+        with self._lock:
+            if key in self._ledgers:
+                return self._ledgers[key]
+        stored = self.load_month(kind, month_start)
+        if stored is None:
+            return None
+        ledger = Ledger.from_store_rows(kind, month_start, *stored)
+        with self._lock:
+            return self._ledgers.setdefault(key, ledger)
+
+    def save_month(self, kind: str, month_start: dt.date, has_sheet: bool, rows):
+        """แทนที่ยอดของเดือนนั้นทั้งหมดด้วย rows (วัน, ประเภท, ยอด)"""
+        key = (kind, month_start.year, month_start.month)
+        with self._lock:
+            self._ledgers.pop(key, None)
+        with self._connect() as con:
+            con.execute("DELETE FROM daily_totals WHERE kind=? AND year=? AND month=?", key)
+            con.executemany(
+                "INSERT INTO daily_totals VALUES (?, ?, ?, ?, ?, ?)",
+                [key + (int(day), str(cat), float(amount)) for day, cat, amount in rows],
+            )
+            con.execute(
+                "INSERT OR REPLACE INTO months (kind, year, month, has_sheet, synced_at) VALUES (?, ?, ?, ?, ?)",
+                key + (int(has_sheet), dt.datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def invalidate(self, kind: str, month_start: dt.date):
+        key = (kind, month_start.year, month_start.month)
+        with self._lock:
+            self._ledgers.pop(key, None)
+        with self._connect() as con:
+            con.execute("DELETE FROM daily_totals WHERE kind=? AND year=? AND month=?", key)
+            con.execute("DELETE FROM months WHERE kind=? AND year=? AND month=?", key)
+
+    def invalidate_range(self, start_date: dt.date, end_date: dt.date):
+        lo = start_date.year * 100 + start_date.month
+        hi = end_date.year * 100 + end_date.month
+        with self._lock:
+            self._ledgers = {k: v for k, v in self._ledgers.items() if not lo <= k[1] * 100 + k[2] <= hi}
+        with self._connect() as con:
+            for table in ("daily_totals", "months"):
+                con.execute(f"DELETE FROM {table} WHERE year * 100 + month BETWEEN ? AND ?", (lo, hi))
+
+
+def get_aggregate_store():
+    return _aggregate_store(current_branch().key)
+
+
+@st.cache_resource
+def _aggregate_store(branch_key: str):
+    path = st.secrets.get("aggregate_db_path", LOCAL_CACHE_DIR / "aggregates.sqlite3")
+    return AggregateStore(get_branch(branch_key).cache_path(path))
+
+
+def _is_closed_month(month_start: dt.date) -> bool:
+    """เดือนที่ปิดแล้ว = เดือนก่อนเดือนปัจจุบัน ข้อมูลจะถูกเสิร์ฟจาก AggregateStore"""
+    today = dt.date.today()
+    return (month_start.year, month_start.month) < (today.year, today.month)
+
+
+# ------------------------------
+# MONTH ARCHIVE (ตารางดิบของเดือนที่ปิดแล้วเป็น Parquet)
+# ------------------------------
+class MonthArchive:
+    """เก็บตารางค่าดิบของชีตเดือนที่ปิดแล้วเป็นไฟล์ Parquet บนเครื่อง แบ่งโฟลเดอร์ตาม year=YYYY/month=MM
+
+    หนึ่งไฟล์ต่อ (kind, เดือน) แต่ละคอลัมน์ของชีตเป็นคอลัมน์ string ใน Parquet
+    ชื่อชีตที่อ่านมาอยู่ใน metadata ของไฟล์
+    อ่านแบบ memory-map การดูตารางของเดือนเก่า (แท็บบันทึก) หลัง container เริ่มใหม่จึงไม่ต้องดาวน์โหลดชีตซ้ำ
+    ส่วนรายงานใช้ยอดใน AggregateStore ไฟล์ของเดือนหนึ่งถูกลบตามกติกาเดียวกับ AggregateStore
+    (แอปเขียนลงเดือนนั้น หรือผู้ใช้กดรีเฟรช) ไม่ผูกกับ modifiedTime ของทั้งไฟล์
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def _path(self, kind: str, month_start: dt.date) -> Path:
+        return self.root / f"year={month_start.year}" / f"month={month_start.month:02d}" / f"{kind}.parquet"
+
+    def load(self, kind: str, month_start: dt.date):
+        """คืนค่า (values, source_title) หรือ None ถ้ายังไม่เคยเก็บ"""
+        path = self._path(kind, month_start)
+        if not path.exists():
+            return None
+        with track("archive.read"):
+            try:
+                table = pq.read_table(path, memory_map=True)
+            except (OSError, pa.ArrowInvalid):
+                # ไฟล์เสีย/เขียนไม่ครบ: ถือว่ายังไม่เคยเก็บ จะโหลดจากชีตแล้วเขียนทับ
+                return None
+            meta = table.schema.metadata or {}
+            columns = [table.column(i).to_pylist() for i in range(table.num_columns)]
+        values = [list(row) for row in zip(*columns)]
+        return values, meta[b"source_title"].decode()
+
+    def save(self, kind: str, month_start: dt.date, values, source_title: str):
+        """เขียนตารางของเดือนนั้นทับของเดิม (เขียนไฟล์ชั่วคราวแล้ว rename เพื่อไม่ให้คนอ่านเจอไฟล์ครึ่งๆ)"""
+        width = max((len(row) for row in values), default=0)
+        table = pa.table({
+            f"c{c}": pa.array([str(row[c]) if c < len(row) else "" for row in values], type=pa.string())
+            for c in range(width)
+        }).replace_schema_metadata({
+            "source_title": source_title,
+            "archived_at": dt.datetime.now().isoformat(timespec="seconds"),
+        })
+        path = self._path(kind, month_start)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+        with track("archive.write"):
+            pq.write_table(table, tmp)
+            os.replace(tmp, path)
+
+    def invalidate(self, kind: str, month_start: dt.date):
+        self._path(kind, month_start).unlink(missing_ok=True)
+
+    def invalidate_range(self, start_date: dt.date, end_date: dt.date):
+        for month_start in _months_in_range(start_date, end_date):
+            for kind in SHEET_NAMES:
+                self.invalidate(kind, month_start)
+
+
+def get_month_archive():
+    return _month_archive(current_branch().key)
+
+
+@st.cache_resource
+def _month_archive(branch_key: str):
+    path = st.secrets.get("month_archive_path", LOCAL_CACHE_DIR / "archive")
+    return MonthArchive(get_branch(branch_key).cache_path(path))
+
+
+# ------------------------------
+# LEDGER (ข้อมูลแบบ long format)
+# ------------------------------
+class Ledger:
+    """สมุดบัญชีแบบ long format หนึ่งแถวต่อ (วันที่, kind, ประเภท/รายการ, ยอด) เก็บเฉพาะยอดที่ไม่เป็น 0
+
+    entries ใช้วันที่เป็น index และเรียงตามวันที่ เลือกช่วงวันที่ได้ด้วยการ slice
+    coverage: วันที่ทั้งหมดที่ข้อมูลของแต่ละ kind ครอบคลุม (รวมวันที่ไม่มียอด) เพื่อให้สรุปแสดงวันที่ยอดเป็น 0 ได้
+    ค่าเริ่มต้นในฟอร์มใช้ lookup บน Ledger ส่วนสรุปรายวันและกราฟวงกลมใช้ PrefixSumIndex ที่สร้างจาก Ledger
+    Ledger ไม่ถูกแก้หลังสร้าง จึงจำค่าที่คำนวณจากมันไว้ในอ็อบเจกต์ได้
+    """
+
+    _EMPTY = {}
+
+    def __init__(self, entries, coverage):
+        self.entries = entries
+        self.coverage = coverage
+        self._lookup = None
+        self._index = None
+
+    @classmethod
+    def from_entries(cls, kind: str, dates, categories, amounts, coverage):
+        """สร้าง Ledger ของ kind เดียว รายการที่ (วันที่, ประเภท) ซ้ำกันจะถูกรวมยอด"""
+        entries = pd.DataFrame({
+            "date": pd.to_datetime(list(dates)),
+            "kind": kind,
+            "category": pd.Series(list(categories), dtype=object),
+            "amount": np.asarray(amounts, dtype=np.float64),
+        })
+        entries = entries[entries["amount"] != 0]
+        entries = entries.groupby(["date", "kind", "category"], as_index=False, sort=True)["amount"].sum()
+        return cls(entries.set_index("date"), {kind: pd.DatetimeIndex(sorted(set(pd.to_datetime(list(coverage)))))})
+
+    @classmethod
+    def empty(cls, kind: str):
+        """Ledger ว่างของ kind นั้น (ใช้อ็อบเจกต์เดิมทุกครั้ง เพื่อให้แคชของช่วงวันที่จำได้ว่าเป็นข้อมูลชุดเดิม)"""
+        if kind not in cls._EMPTY:
+            cls._EMPTY[kind] = cls.from_entries(kind, [], [], [], [])
+        return cls._EMPTY[kind]
+
+    @classmethod
+    def from_store_rows(cls, kind: str, month_start: dt.date, has_sheet: bool, rows):
+        """Ledger ของเดือนที่ปิดแล้วจากแถว (วัน, ประเภท, ยอด) ใน AggregateStore"""
+        if not has_sheet:
+            return cls.empty(kind)
+        last_day = calendar.monthrange(month_start.year, month_start.month)[1]
+        return cls.from_entries(
+            kind,
+            [month_start.replace(day=day) for day, _, _ in rows],
+            [cat for _, cat, _ in rows],
+            [amount for _, _, amount in rows],
+            [month_start.replace(day=d) for d in range(1, last_day + 1)],
+        )
+
+    def _of_kind(self, kind: str):
+        return self.entries[self.entries["kind"] == kind]
+
+    def day(self, kind: str, date: dt.date):
+        """ยอดของแต่ละประเภท/รายการในวันนั้น (เฉพาะที่ไม่เป็น 0)"""
+        ts = pd.Timestamp(date)
+        day_entries = self._of_kind(kind).loc[ts:ts]
+        return day_entries.set_index("category")["amount"]
+
+    def covers(self, kind: str, date: dt.date) -> bool:
+        return pd.Timestamp(date) in self.coverage.get(kind, pd.DatetimeIndex([]))
+
+    def amount(self, kind: str, date: dt.date, category) -> float:
+        """ยอดของ (kind, วันที่, ประเภท) หรือ 0 ถ้าไม่มี"""
+        if self._lookup is None:
+            self._lookup = {
+                (kind_, ts.date(), cat): amount
+                for ts, kind_, cat, amount in zip(
+                    self.entries.index, self.entries["kind"], self.entries["category"], self.entries["amount"]
+                )
+            }
+        return float(self._lookup.get((kind, date, category), 0.0))
+
+    def rows(self, kind: str):
+        """แถว (วัน, ประเภท, ยอด) ของ kind นั้น สำหรับเก็บลง AggregateStore"""
+        entries = self._of_kind(kind)
+        return [(ts.day, cat, amount) for ts, cat, amount in zip(entries.index, entries["category"], entries["amount"])]
+
+    def prefix_index(self):
+        """PrefixSumIndex ของ Ledger นี้ (สร้างครั้งแรกที่เรียก แล้วจำไว้)"""
+        if self._index is None:
+            self._index = PrefixSumIndex.from_ledger(self)
+        return self._index
+
+
+class PrefixSumIndex:
+    """ผลรวมสะสม (prefix sum) ต่อวันของทุกประเภท/รายการ สำหรับหายอดรวมของช่วงวันที่ใดๆ ด้วยการลบสองแถว
+
+    days: วันที่ทั้งหมดที่ข้อมูลครอบคลุม (datetime64[D] เรียงจากน้อยไปมาก) เป็นแถวของสรุปรายวัน
+    values[kind]: ยอดต่อวันต่อประเภท ขนาด (จำนวนวัน, จำนวนประเภท) คอลัมน์ตาม categories[kind]
+    cumulative[kind]: ผลรวมสะสมของ values ที่มีแถว 0 นำหน้า ยอดของวัน i..j-1 = cumulative[j] - cumulative[i]
+    """
+
+    def __init__(self, days, categories, values):
+        self.days = days
+        self.categories = categories
+        self.values = values
+        self.cumulative = {}
+        self.daily = {}
+        for kind, matrix in values.items():
+            zero = np.zeros((1, matrix.shape[1]))
+            self.cumulative[kind] = np.concatenate([zero, matrix.cumsum(axis=0)])
+            self.daily[kind] = matrix.sum(axis=1)
+
+    @classmethod
+    def from_ledger(cls, ledger):
+        entries = ledger.entries
+        dates = pd.DatetimeIndex(entries.index.unique())
+        for covered in ledger.coverage.values():
+            dates = dates.union(covered)
+        days = dates.sort_values().values.astype("datetime64[D]")
+
+        categories, values = {}, {}
+        for kind in set(ledger.coverage) | set(entries["kind"]):
+            part = ledger._of_kind(kind)
+            codes, names = pd.factorize(part["category"], sort=True)
+            rows = np.searchsorted(days, part.index.values.astype("datetime64[D]"))
+            matrix = np.zeros((len(days), len(names)))
+            np.add.at(matrix, (rows, codes), part["amount"].to_numpy(dtype=np.float64))
+            categories[kind] = pd.Index(names)
+            values[kind] = matrix
+        return cls(days, categories, values)
+
+    @classmethod
+    def concat(cls, indexes):
+        """รวม index หลายตัว (เช่น รายรับและรายจ่ายของหลายเดือน) เป็น index เดียวบนวันที่ทั้งหมดที่ครอบคลุม"""
+        indexes = list(indexes)
+        days = np.array([], dtype="datetime64[D]")
+        if indexes:
+            days = np.unique(np.concatenate([ix.days for ix in indexes]))
+        categories, values = {}, {}
+        for kind in sorted({kind for ix in indexes for kind in ix.values}):
+            names = pd.Index(sorted({name for ix in indexes for name in ix.categories.get(kind, [])}))
+            matrix = np.zeros((len(days), len(names)))
+            for ix in indexes:
+                if kind in ix.values:
+                    rows = np.searchsorted(days, ix.days)
+                    matrix[np.ix_(rows, names.get_indexer(ix.categories[kind]))] += ix.values[kind]
+            categories[kind] = names
+            values[kind] = matrix
+        return cls(days, categories, values)
+
+    def _bounds(self, start_date: dt.date, end_date: dt.date):
+        lo = int(np.searchsorted(self.days, np.datetime64(start_date, "D"), side="left"))
+        hi = int(np.searchsorted(self.days, np.datetime64(end_date, "D"), side="right"))
+        return lo, max(lo, hi)
+
+    def category_totals(self, kind: str, start_date: dt.date, end_date: dt.date):
+        """ยอดรวมของแต่ละประเภท/รายการในช่วงวันที่ (Series เรียงตามชื่อ ประเภทที่ไม่มียอดเป็น 0)"""
+        if kind not in self.cumulative:
+            return pd.Series(dtype=float)
+        lo, hi = self._bounds(start_date, end_date)
+        cumulative = self.cumulative[kind]
+        # ปัดเศษทิ้ง error ของ floating point ที่เกิดจากการลบผลรวมสะสม (ยอดเงินมีแค่ 2 ตำแหน่ง)
+        return pd.Series(np.round(cumulative[hi] - cumulative[lo], 6), index=self.categories[kind])
+
+    def total(self, kind: str, start_date: dt.date, end_date: dt.date) -> float:
+        """ยอดรวมทั้งหมดของ kind นั้นในช่วงวันที่"""
+        return float(self.category_totals(kind, start_date, end_date).sum())
+
+    def daily_totals(self, kind: str):
+        """ยอดรวมต่อวันของ kind นั้น เรียงตาม days (วันที่ไม่มียอดเป็น 0)"""
+        return self.daily.get(kind, np.zeros(len(self.days)))
+
+
+class RangeIndexCache:
+    """แคช PrefixSumIndex ของหลายเดือนที่รวมแล้ว ใช้ร่วมกันทุก session
+
+    key คือชุดของ index รายเดือนที่ใช้รวม (เทียบด้วยตัวอ็อบเจกต์) entry เก็บอ็อบเจกต์เหล่านั้นไว้ด้วย
+    เมื่อเดือนไหนโหลดใหม่ index ของเดือนนั้นจะเป็นอ็อบเจกต์ใหม่ key จึงเปลี่ยนเองโดยไม่ต้องล้างแคช
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, parts):
+        key = tuple(id(part) for part in parts)
+        with self._lock:
+            found = self._entries.pop(key, None)
+            if found is not None:
+                self._entries[key] = found
+                return found[1]
+        combined = PrefixSumIndex.concat(parts)
+        with self._lock:
+            self._entries[key] = (tuple(parts), combined)
+            while len(self._entries) > self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+        return combined
+
+
+@st.cache_resource
+def get_range_index_cache():
+    return RangeIndexCache()
+
+
+# ------------------------------
+# LOAD DATA (ตามเดือน)
+# ------------------------------
+@timed("parse_income")
+def _parse_income_df(df):
+    if df.empty:
+        return df
+
+    if "วันที่" not in df.columns:
+        df = df.rename(columns={df.columns[0]: "วันที่"})
+
+    df["วันที่"] = pd.to_numeric(df["วันที่"], errors="coerce")
+    df = df[df["วันที่"].notna()]
+    df["วันที่"] = df["วันที่"].astype(int)
+
+    for c in INCOME_COLUMNS:
+        if c in df.columns:
+            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
+        else:
+            df[c] = 0.0
+
+    df["รวมต่อวัน"] = df[INCOME_COLUMNS].sum(axis=1)
+    return df
+
+
+def _parse_income_grid(grid, positions=None):
+    """แปลงตารางค่าดิบของชีตรายรับเป็น DataFrame (index = ลำดับแถวข้อมูลในชีต หรือ positions ที่ส่งมา)"""
+    df = values_to_df(grid)
+    if positions is not None:
+        df.index = positions
+    return _parse_income_df(df)
+
+
+def _merge_income_rows(old_df, new_part, positions):
+    """แทนแถวของ old_df ตาม positions ด้วยแถวที่แปลงใหม่"""
+    return pd.concat([old_df.drop(index=positions, errors="ignore"), new_part]).sort_index()
+
+
+# ยอดที่เล็กกว่านี้และมีทศนิยมไม่เกิน 2 ตำแหน่ง เก็บเป็น float32 แล้วปัดกลับเป็นสตางค์ได้ตรงเสมอ
+FLOAT32_EXACT_LIMIT = 2 ** 17
+
+
+def _fits_float32(values) -> bool:
+    values = np.asarray(values, dtype=np.float64)
+    return values.size == 0 or bool(
+        np.abs(values).max() < FLOAT32_EXACT_LIMIT and np.array_equal(np.round(values, 2), values)
+    )
+
+
+def _grid_cell(row, col: int):
+    return row[col] if col < len(row) else ""
+
+
+class ExpenseMatrix:
+    """ตารางรายจ่ายของหนึ่งเดือนในรูป matrix ตัวเลข (รายการ × วัน) แทน DataFrame ที่เป็นสตริง
+
+    items: ชื่อรายการของแต่ละแถว (None ถ้าแถวนั้นไม่มีชื่อ), days: เลขวันของแต่ละคอลัมน์ตามหัวตาราง
+    values: float32 (ถ้ามียอดที่ float32 เก็บให้ตรงถึงสตางค์ไม่ได้ จะใช้ float64 ทั้งเดือน)
+    positions: ลำดับแถวข้อมูลในชีตของแต่ละแถว (แถวที่ 2 ของชีต = 0) ใช้แทนที่เฉพาะแถวที่เปลี่ยน
+    """
+
+    ITEM_COLUMN = "รายการรายจ่าย/วันที่"
+    TOTAL_ROW = "รวมทั้งเดือน"
+
+    def __init__(self, items, days, values, positions):
+        self.items = np.asarray(items, dtype=object)
+        self.days = np.asarray(days, dtype=np.int64)
+        self.values = values
+        self.positions = np.asarray(positions, dtype=np.int64)
+        # ถ้าหัวตารางมีวันซ้ำ ใช้คอลัมน์แรกเหมือนการเขียนลงชีต
+        self.day_index = {int(d): j for j, d in reversed(list(enumerate(self.days)))}
+
+    @classmethod
+    @timed("parse_expense")
+    def from_grid(cls, grid, positions=None):
+        """แปลงตารางค่าดิบของชีตรายจ่ายเป็น matrix โดยแปลงตัวเลขทุกช่องด้วย pd.to_numeric ครั้งเดียว
+
+        ตัดแถว "รวมทั้งเดือน" ออก ช่องว่างหรือไม่ใช่ตัวเลขเป็น 0
+        """
+        if not grid:
+            return cls([], [], np.zeros((0, 0), dtype=np.float32), [])
+        header = [str(h).strip() for h in grid[0]]
+        item_col = header.index(cls.ITEM_COLUMN) if cls.ITEM_COLUMN in header else 0
+        day_cols = [j for j, h in enumerate(header) if h.isdigit()]
+        if positions is None:
+            positions = range(len(grid) - 1)
+
+        rows = [(pos, row) for pos, row in zip(positions, grid[1:]) if _grid_cell(row, item_col) != cls.TOTAL_ROW]
+        flat = pd.Series([_grid_cell(row, j) for _, row in rows for j in day_cols], dtype=object)
+        numbers = pd.to_numeric(flat, errors="coerce").to_numpy(dtype=np.float64, na_value=0.0)
+        values = numbers.reshape(len(rows), len(day_cols))
+        return cls(
+            [_grid_cell(row, item_col) or None for _, row in rows],
+            [int(header[j]) for j in day_cols],
+            values.astype(np.float32) if _fits_float32(values) else values,
+            [pos for pos, _ in rows],
+        )
+
+    @property
+    def empty(self) -> bool:
+        return len(self.items) == 0
+
+    def copy(self):
+        return ExpenseMatrix(self.items.copy(), self.days.copy(), self.values.copy(), self.positions.copy())
+
+    def amounts(self):
+        """ยอดทั้งหมดเป็น float64 (ค่าจาก float32 ถูกปัดกลับเป็นทศนิยม 2 ตำแหน่งตามที่อยู่ในชีต)"""
+        if self.values.dtype == np.float32:
+            return np.round(self.values.astype(np.float64), 2)
+        return self.values
+
+    def item_names(self):
+        """ชื่อรายการตามลำดับในชีต (ไม่รวมแถวที่ไม่มีชื่อ)"""
+        return [item for item in self.items if item is not None]
+
+    def set_value(self, item_name, day, value) -> bool:
+        """แก้ยอดของรายการ (ทุกแถวที่ชื่อตรงกัน) ในวันนั้น คืนค่า False ถ้าไม่พบรายการหรือวัน"""
+        col = self.day_index.get(int(day))
+        rows = self.items == item_name
+        if col is None or not rows.any():
+            return False
+        if self.values.dtype == np.float32 and not _fits_float32([value]):
+            self.values = self.values.astype(np.float64)
+        self.values[rows, col] = value
+        return True
+
+    def replace_rows(self, new_part, positions):
+        """matrix ใหม่ที่แทนแถวตาม positions ด้วยแถวของ new_part (หัวตารางต้องเหมือนเดิม)"""
+        keep = ~np.isin(self.positions, positions)
+        order = np.argsort(np.concatenate([self.positions[keep], new_part.positions]), kind="stable")
+        return ExpenseMatrix(
+            np.concatenate([self.items[keep], new_part.items])[order],
+            self.days,
+            np.concatenate([self.values[keep], new_part.values])[order],
+            np.concatenate([self.positions[keep], new_part.positions])[order],
+        )
+
+
+def _valid_days(df_days, month_start: dt.date):
+    last_day = calendar.monthrange(month_start.year, month_start.month)[1]
+    return (df_days >= 1) & (df_days <= last_day)
+
+
+def _income_ledger(df, month_start: dt.date):
+    """แปลงตารางรายรับของเดือนเป็น Ledger (ประเภท = ช่องทางรายรับ)"""
+    if df.empty:
+        return Ledger.empty("income")
+    df = df[_valid_days(df["วันที่"], month_start)]
+    dates = [month_start.replace(day=int(d)) for d in df["วันที่"]]
+    stacked = df[INCOME_COLUMNS].set_axis(dates).stack()
+    return Ledger.from_entries(
+        "income",
+        stacked.index.get_level_values(0),
+        stacked.index.get_level_values(1),
+        stacked.to_numpy(dtype=np.float64),
+        dates,
+    )
+
+
+def _expense_ledger(matrix, month_start: dt.date):
+    """แปลง ExpenseMatrix ของเดือนเป็น Ledger (ประเภท = ชื่อรายการ แถวที่ไม่มีชื่อถูกตัดออก)"""
+    if matrix.empty:
+        return Ledger.empty("expense")
+    valid = _valid_days(matrix.days, month_start)
+    named = np.array([item is not None for item in matrix.items], dtype=bool)
+    dates = [month_start.replace(day=int(d)) for d in matrix.days[valid]]
+    amounts = matrix.amounts()[named][:, valid]
+    rows, cols = np.nonzero(amounts)
+    return Ledger.from_entries(
+        "expense",
+        [dates[c] for c in cols],
+        matrix.items[named][rows],
+        amounts[rows, cols],
+        dates,
+    )
+
+
+# kind -> (แปลงตารางค่าดิบ, แทนแถวที่เปลี่ยน, แปลงเป็น Ledger)
+MONTH_SOURCES = {
+    "income": (_parse_income_grid, _merge_income_rows, _income_ledger),
+    "expense": (ExpenseMatrix.from_grid, ExpenseMatrix.replace_rows, _expense_ledger),
+}
+
+
+@timed("load_month")
+def _load_month(kind: str, ref_date: dt.date):
+    """คืนค่า (df, source_title) ของเดือนนั้นผ่าน MonthCache
+
+    เมื่อแคชหมดอายุและเปิดโหมดซิงก์เฉพาะส่วน (ค่าเริ่มต้น) จะเช็กเวอร์ชันของที่เก็บข้อมูลก่อน
+    ถ้าไม่เปลี่ยนก็ใช้ข้อมูลเดิมต่อ ถ้าเปลี่ยนจะโหลดตารางใหม่แต่แปลงเฉพาะแถวที่ต่างจากครั้งก่อน
+    """
+    key = _month_key(kind, ref_date)
+    cache = get_month_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    backend = get_storage_backend()
+    parse, merge, _ = MONTH_SOURCES[kind]
+    snapshot = cache.snapshot(key) if is_incremental_sync() else None
+    # จำงานเขียนที่ค้างไว้ก่อนอ่านเวอร์ชันและโหลดตาราง ถ้าตัวซิงก์ส่งงานเหล่านี้เสร็จระหว่างโหลด
+    # ตารางที่ได้อาจเป็นของก่อนเขียน แต่ยังทับด้วยค่าที่จำไว้ได้ จึงไม่แคชค่าเก่ากว่างานที่ส่งไปแล้ว
+    queue = get_write_queue()
+    pending_before = queue.pending(kind, ref_date)
+    # อ่านเวอร์ชันก่อนโหลดตาราง ถ้ามีการเขียนระหว่างโหลด รอบหน้าจะเห็นเวอร์ชันใหม่และโหลดซ้ำ
+    version = backend.version()
+    if snapshot is not None and version is not None and snapshot["version"] == version:
+        cache.touch(key)
+        return snapshot["df"].copy(), snapshot["source_title"]
+
+    if _is_closed_month(ref_date):
+        values, source_title = _closed_month_values(kind, ref_date, version, cache.ttl)
+    else:
+        values, source_title = _fetch_month_values(kind, ref_date, version, cache.ttl)
+    df = None
+    if snapshot is not None and snapshot["source_title"] == source_title:
+        df = _reparse_changed_rows(parse, merge, snapshot["df"], snapshot["grid"], values)
+    if df is None:
+        df = parse(values)
+    # งานเขียนที่ยังรอซิงก์ (รวมที่เพิ่งส่งเสร็จระหว่างโหลด) ให้ทับค่าจากชีตไว้ก่อน จะได้ไม่เห็นค่าเก่าระหว่างรอ
+    pending = sorted(set(pending_before) | set(queue.pending(kind, ref_date)))
+    if pending:
+        _apply_cells(kind, df, [(day, target, value) for _, _, _, _, day, target, value in pending])
+    cache.put(key, df, source_title, values, version)
+    return df.copy(), source_title
+
+
+def _fetch_month_values(kind: str, ref_date: dt.date, version, max_age: float):
+    """ตารางค่าดิบของเดือนนั้นผ่าน SharedCache คืนค่า (values, source_title)
+
+    ใช้ของในแคชร่วมได้ถ้าเวอร์ชันตรงกับเวอร์ชันปัจจุบันของที่เก็บข้อมูล
+    หรือถ้าไม่รู้เวอร์ชัน (เช่น ไม่ได้เปิด Drive API) ใช้ได้ถ้ายังไม่เกิน max_age วินาที
+    """
+    month_start = dt.date(ref_date.year, ref_date.month, 1)
+
+    def accept(entry):
+        if version is not None:
+            return entry["version"] == version
+        return time.time() - entry["stored_at"] <= max_age
+
+    def fetch():
+        values, source_title = get_storage_backend().load_values(kind, month_start)
+        return {"values": values, "source_title": source_title}, version
+
+    entry = get_shared_cache().load(_shared_month_key(kind, month_start), fetch, accept)
+    return entry["value"]["values"], entry["value"]["source_title"]
+
+
+def _closed_month_values(kind: str, ref_date: dt.date, version, max_age: float):
+    """ตารางค่าดิบของเดือนที่ปิดแล้ว คืนค่า (values, source_title)
+
+    ใช้ของใน MonthArchive ถ้ามี ถ้ายังไม่เคยเก็บ (หรือถูกล้างเพราะแอปเขียนลงเดือนนั้น/กดรีเฟรช) จะโหลดจากชีตแล้วเก็บ
+    เก็บเฉพาะเดือนที่มีชีตของเดือนนั้นจริงและไม่มีงานเขียนของเดือนนั้นค้างอยู่ระหว่างโหลด
+    """
+    month_start = dt.date(ref_date.year, ref_date.month, 1)
+    archive = get_month_archive()
+    archived = archive.load(kind, month_start)
+    if archived is not None:
+        return archived
+
+    queue = get_write_queue()
+    writing = bool(queue.pending(kind, ref_date))
+    values, source_title = _fetch_month_values(kind, ref_date, version, max_age)
+    writing = writing or bool(queue.pending(kind, ref_date))
+    if not writing and source_title == _get_monthly_sheet_title(SHEET_NAMES[kind], month_start):
+        archive.save(kind, month_start, values, source_title)
+    return values, source_title
+
+
+def is_incremental_sync() -> bool:
+    """ซิงก์เฉพาะส่วนที่เปลี่ยน (st.secrets["incremental_sync"], ค่าเริ่มต้น true)"""
+    return bool(st.secrets.get("incremental_sync", True))
+
+
+def _reparse_changed_rows(parse, merge, old_df, old_grid, new_grid):
+    """สร้างข้อมูลของเดือนใหม่จากข้อมูลเดิม โดยแปลงใหม่เฉพาะแถวที่ค่าในชีตต่างจาก grid เดิม
+
+    ข้อมูลที่แปลงแล้วจำลำดับแถวข้อมูลในชีต (แถวที่ 2 ของชีต = 0) ไว้ จึงแทนที่ทีละแถวได้
+    คืนค่า None ถ้าโครงตารางเปลี่ยน (หัวตารางหรือจำนวนแถวไม่เท่าเดิม) ให้ผู้เรียกแปลงใหม่ทั้งตาราง
+    """
+    if old_df.empty or not old_grid or not new_grid:
+        return None
+    if old_grid[0] != new_grid[0] or len(old_grid) != len(new_grid):
+        return None
+    changed = [i for i in range(1, len(new_grid)) if new_grid[i] != old_grid[i]]
+    if not changed:
+        return old_df.copy()
+
+    positions = [i - 1 for i in changed]
+    new_part = parse([new_grid[0]] + [new_grid[i] for i in changed], positions)
+    return merge(old_df, new_part, positions)
+
+
+def load_income_df(ref_date: dt.date):
+    return _load_month("income", ref_date)[0]
+
+
+def load_expense_matrix(ref_date: dt.date):
+    """รายจ่ายของเดือนเป็น ExpenseMatrix (รายการ × วัน)"""
+    return _load_month("expense", ref_date)[0]
+
+
+def load_month_ledger(kind: str, ref_date: dt.date):
+    """Ledger ของข้อมูลเดือนนั้นตามที่โหลดมา (รวมกรณี fallback ไปชีตพื้นฐาน) คืนค่า (ledger, source_title)
+
+    Ledger ถูกสร้างครั้งเดียวต่อข้อมูลที่แคชไว้ใน MonthCache และสร้างใหม่เมื่อข้อมูลเดือนนั้นเปลี่ยน
+    """
+    month_start = dt.date(ref_date.year, ref_date.month, 1)
+    key = _month_key(kind, ref_date)
+    _, _, to_ledger = MONTH_SOURCES[kind]
+
+    def build(data):
+        return to_ledger(data, month_start)
+
+    found = get_month_cache().derived(key, "ledger", build)
+    if found is None:
+        data, source_title = _load_month(kind, ref_date)
+        found = get_month_cache().derived(key, "ledger", build) or (build(data), source_title)
+    return found
+
+
+@timed("month_ledger")
+def _month_ledger(kind: str, month_start: dt.date, base_date: dt.date):
+    """Ledger ของเดือนนั้นสำหรับรายงานหลายเดือน
+
+    เดือนที่ปิดแล้วอ่านจาก AggregateStore ถ้ามี ส่วนเดือนปัจจุบันอ่านจาก Google Sheets เสมอ
+    เดือนที่ไม่มีชีตของเดือนนั้นจะ fallback ไปใช้ชีตพื้นฐานได้เฉพาะเดือนอ้างอิง (base_date) เหมือนเดิม
+    เดือนอื่นที่ไม่มีชีต (และไม่มีงานเขียนค้าง) เป็น Ledger ว่างทันที ไม่ต้องโหลดชีตพื้นฐานมาแปลงทิ้ง
+    """
+    closed = _is_closed_month(month_start)
+    is_base_month = (month_start.year, month_start.month) == (base_date.year, base_date.month)
+    if closed:
+        stored = get_aggregate_store().load_ledger(kind, month_start)
+        if stored is not None:
+            return stored
+
+    if (
+        not is_base_month
+        and not get_month_cache().has(_month_key(kind, month_start))
+        and not get_write_queue().pending(kind, month_start)
+        and not get_storage_backend().has_month(kind, month_start)
+    ):
+        if closed:
+            get_aggregate_store().save_month(kind, month_start, False, [])
+        return Ledger.empty(kind)
+
+    ledger, source_title = load_month_ledger(kind, month_start)
+    is_monthly = source_title == _get_monthly_sheet_title(SHEET_NAMES[kind], month_start)
+    if not is_monthly and not is_base_month:
+        ledger = Ledger.empty(kind)
+
+    if closed and (is_monthly or not is_base_month):
+        # ข้ามถ้ามีงานเขียนค้าง (ค่าที่ทับไว้ยังไม่อยู่ในชีต)
+        if not get_write_queue().pending(kind, month_start):
+            get_aggregate_store().save_month(kind, month_start, len(ledger.coverage[kind]) > 0, ledger.rows(kind))
+    return ledger
+
+
+def _run_in_threads(fn, items, max_workers: int = 4):
+    """เรียก fn กับทุก item พร้อมกันใน thread pool และคืนผลตามลำดับเดิม
+
+    ทุก thread ได้ ScriptRunContext ของ rerun ปัจจุบัน เพื่อให้ st.error/st.stop ทำงานได้ตามปกติ
+    และทำงานให้สาขาเดียวกับผู้เรียก (use_branch)
+    """
+    items = list(items)
+    if len(items) <= 1:
+        return [fn(item) for item in items]
+
+    ctx = get_script_run_ctx()
+    caller = contextvars.copy_context()
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, len(items)),
+        initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx),
+    ) as pool:
+        return list(pool.map(lambda item: caller.copy().run(fn, item), items))
+
+
+def _months_in_range(start_date: dt.date, end_date: dt.date):
+    """คืนค่าวันที่ 1 ของทุกเดือนที่ช่วง start_date..end_date ครอบคลุม"""
+    months = []
+    cur = dt.date(start_date.year, start_date.month, 1)
+    while cur <= end_date:
+        months.append(cur)
+        cur = dt.date(cur.year + cur.month // 12, cur.month % 12 + 1, 1)
+    return months
+
+
+@timed("prefetch_months")
+def prefetch_months(requests):
+    """เริ่มดึงทุก (kind, เดือน) ที่หน้านี้ต้องใช้พร้อมกันใน thread pool แล้วเก็บลง MonthCache
+
+    ข้ามเดือนที่อยู่ในแคชแล้ว และเดือนที่ปิดแล้วซึ่งมียอดอยู่ใน AggregateStore
+    ทำให้ตอนเปิดหน้าแบบแคชว่าง รอ Google Sheets แค่รอบเดียวแทนที่จะรอทีละชีต
+    """
+    todo = []
+    for kind, ref_date in requests:
+        month_start = dt.date(ref_date.year, ref_date.month, 1)
+        if (kind, month_start) in todo or get_month_cache().has(_month_key(kind, month_start)):
+            continue
+        if _is_closed_month(month_start) and get_aggregate_store().has_month(kind, month_start):
+            continue
+        todo.append((kind, month_start))
+    _run_in_threads(lambda r: _load_month(*r), todo)
+
 
+@timed("load_range_index")
+def load_range_index(start_date: dt.date, end_date: dt.date, base_date: dt.date, branches=None):
+    """PrefixSumIndex ของรายรับและรายจ่ายทุกเดือนที่ช่วงวันที่ครอบคลุม (ทั้งเดือน) รวมทุกสาขาใน branches
 
-def get_worksheet_for_month(base_name: str, ref_date: dt.date, kind: str, create_if_missing: bool):
+    branches=None คือสาขาปัจจุบัน ถ้าให้หลายสาขาจะได้ยอดรวม (ยอดของวัน/ประเภทเดียวกันถูกบวกกัน)
+    แต่ละเดือนของแต่ละสาขาโหลด (และแคช) แยกกัน โดยโหลดทุกเดือนของทุก kind ทุกสาขาพร้อมกันใน thread pool
+    ขนาด pool เพิ่มตามจำนวนสาขา การเพิ่มสาขาจึงไม่ทำให้รอนานขึ้นเป็นเท่าตัว
+    index รายเดือนสร้างครั้งเดียวต่อข้อมูลหนึ่งชุด ส่วน index ที่รวมหลายเดือนแล้วแคชไว้ใน RangeIndexCache
+    การเปลี่ยนช่วงวันที่ภายในเดือนเดิมจึงเหลือแค่การลบผลรวมสะสม
     """
-    คืนค่า worksheet ของเดือนที่ต้องการ
+    branches = branches or [current_branch()]
+    months = _months_in_range(start_date, end_date)
+    # สลับสาขากันในลำดับงาน ให้ทุกสาขาได้เริ่มเปิดไฟล์/โหลดพร้อมกันตั้งแต่งานแรกๆ ของ pool
+    jobs = [
+        (branch, kind, month_start) for month_start in months for kind in ("income", "expense") for branch in branches
+    ]
 
-    - ถ้า create_if_missing=False:
-        ถ้าไม่พบชีตตามเดือน จะ fallback ไปใช้ชีตพื้นฐาน (base_name)
-    - ถ้า create_if_missing=True:
-        ถ้าไม่พบ จะสร้างชีตใหม่โดยใช้ชีตพื้นฐานเป็น template ถ้ามี
+    def load(job):
+        branch, kind, month_start = job
+        with use_branch(branch):
+            return _month_ledger(kind, month_start, base_date)
 
-    kind: "income" หรือ "expense" เพื่อกำหนด header เริ่มต้นเมื่อไม่มี template
-    """
-    sh = get_workbook()
-    monthly_title = _get_monthly_sheet_title(base_name, ref_date)
+    ledgers = _run_in_threads(load, jobs, max_workers=min(4 * len(branches), SHEETS_HTTP_POOL_SIZE))
+    return get_range_index_cache().get([ledger.prefix_index() for ledger in ledgers])
 
-    # ลองหาชีตตามเดือนก่อน
-    try:
-        return sh.worksheet(monthly_title)
-    except WorksheetNotFound:
-        pass
 
-    # ถ้าไม่ต้องสร้างใหม่ ให้ fallback ไปใช้ชีตพื้นฐาน (ถ้ามี)
-    if not create_if_missing:
-        try:
-            return sh.worksheet(base_name)
-        except WorksheetNotFound:
-            st.error(f"ไม่พบชีต '{monthly_title}' หรือชีตพื้นฐาน '{base_name}' ในไฟล์ Google Sheets")
-            st.stop()
+# ------------------------------
+# WRITE-AHEAD QUEUE (บันทึกลงเครื่องก่อน แล้วค่อยซิงก์ไป Google Sheets)
+# ------------------------------
+class WriteQueue:
+    """คิวงานเขียน (write-ahead log) ในไฟล์ SQLite บนเครื่อง
 
-    # ต้องการสร้างใหม่: พยายามใช้ชีตพื้นฐานเป็น template
-    template_data = []
-    try:
-        template_ws = sh.worksheet(base_name)
-        template_data = template_ws.get_all_values()
-    except WorksheetNotFound:
-        template_ws = None  # noqa: F841
+    ทุกการบันทึกจะถูกเก็บเป็นแถวละหนึ่งช่อง (kind, ปี, เดือน, วัน, target, ค่า)
+    target คือชื่อช่องทางรายรับ หรือชื่อรายการรายจ่าย
+    แถวที่ส่งไม่ได้เพราะหาแถว/คอลัมน์ในชีตไม่เจอ หรือส่งไม่สำเร็จครบ max_attempts ครั้ง
+    จะถูกตั้งสถานะเป็น failed และไม่ส่งซ้ำอัตโนมัติ จนกว่าผู้ใช้จะสั่งส่งใหม่หรือลบทิ้ง
+    """
 
-    if template_data:
-        header_row = template_data[0]
-        num_cols = len(header_row)
-        new_data = [header_row]
+    def __init__(self, path: Path, max_attempts: int = 8):
+        self.path = Path(path)
+        self.max_attempts = max_attempts
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.last_synced_at = None
+        self.last_error = None
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS pending ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " kind TEXT, year INTEGER, month INTEGER, day INTEGER, target TEXT, value REAL,"
+                " created_at TEXT, status TEXT DEFAULT 'pending', attempts INTEGER DEFAULT 0, last_error TEXT)"
+            )
 
-        # คัดลอกเฉพาะชื่อแถว/วันที่ในคอลัมน์แรก ค่าอื่นให้เคลียร์ว่าง
-        for row in template_data[1:]:
-            first_col = row[0] if row else ""
-            new_row = [first_col] + [""] * (num_cols - 1)
-            new_data.append(new_row)
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def append(self, kind: str, month_start: dt.date, cells):
+        """เพิ่มงานเขียนลงคิว cells: list ของ (วัน, target, ค่า)"""
+        now = dt.datetime.now().isoformat(timespec="seconds")
+        with self._connect() as con:
+            con.executemany(
+                "INSERT INTO pending (kind, year, month, day, target, value, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (kind, month_start.year, month_start.month, int(day), str(target), float(value), now)
+                    for day, target, value in cells
+                ],
+            )
 
-        rows = len(new_data) + 5
-        cols = num_cols + 5
-        ws = sh.add_worksheet(title=monthly_title, rows=rows, cols=cols)
-        ws.update("A1", new_data)
-        return ws
+    def pending(self, kind: str = None, month_start: dt.date = None):
+        """คืนค่างานที่ยังไม่ได้ส่ง เรียงตามลำดับที่บันทึก: list ของ (id, kind, ปี, เดือน, วัน, target, ค่า)"""
+        sql = "SELECT id, kind, year, month, day, target, value FROM pending WHERE status='pending'"
+        params = []
+        if kind is not None:
+            sql += " AND kind=? AND year=? AND month=?"
+            params = [kind, month_start.year, month_start.month]
+        with self._connect() as con:
+            return con.execute(sql + " ORDER BY id", params).fetchall()
+
+    def mark_done(self, ids):
+        with self._connect() as con:
+            con.executemany("DELETE FROM pending WHERE id=?", [(i,) for i in ids])
+        self.last_synced_at = dt.datetime.now()
+        self.last_error = None
+
+    def mark_retry(self, ids, error: str):
+        with self._connect() as con:
+            con.executemany(
+                "UPDATE pending SET attempts = attempts + 1, last_error=?,"
+                " status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE status END WHERE id=?",
+                [(error, self.max_attempts, i) for i in ids],
+            )
+        self.last_error = error
 
-    # กรณีไม่มี template เลย สร้างโครงพื้นฐานใหม่
-    if kind == "income":
-        header = ["วันที่", "เงินสด", "สแกน", "คนละครึ่ง", "Grab", "Shopee", "LINE Man"]
-        rows = 32
-        cols = len(header)
-        ws = sh.add_worksheet(title=monthly_title, rows=rows, cols=cols)
-        ws.update("A1", [header])
-        # ใส่วันที่ 1-31 ในคอลัมน์แรก
-        date_values = [[str(i)] for i in range(1, 32)]
-        ws.update("A2", date_values)
-        return ws
-    else:
-        header = ["รายการรายจ่าย/วันที่"] + [str(i) for i in range(1, 32)]
-        rows = 50
-        cols = len(header)
-        ws = sh.add_worksheet(title=monthly_title, rows=rows, cols=cols)
-        ws.update("A1", [header])
-        return ws
+    def mark_failed(self, ids, error: str):
+        with self._connect() as con:
+            con.executemany(
+                "UPDATE pending SET status='failed', last_error=? WHERE id=?",
+                [(error, i) for i in ids],
+            )
 
+    def retry_failed(self):
+        """ให้แถวที่ failed กลับไปรอส่งใหม่ (นับจำนวนครั้งใหม่)"""
+        with self._connect() as con:
+            con.execute("UPDATE pending SET status='pending', attempts=0 WHERE status='failed'")
+
+    def dismiss_failed(self):
+        """ลบแถวที่ failed ทิ้ง คืนค่า list ของ (kind, วันที่ 1 ของเดือน) ที่มีแถวถูกลบ"""
+        with self._connect() as con:
+            months = con.execute("SELECT DISTINCT kind, year, month FROM pending WHERE status='failed'").fetchall()
+            con.execute("DELETE FROM pending WHERE status='failed'")
+        return [(kind, dt.date(year, month, 1)) for kind, year, month in months]
+
+    def status(self):
+        with self._connect() as con:
+            counts = dict(con.execute("SELECT status, COUNT(*) FROM pending GROUP BY status").fetchall())
+            failed = con.execute(
+                "SELECT kind, year, month, day, target, last_error FROM pending WHERE status='failed' ORDER BY id"
+            ).fetchall()
+        return {
+            "pending": counts.get("pending", 0),
+            "failed": failed,
+            "last_synced_at": self.last_synced_at,
+            "last_error": self.last_error,
+        }
+
+
+class WriteFlusher:
+    """thread เบื้องหลังที่รวบงานในคิวแล้วส่งไปที่เก็บข้อมูล (StorageBackend) ทีละเดือน
+    สำหรับ Google Sheets คือ batch_update ครั้งเดียวต่อเดือน
+
+    ถ้าช่องเดียวกันถูกบันทึกหลายครั้ง จะส่งเฉพาะค่าล่าสุด
+    ถ้าส่งไม่สำเร็จ (เช่น 429 จาก quota หรือเน็ตหลุด) จะรอแบบ exponential backoff + jitter แล้วลองใหม่
+    """
 
-# ------------------------------
-# LOAD DATA (ตามเดือน)
-# ------------------------------
-@st.cache_data(ttl=60)
-def load_income_df(ref_date: dt.date):
-    ws = get_worksheet_for_month(INCOME_SHEET_NAME, ref_date, kind="income", create_if_missing=False)
-    df = ws_to_df(ws)
-    if df.empty:
-        return df
+    def __init__(self, queue: WriteQueue, branch: Branch, interval: float = 2.0, max_backoff: float = 60.0):
+        self.queue = queue
+        self.branch = branch
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._wake = threading.Event()
+        self._failures = 0
+        self._thread = threading.Thread(target=self._run, name="whale-write-flusher", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            delay = self.interval
+            if self._failures:
+                delay = min(self.max_backoff, 2 ** self._failures) * random.uniform(0.5, 1.5)
+            self._wake.wait(timeout=delay)
+            self._wake.clear()
+            try:
+                with use_branch(self.branch):
+                    self.flush_once()
+                self._failures = 0
+            except Exception:
+                self._failures += 1
+
+    def flush_once(self):
+        groups = {}
+        for row_id, kind, year, month, day, target, value in self.queue.pending():
+            groups.setdefault((kind, dt.date(year, month, 1)), []).append((row_id, day, target, value))
+
+        for (kind, month_start), rows in groups.items():
+            # รวบช่องที่ซ้ำกัน ใช้ค่าล่าสุด แต่ลบทุก id ออกจากคิวเมื่อส่งสำเร็จ
+            latest = {}
+            ids_by_cell = {}
+            for row_id, day, target, value in rows:
+                latest[(day, target)] = value
+                ids_by_cell.setdefault((day, target), []).append(row_id)
+            all_ids = [row_id for row_id, _, _, _ in rows]
 
-    if "วันที่" not in df.columns:
-        df = df.rename(columns={df.columns[0]: "วันที่"})
+            try:
+                missing = get_storage_backend().write_cells(
+                    kind, month_start, [(day, target, value) for (day, target), value in latest.items()]
+                )
+            except Exception as e:
+                self.queue.mark_retry(all_ids, str(e))
+                raise
+            if _is_closed_month(month_start):
+                get_month_archive().invalidate(kind, month_start)
 
-    df["วันที่"] = pd.to_numeric(df["วันที่"], errors="coerce")
-    df = df[df["วันที่"].notna()]
-    df["วันที่"] = df["วันที่"].astype(int)
+            failed_ids = [i for cell in missing for i in ids_by_cell[cell]]
+            if failed_ids:
+                self.queue.mark_failed(failed_ids, "ไม่พบแถวหรือคอลัมน์นี้ในชีต")
+            self.queue.mark_done([i for i in all_ids if i not in failed_ids])
 
-    income_cols = ["เงินสด", "สแกน", "คนละครึ่ง", "Grab", "Shopee", "LINE Man"]
-    for c in income_cols:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce").fillna(0.0)
-        else:
-            df[c] = 0.0
 
-    df["รวมต่อวัน"] = df[income_cols].sum(axis=1)
-    return df
+@st.cache_resource
+def _write_queue(branch_key: str):
+    path = st.secrets.get("write_queue_path", LOCAL_CACHE_DIR / "write_queue.sqlite3")
+    return WriteQueue(get_branch(branch_key).local_path(path))
 
 
-@st.cache_data(ttl=60)
-def load_expense_df(ref_date: dt.date):
-    ws = get_worksheet_for_month(EXPENSE_SHEET_NAME, ref_date, kind="expense", create_if_missing=False)
-    df = ws_to_df(ws)
-    if df.empty:
-        return df
+def get_write_queue():
+    return _write_queue(current_branch().key)
+
 
-    if "รายการรายจ่าย/วันที่" not in df.columns:
-        df = df.rename(columns={df.columns[0]: "รายการรายจ่าย/วันที่"})
+@st.cache_resource
+def _write_flusher(branch_key: str):
+    return WriteFlusher(_write_queue(branch_key), get_branch(branch_key))
 
-    if "รายการรายจ่าย/วันที่" in df.columns:
-        df = df[df["รายการรายจ่าย/วันที่"] != "รวมทั้งเดือน"].copy()
 
-    for col in df.columns:
-        if str(col).strip().isdigit():
-            df[col] = pd.to_numeric(df[col], errors="coerce").fillna(0.0)
-    return df
+def get_write_flusher():
+    return _write_flusher(current_branch().key)
 
 
 # ------------------------------
 # UPDATE FUNCTIONS
 # ------------------------------
-def update_income_row(date_obj: dt.date, cash, scan, half, grab, shopee, lineman):
-    """อัปเดตรายรับของวันที่ในเดือนที่ระบุ ถ้าไม่มีชีตของเดือนนั้นจะสร้างใหม่ให้"""
-    ws = get_worksheet_for_month(INCOME_SHEET_NAME, date_obj, kind="income", create_if_missing=True)
-    data = ws.get_all_values()
-    if not data:
-        st.error("ชีต 'รายรับ' ยังไม่มีโครงสร้างตาราง")
-        return
+def _apply_cells(kind: str, df, cells):
+    """เขียน cells (วัน, target, ค่า) ลงข้อมูลของเดือนในที่ (DataFrame รายรับ หรือ ExpenseMatrix รายจ่าย)
+    คืนค่า False ถ้าหาแถว/คอลัมน์ไม่เจอ
+    """
+    if df.empty:
+        return False
+    if kind == "income":
+        for day, col, val in cells:
+            mask = df["วันที่"] == day
+            if col not in df.columns or not mask.any():
+                return False
+            df.loc[mask, col] = val
+        df["รวมต่อวัน"] = df[INCOME_COLUMNS].sum(axis=1)
+    else:
+        for day, item_name, val in cells:
+            if not df.set_value(item_name, day, val):
+                return False
+    return True
 
-    header = [str(h).strip() for h in data[0]]
-    try:
-        col_day = header.index("วันที่") + 1
-    except ValueError:
-        col_day = 1
 
-    def col_idx(name):
-        return header.index(name) + 1 if name in header else None
+def _read_header_and_column(ws, col: int = 1):
+    """อ่านเฉพาะแถวหัวตาราง และค่าทั้งคอลัมน์ที่ระบุ (เริ่มนับที่ 1)
 
-    day = date_obj.day
-    target_row = None
-    for i in range(1, len(data)):
-        v = data[i][col_day - 1]
-        try:
-            d = int(float(v))
-            if d == day:
-                target_row = i + 1
-                break
-        except Exception:
+    ถ้าเป็นคอลัมน์แรก จะอ่านทั้งสองส่วนใน batch_get ครั้งเดียว
+    คืนค่า (header, column_values) โดย column_values[0] คือค่าในแถวหัวตาราง
+    """
+    if col == 1:
+        header_vals, col_vals = ws.batch_get(["1:1", "A:A"])
+        header = header_vals[0] if header_vals else []
+        column = [r[0] if r else "" for r in col_vals]
+    else:
+        header = ws.row_values(1)
+        column = ws.col_values(col)
+    return [str(h).strip() for h in header], column
+
+
+def _locate_cells(kind: str, header, first_col, cells):
+    """หาตำแหน่ง (แถว, คอลัมน์) ของแต่ละ cell (วัน, target, ค่า) จากหัวตารางและคอลัมน์แรกของชีต
+
+    first_col คือคอลัมน์วันที่ (รายรับ) หรือคอลัมน์ชื่อรายการ (รายจ่าย) รวมแถวหัวตาราง
+    คืนค่า (list ของ (แถว, คอลัมน์, ค่า), list ของ (วัน, target) ที่หาตำแหน่งไม่เจอ)
+    """
+    rows = {}
+    if kind == "income":
+        for i in range(1, len(first_col)):
+            try:
+                rows.setdefault(int(float(first_col[i])), i + 1)
+            except Exception:
+                continue
+    else:
+        # ถ้ามีชื่อรายการซ้ำ ใช้แถวแรกที่เจอเหมือนเดิม
+        for i in range(1, len(first_col)):
+            rows.setdefault(first_col[i], i + 1)
+
+    data = []
+    missing = []
+    for day, target, value in cells:
+        row_key, col_name = (day, target) if kind == "income" else (target, str(day))
+        if row_key not in rows or col_name not in header:
+            missing.append((day, target))
             continue
+        data.append((rows[row_key], header.index(col_name) + 1, value))
+    return data, missing
 
-    if target_row is None:
-        st.error("ไม่พบแถวของวันที่นี้ในชีต 'รายรับ'")
-        return
-
-    updates = {
-        "เงินสด": cash,
-        "สแกน": scan,
-        "คนละครึ่ง": half,
-        "Grab": grab,
-        "Shopee": shopee,
-        "LINE Man": lineman,
-    }
-    for name, val in updates.items():
-        c = col_idx(name)
-        if c:
-            ws.update_cell(target_row, c, float(val) if val is not None else 0)
 
-    st.cache_data.clear()
+def _enqueue_cells(kind: str, date_obj: dt.date, cells):
+    """ลงคิวงานเขียน แก้แคชของเดือนนั้นด้วยค่าใหม่ทันที แล้วปลุกตัวซิงก์เบื้องหลัง"""
+    get_write_queue().append(kind, date_obj, cells)
+    monthly_title = _get_monthly_sheet_title(SHEET_NAMES[kind], date_obj)
+    get_month_cache().patch(_month_key(kind, date_obj), monthly_title, lambda df: _apply_cells(kind, df, cells))
+    if _is_closed_month(date_obj):
+        get_aggregate_store().invalidate(kind, date_obj)
+        get_month_archive().invalidate(kind, date_obj)
+    get_write_flusher().wake()
 
 
-def update_expense_cell(date_obj: dt.date, day, item_name, amount):
-    """อัปเดตรายจ่ายของวันที่ในเดือนที่ระบุ ถ้าไม่มีชีตของเดือนนั้นจะสร้างใหม่ให้"""
-    ws = get_worksheet_for_month(EXPENSE_SHEET_NAME, date_obj, kind="expense", create_if_missing=True)
-    data = ws.get_all_values()
-    if not data:
-        st.error("ชีต 'รายจ่าย' ยังไม่มีโครงสร้างตาราง")
-        return
+def update_income_row(date_obj: dt.date, cash, scan, half, grab, shopee, lineman):
+    """บันทึกรายรับของวันที่ในเดือนที่ระบุลงคิวในเครื่อง แล้วคืนค่าทันที
 
-    header = [str(h).strip() for h in data[0]]
-    try:
-        col_day = header.index(str(day)) + 1
-    except ValueError:
-        st.error(f"ไม่พบคอลัมน์วันที่ {day} ในชีต 'รายจ่าย'")
-        return
+    ตัวซิงก์เบื้องหลังจะเขียนทุกช่องทางของวันนั้นลงชีตของเดือนใน batch_update ครั้งเดียว
+    (ถ้าไม่มีชีตของเดือนนั้นจะสร้างใหม่ให้)
+    คืนค่า dict {ชื่อคอลัมน์: ค่าที่บันทึก} เพื่อให้ผู้เรียกไม่ต้องอ่านชีตซ้ำ
+    """
+    values = [cash, scan, half, grab, shopee, lineman]
+    written = {name: float(val) if val is not None else 0.0 for name, val in zip(INCOME_COLUMNS, values)}
+    _enqueue_cells("income", date_obj, [(date_obj.day, name, val) for name, val in written.items()])
+    return written
 
-    target_row = None
-    for i in range(1, len(data)):
-        if data[i][0] == item_name:
-            target_row = i + 1
-            break
 
-    if target_row is None:
-        st.error("ไม่พบชื่อรายการรายจ่ายในชีต 'รายจ่าย'")
-        return
+def update_expense_cells(date_obj: dt.date, entries):
+    """บันทึกรายจ่ายหลายรายการของเดือนที่ระบุลงคิวในเครื่อง แล้วคืนค่าทันที
 
-    ws.update_cell(target_row, col_day, float(amount) if amount is not None else 0)
-    st.cache_data.clear()
+    ตัวซิงก์เบื้องหลังจะเขียนทุกรายการของเดือนนั้นใน batch_update ครั้งเดียว
+    entries: list ของ (ชื่อรายการ, วันที่, จำนวนเงิน)
+    คืนค่า list ของ (ชื่อรายการ, วันที่, ค่าที่บันทึก)
+    """
+    written = [
+        (item_name, day, float(amount) if amount is not None else 0.0)
+        for item_name, day, amount in entries
+    ]
+    if written:
+        _enqueue_cells("expense", date_obj, [(day, item_name, val) for item_name, day, val in written])
+    return written
 
 
 # ------------------------------
 # SUMMARY & CHART
 # ------------------------------
-def build_daily_summary(base_date: dt.date):
-    inc = load_income_df(base_date)
-    exp = load_expense_df(base_date)
-
-    if inc.empty:
-        inc_daily = pd.DataFrame(columns=["วันที่", "รวมรับ"])
-    else:
-        inc_daily = inc[["วันที่", "รวมต่อวัน"]].rename(columns={"รวมต่อวัน": "รวมรับ"})
-
-    if exp.empty:
-        exp_daily = pd.DataFrame(columns=["วันที่", "รวมจ่าย"])
-    else:
-        day_cols = [c for c in exp.columns if str(c).strip().isdigit()]
-        tmp = exp[day_cols].sum(axis=0)
-        exp_daily = tmp.reset_index().rename(columns={"index": "วันที่", 0: "รวมจ่าย"})
-        exp_daily["วันที่"] = exp_daily["วันที่"].astype(int)
-
-    df = pd.merge(inc_daily, exp_daily, on="วันที่", how="outer").fillna(0.0)
-    df["รวมรับ"] = df["รวมรับ"].astype(float)
-    df["รวมจ่าย"] = df["รวมจ่าย"].astype(float)
+@timed("build_daily_summary")
+def build_daily_summary(start_date: dt.date, end_date: dt.date, base_date: dt.date, branches=None):
+    """สรุปรายรับ/รายจ่ายรายวันของทุกเดือนที่ช่วงวันที่ครอบคลุม (เรียงตามวันที่) รวมทุกสาขาใน branches"""
+    index = load_range_index(start_date, end_date, base_date, branches)
+    if len(index.days) == 0:
+        return pd.DataFrame(columns=["วันที่", "รวมรับ", "รวมจ่าย", "กำไรสุทธิ", "วันที่จริง"])
+
+    days = pd.DatetimeIndex(index.days)
+    df = pd.DataFrame({
+        "วันที่": days.day,
+        "รวมรับ": index.daily_totals("income"),
+        "รวมจ่าย": index.daily_totals("expense"),
+    })
     df["กำไรสุทธิ"] = df["รวมรับ"] - df["รวมจ่าย"]
-
-    y, mth = base_date.year, base_date.month
-    df["วันที่จริง"] = df["วันที่"].apply(lambda d: dt.date(y, mth, int(d)))
-    df = df.sort_values("วันที่จริง")
+    df["วันที่จริง"] = days.date
     return df
 
 
-def build_expense_pie(start_date: dt.date, end_date: dt.date, base_date: dt.date):
+@timed("build_expense_pie")
+def build_expense_pie(start_date: dt.date, end_date: dt.date, base_date: dt.date, branches=None):
     """สร้างข้อมูลสำหรับกราฟวงกลม รายจ่ายตามประเภท ในช่วงวันที่ที่เลือก
 
     เพิ่มคอลัมน์เปอร์เซ็นต์ และป้ายแสดง (เช่น ค่าเช่าร้าน 55.0%) สำหรับใช้ใน legend
     """
-    exp = load_expense_df(base_date)
-    if exp.empty:
-        return pd.DataFrame(columns=["รายการ", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
-
-    y, mth = base_date.year, base_date.month
-    cur = start_date
-    days: list[str] = []
-    while cur <= end_date:
-        if cur.year == y and cur.month == mth:
-            days.append(str(cur.day))
-        cur += dt.timedelta(days=1)
-
-    day_cols = [d for d in days if d in exp.columns]
-    if not day_cols:
-        return pd.DataFrame(columns=["รายการ", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
-
-    exp["ยอดรวม"] = exp[day_cols].sum(axis=1)
-    df = exp[["รายการรายจ่าย/วันที่", "ยอดรวม"]].copy()
+    index = load_range_index(start_date, end_date, base_date, branches)
+    totals = index.category_totals("expense", start_date, end_date)
+    df = totals.rename("ยอดรวม").rename_axis("รายการ").reset_index()
     df = df[df["ยอดรวม"] > 0]
-    df = df.rename(columns={"รายการรายจ่าย/วันที่": "รายการ"})
+    if df.empty:
+        return pd.DataFrame(columns=["รายการ", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
 
     total_all = float(df["ยอดรวม"].sum()) if not df.empty else 0.0
     if total_all > 0:
@@ -359,44 +2624,21 @@ def build_expense_pie(start_date: dt.date, end_date: dt.date, base_date: dt.date
     return df
 
 
-def build_income_pie(start_date: dt.date, end_date: dt.date, base_date: dt.date):
+@timed("build_income_pie")
+def build_income_pie(start_date: dt.date, end_date: dt.date, base_date: dt.date, branches=None):
     """สร้างข้อมูลสำหรับกราฟวงกลม รายรับตามประเภท ในช่วงวันที่ที่เลือก
 
     เพิ่มคอลัมน์เปอร์เซ็นต์ และป้ายแสดง (เช่น Grab 64.3%) สำหรับใช้ใน legend
     """
-    inc = load_income_df(base_date)
-    if inc.empty:
-        return pd.DataFrame(columns=["ประเภท", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
-
-    y, mth = base_date.year, base_date.month
-    cur = start_date
-    days: list[int] = []
-    while cur <= end_date:
-        if cur.year == y and cur.month == mth:
-            days.append(cur.day)
-        cur += dt.timedelta(days=1)
-
-    if not days:
-        return pd.DataFrame(columns=["ประเภท", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
-
-    inc_sel = inc[inc["วันที่"].isin(days)].copy()
-    if inc_sel.empty:
-        return pd.DataFrame(columns=["ประเภท", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
-
-    income_cols = ["เงินสด", "สแกน", "คนละครึ่ง", "Grab", "Shopee", "LINE Man"]
-    rows = []
-    for col in income_cols:
-        if col in inc_sel.columns:
-            total_val = float(pd.to_numeric(inc_sel[col], errors="coerce").sum())
-        else:
-            total_val = 0.0
-        if total_val > 0:
-            rows.append({"ประเภท": col, "ยอดรวม": total_val})
-
-    if not rows:
+    index = load_range_index(start_date, end_date, base_date, branches)
+    totals = index.category_totals("income", start_date, end_date)
+    # เรียงตามลำดับช่องทางรายรับเดิม
+    totals = totals.reindex(INCOME_COLUMNS, fill_value=0.0)
+    df = totals.rename("ยอดรวม").rename_axis("ประเภท").reset_index()
+    df = df[df["ยอดรวม"] > 0].reset_index(drop=True)
+    if df.empty:
         return pd.DataFrame(columns=["ประเภท", "ยอดรวม", "เปอร์เซ็นต์", "ป้ายแสดง"])
 
-    df = pd.DataFrame(rows)
     total_all = float(df["ยอดรวม"].sum()) if not df.empty else 0.0
     if total_all > 0:
         df["เปอร์เซ็นต์"] = df["ยอดรวม"] / total_all * 100.0
@@ -406,14 +2648,37 @@ def build_income_pie(start_date: dt.date, end_date: dt.date, base_date: dt.date)
     return df
 
 
-def filter_by_mode(df_daily, mode: str, base_date: dt.date):
-    if df_daily.empty:
-        return df_daily, base_date, base_date
+@timed("build_branch_totals")
+def build_branch_totals(start_date: dt.date, end_date: dt.date, base_date: dt.date, branches):
+    """ยอดรวมรายรับ/รายจ่าย/กำไรของแต่ละสาขาในช่วงวันที่ (ใช้ข้อมูลรายเดือนชุดเดียวกับยอดรวมทุกสาขา)"""
+    rows = []
+    for branch in branches:
+        index = load_range_index(start_date, max(start_date, end_date), base_date, [branch])
+        income = index.total("income", start_date, end_date)
+        expense = index.total("expense", start_date, end_date)
+        rows.append((branch.name, income, expense, income - expense))
+    return pd.DataFrame(rows, columns=["สาขา", "รวมรับ", "รวมจ่าย", "กำไรสุทธิ"])
+
+
+def refresh_closed_months(start_date: dt.date, end_date: dt.date, branches):
+    """ล้างยอดและตารางที่เก็บไว้ของเดือนในช่วงนี้ของทุกสาขาใน branches รอบถัดไปจะโหลดจากชีตใหม่
+
+    ใช้หลังมีคนแก้ชีตของเดือนที่ปิดแล้วโดยตรง (แอปไม่รู้เองเพราะถือว่าเดือนเก่าไม่เปลี่ยน)
+    """
+    for branch in branches:
+        with use_branch(branch):
+            get_aggregate_store().invalidate_range(start_date, end_date)
+            get_month_archive().invalidate_range(start_date, end_date)
+            for month_start in _months_in_range(start_date, end_date):
+                for kind in SHEET_NAMES:
+                    get_month_cache().invalidate(_month_key(kind, month_start))
 
+
+def select_range_by_mode(mode: str, base_date: dt.date):
+    """แสดงตัวเลือกวันที่ตามรูปแบบสรุป แล้วคืนค่า (start, end) ซึ่งอาจคร่อมหลายเดือนได้"""
     if mode == "รายวัน":
         target = st.date_input("เลือกวัน", value=base_date, key="sum_daily")
-        mask = df_daily["วันที่จริง"] == target
-        return df_daily[mask], target, target
+        return target, target
 
     elif mode == "รายสัปดาห์":
         # ใช้สัปดาห์รูปแบบ พฤหัสบดี -> อังคาร
@@ -422,18 +2687,23 @@ def filter_by_mode(df_daily, mode: str, base_date: dt.date):
         offset = (ref.weekday() - 3) % 7
         start = ref - dt.timedelta(days=offset)
         end = start + dt.timedelta(days=5)  # พฤหัสบดีถึงอังคาร รวม 6 วัน
-        mask = (df_daily["วันที่จริง"] >= start) & (df_daily["วันที่จริง"] <= end)
-        return df_daily[mask], start, end
+        return start, end
 
     elif mode == "รายเดือน":
         y, mth = base_date.year, base_date.month
         start = dt.date(y, mth, 1)
-        if mth == 12:
-            end = dt.date(y, 12, 31)
-        else:
-            end = dt.date(y, mth + 1, 1) - dt.timedelta(days=1)
-        mask = (df_daily["วันที่จริง"] >= start) & (df_daily["วันที่จริง"] <= end)
-        return df_daily[mask], start, end
+        end = dt.date(y, mth, calendar.monthrange(y, mth)[1])
+        return start, end
+
+    elif mode == "รายไตรมาส":
+        y = base_date.year
+        first_month = (base_date.month - 1) // 3 * 3 + 1
+        start = dt.date(y, first_month, 1)
+        end = dt.date(y, first_month + 2, calendar.monthrange(y, first_month + 2)[1])
+        return start, end
+
+    elif mode == "รายปี":
+        return dt.date(base_date.year, 1, 1), dt.date(base_date.year, 12, 31)
 
     else:
         c1, c2 = st.columns(2)
@@ -443,394 +2713,582 @@ def filter_by_mode(df_daily, mode: str, base_date: dt.date):
             end = st.date_input("วันที่สิ้นสุด", value=base_date, key="sum_range_end")
         if end < start:
             st.warning("วันที่สิ้นสุดต้องไม่น้อยกว่าวันที่เริ่มต้น")
-            return df_daily.iloc[0:0], start, end
-        mask = (df_daily["วันที่จริง"] >= start) & (df_daily["วันที่จริง"] <= end)
-        return df_daily[mask], start, end
+        return start, end
+
+
+def build_monthly_trend(df_daily):
+    """รวมยอดรายวันเป็นรายเดือน สำหรับกราฟแนวโน้มรายไตรมาส/รายปี"""
+    if df_daily.empty:
+        return pd.DataFrame(columns=["เดือน", "รวมรับ", "รวมจ่าย", "กำไรสุทธิ"])
+    month_labels = [d.strftime("%Y-%m") for d in df_daily["วันที่จริง"]]
+    df = df_daily.groupby(month_labels)[["รวมรับ", "รวมจ่าย", "กำไรสุทธิ"]].sum()
+    return df.rename_axis("เดือน").reset_index()
+
+
+REPORT_WEEKDAY_COLORS = {
+    0: "#FFFFCC",  # จันทร์ เหลืองอ่อน
+    1: "#FF99CC",  # อังคาร ชมพูอ่อน
+    2: "#66FF66",  # พุธ เขียวอ่อน
+    3: "#FF6633",  # พฤหัสฯ ส้มอ่อน
+    4: "#99FFFF",  # ศุกร์ ฟ้าอ่อน
+    5: "#CC99FF",  # เสาร์ ม่วงอ่อน
+    6: "#FF3333",  # อาทิตย์ แดงอ่อน
+}
+
+
+def _report_table_rows(filtered):
+    """สร้างแถว <tr> ของตารางรายงาน โดยคำนวณสีตามวันในสัปดาห์ กำไร และตัวเลขที่จัดรูปแบบแล้วทีละคอลัมน์
+    แล้วต่อทุกแถวเป็นสตริงเดียวด้วย join ครั้งเดียว
+    """
+    label_col = "วันที่แสดง" if "วันที่แสดง" in filtered.columns else "วันที่"
+    labels = filtered[label_col].fillna("").astype(str)
+    weekday = pd.to_datetime(filtered["วันที่จริง"], errors="coerce").dt.weekday
+    colors = weekday.map(REPORT_WEEKDAY_COLORS).fillna("#FFFFFF")
+    inc = pd.to_numeric(filtered["รวมรับ"], errors="coerce").fillna(0.0)
+    exp = pd.to_numeric(filtered["รวมจ่าย"], errors="coerce").fillna(0.0)
+    fmt = "{:,.2f}".format
+
+    rows = (
+        "<tr style='background-color:" + colors + ";'>"
+        + "<td>" + labels + "</td>"
+        + "<td style='text-align:right;'>" + inc.map(fmt) + "</td>"
+        + "<td style='text-align:right;'>" + exp.map(fmt) + "</td>"
+        + "<td style='text-align:right;'>" + (inc - exp).map(fmt) + "</td>"
+        + "</tr>"
+    )
+    return "".join(rows)
+
+
+def build_report_html(filtered, start_date: dt.date, end_date: dt.date):
+    """สร้างรายงานสรุปรายรับ-รายจ่ายในรูปแบบ HTML สำหรับพรีวิวและสั่งพิมพ์"""
+    total_income = float(filtered["รวมรับ"].sum())
+    total_expense = float(filtered["รวมจ่าย"].sum())
+    profit = total_income - total_expense
+
+    period_text = start_date.strftime("%d/%m/%Y")
+    if end_date != start_date:
+        period_text = f"{start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}"
+
+    parts, _ = get_report_template()
+    return render_template(
+        parts,
+        period_text=period_text,
+        total_income=f"{total_income:,.2f}",
+        total_expense=f"{total_expense:,.2f}",
+        profit=f"{profit:,.2f}",
+        table_rows=_report_table_rows(filtered),
+    )
+
+
+def _report_data_version(filtered) -> int:
+    """เวอร์ชันของข้อมูลในรายงาน (hash ของวันที่และยอดทุกแถว) เปลี่ยนทันทีเมื่อยอดใดยอดหนึ่งเปลี่ยน"""
+    return int(pd.util.hash_pandas_object(filtered[["วันที่จริง", "รวมรับ", "รวมจ่าย"]], index=False).sum())
+
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def _cached_report_html(start_date: dt.date, end_date: dt.date, data_version: int, template_version, _filtered):
+    # _filtered ไม่ถูกนำไป hash เป็น key ของแคช ใช้ data_version แทน
+    return build_report_html(_filtered, start_date, end_date)
+
+
+def render_report_html(filtered, start_date: dt.date, end_date: dt.date):
+    """รายงาน HTML ของช่วงวันที่นี้ ใช้ผลที่แคชไว้ถ้าช่วงวันที่ ข้อมูล และ template (โลโก้) ยังเหมือนเดิม"""
+    _, template_version = get_report_template()
+    return _cached_report_html(start_date, end_date, _report_data_version(filtered), template_version, filtered)
+
+
+def write_queue_status(branches):
+    """รวม WriteQueue.status() ของหลายสาขา แถวที่ส่งไม่สำเร็จมีชื่อสาขานำหน้า"""
+    parts = []
+    for branch in branches:
+        with use_branch(branch):
+            parts.append((branch, get_write_queue().status()))
+    return {
+        "pending": sum(part["pending"] for _, part in parts),
+        "failed": [(branch.name,) + tuple(row) for branch, part in parts for row in part["failed"]],
+        "last_synced_at": max((part["last_synced_at"] for _, part in parts if part["last_synced_at"]), default=None),
+        "last_error": next((part["last_error"] for _, part in parts if part["last_error"]), None),
+    }
+
+
+def retry_failed_writes():
+    """ให้แถวที่ส่งไม่ได้ของทุกสาขากลับเข้าคิว แล้วปลุกตัวซิงก์"""
+    for branch in get_branches():
+        with use_branch(branch):
+            get_write_queue().retry_failed()
+            get_write_flusher().wake()
+
+
+def dismiss_failed_writes():
+    """ลบแถวที่ส่งไม่ได้ของทุกสาขา และล้างแคชของเดือนเหล่านั้นที่ถูกแก้ด้วยค่าที่ไม่ได้ลงชีต"""
+    for branch in get_branches():
+        with use_branch(branch):
+            for kind, month_start in get_write_queue().dismiss_failed():
+                get_month_cache().invalidate(_month_key(kind, month_start))
+                get_aggregate_store().invalidate(kind, month_start)
+
+
+@st.fragment(run_every=5)
+def render_sync_status():
+    """แสดงสถานะงานบันทึกที่รอซิงก์ไป Google Sheets
+
+    เป็น fragment ที่รีเฟรชตัวเองทุก 5 วินาที จึงเห็นงานที่บันทึกจากแท็บที่ rerun แยก (fragment) ด้วย
+    ถ้ามีหลายสาขาจะรวมคิวของทุกสาขา
+    """
+    status = write_queue_status(get_branches())
+    with st.container():
+        if status["pending"]:
+            st.warning(f"⏳ รอซิงก์ไป Google Sheets {status['pending']} ช่อง")
+            if status["last_error"]:
+                st.caption(f"ส่งไม่สำเร็จล่าสุด: {status['last_error']} (ระบบจะลองใหม่อัตโนมัติ)")
+            if st.button("ซิงก์ตอนนี้", key="sync_now"):
+                for branch in get_branches():
+                    with use_branch(branch):
+                        get_write_flusher().wake()
+        else:
+            st.success("✅ ซิงก์กับ Google Sheets แล้ว")
+            if status["last_synced_at"]:
+                st.caption(f"ซิงก์ล่าสุด {status['last_synced_at']:%H:%M:%S}")
+        if status["failed"]:
+            st.error(f"มี {len(status['failed'])} ช่องที่บันทึกลงชีตไม่ได้")
+            st.dataframe(
+                pd.DataFrame(status["failed"], columns=["สาขา", "ชนิด", "ปี", "เดือน", "วัน", "รายการ", "สาเหตุ"]),
+                hide_index=True,
+            )
+            retry_col, dismiss_col = st.columns(2)
+            # ทำใน on_click ซึ่งรันก่อน fragment วาดใหม่ สถานะที่แสดงจึงเป็นหลังกดแล้ว
+            retry_col.button("ลองส่งใหม่", key="retry_failed", on_click=retry_failed_writes)
+            dismiss_col.button("ลบรายการที่ส่งไม่ได้", key="dismiss_failed", on_click=dismiss_failed_writes)
+
+
+def render_perf_panel(container, metrics):
+    """แผงผู้ดูแล: เวลาของแต่ละขั้นตอนใน rerun ล่าสุด และเวลารวมของ rerun ก่อนหน้า"""
+    with container.container():
+        st.markdown("#### ⏱️ วัดประสิทธิภาพ (rerun นี้)")
+        if metrics is None:
+            st.caption("ใช้ได้เมื่อรันด้วย streamlit run เท่านั้น")
+            return
+        c1, c2 = st.columns(2)
+        c1.metric("เวลาทั้งหมด", f"{metrics.total_seconds * 1000:,.0f} ms")
+        c2.metric("Google API", f"{metrics.api_calls()} ครั้ง")
+        steps = metrics.steps()
+        st.dataframe(
+            pd.DataFrame(
+                [
+                    {
+                        "ขั้นตอน": name,
+                        "ครั้ง": step["count"],
+                        "รวม (ms)": round(step["seconds"] * 1000, 1),
+                        "นานสุด (ms)": round(step["max_seconds"] * 1000, 1),
+                    }
+                    for name, step in steps.items()
+                ],
+                columns=["ขั้นตอน", "ครั้ง", "รวม (ms)", "นานสุด (ms)"],
+            ),
+            hide_index=True,
+            use_container_width=True,
+        )
+        st.caption("เวลาของแต่ละขั้นตอนรวมขั้นตอนย่อยด้วย และขั้นตอนที่โหลดพร้อมกันอาจรวมกันเกินเวลาทั้งหมด")
+        history = st.session_state.get("_perf_history", [])
+        if len(history) > 1:
+            st.markdown("##### rerun ก่อนหน้า")
+            st.dataframe(
+                pd.DataFrame(
+                    [
+                        {
+                            "เวลาเริ่ม": m.started_at.strftime("%H:%M:%S"),
+                            "ส่วนที่รัน": m.scope,
+                            "รวม (ms)": round(m.total_seconds * 1000, 1),
+                            "Google API": m.api_calls(),
+                        }
+                        for m in reversed(history)
+                    ]
+                ),
+                hide_index=True,
+                use_container_width=True,
+            )
+
+
+def filter_by_range(df_daily, start_date: dt.date, end_date: dt.date):
+    """เลือกแถวในช่วงวันที่ด้วย binary search (df_daily เรียงตามวันที่อยู่แล้ว)"""
+    if df_daily.empty:
+        return df_daily
+    dates = df_daily["วันที่จริง"]
+    lo = dates.searchsorted(start_date, side="left")
+    hi = dates.searchsorted(end_date, side="right")
+    return df_daily.iloc[lo:max(lo, hi)]
 
 
 # ------------------------------
-# UI
+# TABS (แต่ละแท็บเป็น fragment: widget ในแท็บไหนเปลี่ยน จะ rerun เฉพาะแท็บนั้น)
 # ------------------------------
-with st.sidebar:
-    logo_path = Path(__file__).with_name("logo_whale.png")
-    if logo_path.exists():
-        st.image(str(logo_path), use_container_width=True)
-    st.markdown("### 🐳 วาฬวาฬ (Cloud)")
-    st.caption("แอปบันทึกบัญชีรายรับรายจ่ายบน Google Sheets")
-    base_date = st.date_input("เดือนอ้างอิง (ใช้สำหรับคำนวณรายงาน)", value=dt.date.today())
+SUMMARY_WIDGET_KEYS = ["sum_mode", "sum_branch", "sum_daily", "sum_week_ref", "sum_range_start", "sum_range_end"]
 
-st.title("🐳 วาฬวาฬ - บัญชีรายรับรายจ่าย (Cloud)")
-st.caption("เวอร์ชัน V.1.2")
 
-tab_income, tab_expense, tab_summary = st.tabs(["📥 รายรับ", "📤 รายจ่าย", "📊 ผลประกอบการ & กราฟ"])
+def keep_widget_state(keys):
+    """รอบที่ไม่ได้วาด widget เหล่านี้ (เช่น แท็บสรุปที่ไม่ได้เปิดอยู่) Streamlit จะล้างค่าของมันทิ้ง
+    การเขียนค่าเดิมกลับลง session_state ทำให้ค่ายังอยู่เมื่อกลับมาเปิดแท็บนั้นอีกครั้ง
+    """
+    for key in keys:
+        if key in st.session_state:
+            st.session_state[key] = st.session_state[key]
 
-# TAB รายรับ
-with tab_income:
-    st.subheader("บันทึกรายรับประจำวัน")
-    d_in = st.date_input("วันที่ (รายรับ)", value=dt.date.today(), key="income_date")
-    day = d_in.day
-    st.caption(f"จะบันทึกลงแถว 'วันที่' = {day} ในชีตของเดือนนั้น")
+
+@st.fragment
+def render_income_tab():
+    """แท็บบันทึกรายรับ การพิมพ์ตัวเลขหรือเปลี่ยนวันที่ rerun เฉพาะแท็บนี้"""
+    with fragment_run("ui.tab_income"), use_branch(selected_branch()) as branch:
+        st.subheader("บันทึกรายรับประจำวัน")
+        if len(get_branches()) > 1:
+            st.caption(f"สาขา: {branch.name}")
+        d_in = st.date_input("วันที่ (รายรับ)", value=dt.date.today(), key="income_date")
+        day = d_in.day
+        st.caption(f"จะบันทึกลงแถว 'วันที่' = {day} ในชีตของเดือนนั้น")
 
 
-    inc_df = load_income_df(d_in)
-    if not inc_df.empty:
-        row = inc_df.loc[inc_df["วันที่"] == day]
-    else:
-        row = pd.DataFrame()
-
-    def get_inc_val(col):
-        if row.empty or col not in row.columns:
-            return 0.0
-        v = row.iloc[0][col]
-        return float(v) if pd.notna(v) else 0.0
-
-    c1, c2, c3 = st.columns(3)
-    with c1:
-        cash = st.number_input("เงินสด 💵", min_value=0.0, step=10.0, value=get_inc_val("เงินสด"))
-        grab = st.number_input("Grab 🛵", min_value=0.0, step=10.0, value=get_inc_val("Grab"))
-    with c2:
-        scan = st.number_input("สแกน 📲", min_value=0.0, step=10.0, value=get_inc_val("สแกน"))
-        shopee = st.number_input("Shopee 🛒", min_value=0.0, step=10.0, value=get_inc_val("Shopee"))
-    with c3:
-        half = st.number_input("คนละครึ่ง 🤝", min_value=0.0, step=10.0, value=get_inc_val("คนละครึ่ง"))
-        lineman = st.number_input("LINE Man 🛵", min_value=0.0, step=10.0, value=get_inc_val("LINE Man"))
-
-    if st.button("บันทึกรายรับวันนี้", type="primary"):
-        # อัปเดตรายรับลง Google Sheets (แยกชีตตามเดือน)
-        update_income_row(d_in, cash, scan, half, grab, shopee, lineman)
-        st.success("บันทึกรายรับเรียบร้อยแล้ว ✅")
-        # โหลดข้อมูลรายรับใหม่หลังอัปเดต เพื่อให้ตารางด้านล่างเป็นค่าล่าสุดทันที
         inc_df = load_income_df(d_in)
+        inc_ledger, _ = load_month_ledger("income", d_in)
 
-    if not inc_df.empty:
-        st.markdown("#### ตารางรายรับทั้งเดือน (จากชีตของเดือนนั้น)")
-        st.dataframe(inc_df, use_container_width=True)
+        def get_inc_val(col):
+            return inc_ledger.amount("income", d_in, col)
 
-# TAB รายจ่าย
-with tab_expense:
-    st.subheader("บันทึกรายจ่ายประจำวัน")
-    d_ex = st.date_input("วันที่ (รายจ่าย)", value=dt.date.today(), key="expense_date")
-    day_e = d_ex.day
-    st.caption(f"จะบันทึกลงวันที่ {day_e} ในชีตของเดือนนั้น")
+        c1, c2, c3 = st.columns(3)
+        with c1:
+            cash = st.number_input("เงินสด 💵", min_value=0.0, step=10.0, value=get_inc_val("เงินสด"))
+            grab = st.number_input("Grab 🛵", min_value=0.0, step=10.0, value=get_inc_val("Grab"))
+        with c2:
+            scan = st.number_input("สแกน 📲", min_value=0.0, step=10.0, value=get_inc_val("สแกน"))
+            shopee = st.number_input("Shopee 🛒", min_value=0.0, step=10.0, value=get_inc_val("Shopee"))
+        with c3:
+            half = st.number_input("คนละครึ่ง 🤝", min_value=0.0, step=10.0, value=get_inc_val("คนละครึ่ง"))
+            lineman = st.number_input("LINE Man 🛵", min_value=0.0, step=10.0, value=get_inc_val("LINE Man"))
+
+        if st.button("บันทึกรายรับวันนี้", type="primary"):
+            # อัปเดตรายรับลง Google Sheets (แยกชีตตามเดือน)
+            update_income_row(d_in, cash, scan, half, grab, shopee, lineman)
+            st.success("บันทึกรายรับเรียบร้อยแล้ว ✅ ระบบจะซิงก์ไป Google Sheets ให้อัตโนมัติ")
+            # แคชของเดือนนั้นถูกแก้ด้วยค่าที่เพิ่งบันทึกแล้ว โหลดซ้ำจึงไม่ต้องอ่านชีตใหม่
+            inc_df = load_income_df(d_in)
+
+        if not inc_df.empty:
+            st.markdown("#### ตารางรายรับทั้งเดือน (จากชีตของเดือนนั้น)")
+            st.dataframe(inc_df, use_container_width=True)
+
+
+@st.fragment
+def render_expense_tab():
+    """แท็บบันทึกรายจ่าย การแก้ตาราง expense_editor rerun เฉพาะแท็บนี้"""
+    with fragment_run("ui.tab_expense"), use_branch(selected_branch()) as branch:
+        st.subheader("บันทึกรายจ่ายประจำวัน")
+        if len(get_branches()) > 1:
+            st.caption(f"สาขา: {branch.name}")
+        d_ex = st.date_input("วันที่ (รายจ่าย)", value=dt.date.today(), key="expense_date")
+        day_e = d_ex.day
+        st.caption(f"จะบันทึกลงวันที่ {day_e} ในชีตของเดือนนั้น")
+
+
+        exp_mx = load_expense_matrix(d_ex)
+        exp_ledger, _ = load_month_ledger("expense", d_ex)
+        items = exp_mx.item_names()
+
+        if not items:
+            st.warning("ชีต 'รายจ่าย' ยังไม่มีรายการรายจ่าย กรุณาเตรียมโครงสร้างใน Google Sheets ก่อน")
+        else:
+            st.markdown("เลือกติ๊ก ✔ รายการที่มีค่าใช้จ่ายวันนี้ แล้วใส่จำนวนเงินในตาราง จากนั้นกดปุ่ม **บันทึกรายจ่ายวันนี้**")
 
 
-    exp_df = load_expense_df(d_ex)
-    if "รายการรายจ่าย/วันที่" in exp_df.columns:
-        items = exp_df["รายการรายจ่าย/วันที่"].dropna().tolist()
-    else:
-        items = []
+            default_amounts = [exp_ledger.amount("expense", d_ex, item_name) for item_name in items]
 
-    if not items:
-        st.warning("ชีต 'รายจ่าย' ยังไม่มีรายการรายจ่าย กรุณาเตรียมโครงสร้างใน Google Sheets ก่อน")
-    else:
-        st.markdown("เลือกติ๊ก ✔ รายการที่มีค่าใช้จ่ายวันนี้ แล้วใส่จำนวนเงินในตาราง จากนั้นกดปุ่ม **บันทึกรายจ่ายวันนี้**")
-
-
-        col_day = str(day_e)
-        default_amounts = []
-        for item_name in items:
-            amt = 0.0
-            if col_day in exp_df.columns:
-                row_match = exp_df[exp_df["รายการรายจ่าย/วันที่"] == item_name]
-                if not row_match.empty:
-                    v = pd.to_numeric(row_match.iloc[0][col_day], errors="coerce")
-                    if pd.notna(v):
-                        amt = float(v)
-            default_amounts.append(amt)
-
-        df_items = pd.DataFrame({
-            "เลือก": [False] * len(items),
-            "รายการรายจ่าย": items,
-            "จำนวนเงิน (บาท)": default_amounts,
-        })
+            df_items = pd.DataFrame({
+                "เลือก": [False] * len(items),
+                "รายการรายจ่าย": items,
+                "จำนวนเงิน (บาท)": default_amounts,
+            })
 
-        # ป้องกันไม่ให้มีค่า None ในคอลัมน์จำนวนเงิน (แก้ปัญหาแก้ไขไม่ได้บน iPad/Safari)
-        df_items["จำนวนเงิน (บาท)"] = pd.to_numeric(df_items["จำนวนเงิน (บาท)"], errors="coerce").fillna(0.0)
+            # ป้องกันไม่ให้มีค่า None ในคอลัมน์จำนวนเงิน (แก้ปัญหาแก้ไขไม่ได้บน iPad/Safari)
+            df_items["จำนวนเงิน (บาท)"] = pd.to_numeric(df_items["จำนวนเงิน (บาท)"], errors="coerce").fillna(0.0)
 
-        edited_items = st.data_editor(
-            df_items,
-            key="expense_editor",
-            use_container_width=True,
-            hide_index=True,
-            column_config={
-                "เลือก": st.column_config.CheckboxColumn("เลือก"),
-                "รายการรายจ่าย": st.column_config.TextColumn("รายการรายจ่าย", disabled=True),
-                "จำนวนเงิน (บาท)": st.column_config.NumberColumn(
-                    "จำนวนเงิน (บาท)", min_value=0.0, step=1.0, format="%.2f"
-                ),
-            },
-        )
+            edited_items = st.data_editor(
+                df_items,
+                key="expense_editor",
+                use_container_width=True,
+                hide_index=True,
+                column_config={
+                    "เลือก": st.column_config.CheckboxColumn("เลือก"),
+                    "รายการรายจ่าย": st.column_config.TextColumn("รายการรายจ่าย", disabled=True),
+                    "จำนวนเงิน (บาท)": st.column_config.NumberColumn(
+                        "จำนวนเงิน (บาท)", min_value=0.0, step=1.0, format="%.2f"
+                    ),
+                },
+            )
 
-        if st.button("บันทึกรายจ่ายวันนี้", type="primary"):
-            saved_any = False
-            for _, row_state in edited_items.iterrows():
-                if bool(row_state["เลือก"]) and float(row_state["จำนวนเงิน (บาท)"]) > 0:
-                    update_expense_cell(d_ex, day_e, row_state["รายการรายจ่าย"], float(row_state["จำนวนเงิน (บาท)"]))
-                    saved_any = True
-
-            if saved_any:
-                st.success("บันทึกรายจ่ายสำหรับรายการที่เลือกเรียบร้อยแล้ว ✅")
-                # โหลดข้อมูลรายจ่ายใหม่ เพื่อให้ตารางด้านล่างแสดงค่าล่าสุดทันที
-                exp_df = load_expense_df(d_ex)
+            if st.button("บันทึกรายจ่ายวันนี้", type="primary"):
+                selected = edited_items[
+                    edited_items["เลือก"].astype(bool) & (edited_items["จำนวนเงิน (บาท)"].astype(float) > 0)
+                ]
+                entries = [
+                    (item_name, day_e, float(amount))
+                    for item_name, amount in zip(selected["รายการรายจ่าย"], selected["จำนวนเงิน (บาท)"])
+                ]
+
+                if entries:
+                    # ลงคิวทุกรายการที่เลือก ตัวซิงก์จะส่งไปชีตใน batch_update ครั้งเดียว
+                    update_expense_cells(d_ex, entries)
+                    st.success("บันทึกรายจ่ายสำหรับรายการที่เลือกเรียบร้อยแล้ว ✅ ระบบจะซิงก์ไป Google Sheets ให้อัตโนมัติ")
+                    # แคชของเดือนนั้นถูกแก้ด้วยค่าที่เพิ่งบันทึกแล้ว โหลดซ้ำจึงไม่ต้องอ่านชีตใหม่
+                    exp_ledger, _ = load_month_ledger("expense", d_ex)
+                else:
+                    st.warning("กรุณาติ๊กเลือกอย่างน้อย 1 รายการ และใส่จำนวนเงินมากกว่า 0 บาท")
+
+
+            st.markdown("#### รายการรายจ่ายของวันนั้น")
+            if exp_ledger.covers("expense", d_ex):
+                tmp = exp_ledger.day("expense", d_ex).rename_axis("รายการรายจ่าย/วันที่").rename("ยอด").reset_index()
+                tmp = tmp[tmp["ยอด"] > 0]
+                st.dataframe(tmp.reset_index(drop=True), use_container_width=True)
             else:
-                st.warning("กรุณาติ๊กเลือกอย่างน้อย 1 รายการ และใส่จำนวนเงินมากกว่า 0 บาท")
+                st.info("ยังไม่พบคอลัมน์วันนี้ในชีต 'รายจ่าย'")
 
 
-        col_day = str(day_e)
-        st.markdown("#### รายการรายจ่ายของวันนั้น")
-        if col_day in exp_df.columns:
-            tmp = exp_df[["รายการรายจ่าย/วันที่", col_day]].copy()
-            tmp = tmp.rename(columns={col_day: "ยอด"})
-            tmp["ยอด"] = pd.to_numeric(tmp["ยอด"], errors="coerce").fillna(0.0)
-            tmp = tmp[tmp["ยอด"] > 0]
-            st.dataframe(tmp.reset_index(drop=True), use_container_width=True)
-        else:
-            st.info("ยังไม่พบคอลัมน์วันนี้ในชีต 'รายจ่าย'")
+@st.fragment
+def render_summary_tab(base_date: dt.date):
+    """แท็บสรุปและกราฟ เปลี่ยนรูปแบบสรุป/ช่วงวันที่แล้ว rerun เฉพาะแท็บนี้
 
-# TAB สรุป
-with tab_summary:
-    st.subheader("สรุปรายรับรายจ่าย และกราฟ")
-    daily = build_daily_summary(base_date)
-    if daily.empty:
-        st.info("ยังไม่มีข้อมูลรายรับ/รายจ่ายในชีต")
-    else:
-        col_mode, _ = st.columns([1, 3])
+    altair และ streamlit.components ถูก import ตอนเปิดแท็บนี้ครั้งแรก ไม่ใช่ตอนเปิดหน้า
+    """
+    import altair as alt
+    import streamlit.components.v1 as components
+
+    with fragment_run("ui.tab_summary"):
+        st.subheader("สรุปรายรับรายจ่าย และกราฟ")
+        branches = get_branches()
+        col_mode, col_branch = st.columns([1, 3])
         with col_mode:
             mode = st.radio(
                 "เลือกรูปแบบสรุป",
-                ["รายวัน", "รายสัปดาห์", "รายเดือน", "ช่วงวันที่กำหนดเอง"],
+                ["รายวัน", "รายสัปดาห์", "รายเดือน", "รายไตรมาส", "รายปี", "ช่วงวันที่กำหนดเอง"],
                 index=2,
+                key="sum_mode",
             )
+        # สรุปของทุกสาขารวมกัน หรือเฉพาะสาขาเดียว ใช้ฟังก์ชันสรุปชุดเดียวกัน ต่างกันแค่รายการสาขา
+        scope = branches
+        if len(branches) > 1:
+            with col_branch:
+                all_label = "ทุกสาขา (รวม)"
+                picked = st.selectbox("สาขา", [all_label] + [b.name for b in branches], key="sum_branch")
+            if picked != all_label:
+                scope = [b for b in branches if b.name == picked]
+
+        start_d, end_d = select_range_by_mode(mode, base_date)
+        if _is_closed_month(dt.date(start_d.year, start_d.month, 1)):
+            st.caption("เดือนที่ปิดแล้วใช้ยอดที่เก็บไว้ในเครื่อง ถ้าแก้ชีตของเดือนเก่าโดยตรงให้กดรีเฟรช")
+            if st.button("รีเฟรชข้อมูลเดือนเก่าจาก Google Sheets", key="refresh_aggregates"):
+                refresh_closed_months(start_d, end_d, scope)
+        # โหลดทุกเดือนที่ช่วงวันที่ครอบคลุม เพื่อไม่ให้วันที่นอกเดือนอ้างอิงหายไป
+        daily = build_daily_summary(start_d, max(start_d, end_d), base_date, scope)
+        if daily.empty:
+            st.info("ยังไม่มีข้อมูลรายรับ/รายจ่ายในชีต")
+        else:
+            filtered = filter_by_range(daily, start_d, end_d)
 
-        filtered, start_d, end_d = filter_by_mode(daily, mode, base_date)
-
-        # สร้างรายงานสรุปรายรับ-รายจ่ายในรูปแบบ HTML สำหรับพรีวิวและสั่งพิมพ์
-        if not filtered.empty:
-            total_income = float(filtered.get("รวมรับ", pd.Series(dtype=float)).sum())
-            total_expense = float(filtered.get("รวมจ่าย", pd.Series(dtype=float)).sum())
-            profit = total_income - total_expense
-
-            # เตรียมแถวตารางรายวัน
-            weekday_colors = {
-                0: "#FFFFCC",  # จันทร์ เหลืองอ่อน
-                1: "#FF99CC",  # อังคาร ชมพูอ่อน
-                2: "#66FF66",  # พุธ เขียวอ่อน
-                3: "#FF6633",  # พฤหัสฯ ส้มอ่อน
-                4: "#99FFFF",  # ศุกร์ ฟ้าอ่อน
-                5: "#CC99FF",  # เสาร์ ม่วงอ่อน
-                6: "#FF3333",  # อาทิตย์ แดงอ่อน
-            }
-            table_rows = ""
-            for _, r in filtered.iterrows():
-                day_label = r.get("วันที่แสดง", r.get("วันที่", ""))
-                # หาวันที่จริงเพื่อใช้ระบายสีตามวันในสัปดาห์
-                real_date = r.get("วันที่จริง")
-                weekday = None
-                try:
-                    if isinstance(real_date, dt.date):
-                        weekday = real_date.weekday()
-                    elif isinstance(real_date, str) and real_date:
-                        weekday = dt.date.fromisoformat(real_date).weekday()
-                except Exception:
-                    weekday = None
+            # สร้างรายงานสรุปรายรับ-รายจ่ายในรูปแบบ HTML สำหรับพรีวิวและสั่งพิมพ์
+            if not filtered.empty:
+                # รายงาน HTML ถูกสร้างแบบทีละคอลัมน์ และแคชไว้ตามช่วงวันที่ + เวอร์ชันของข้อมูล
+                with track("ui.report_html"):
+                    report_html = render_report_html(filtered, start_d, end_d)
 
-                if weekday is None:
-                    # กรณีไม่มีคอลัมน์วันที่จริง ให้ลองใช้เลขวันที่ร่วมกับ base_date
-                    try:
-                        day_int = int(str(r.get("วันที่", "")).split()[0])
-                        weekday = dt.date(base_date.year, base_date.month, day_int).weekday()
-                    except Exception:
-                        weekday = None
+                with track("ui.components_html"):
+                    components.html(report_html, height=500, scrolling=True)
 
-                bg_color = weekday_colors.get(weekday, "#FFFFFF")
+            if filtered.empty:
+                st.warning("ไม่มีข้อมูลในช่วงวันที่ที่เลือก")
+            else:
+                # ยอดรวมของช่วงวันที่ได้จากผลรวมสะสม ไม่ต้องรวมแถวของตารางใหม่ทุกครั้งที่เปลี่ยนช่วง
+                range_index = load_range_index(start_d, max(start_d, end_d), base_date, scope)
+                total_inc = range_index.total("income", start_d, end_d)
+                total_exp = range_index.total("expense", start_d, end_d)
+                net = total_inc - total_exp
+
+                m1, m2, m3 = st.columns(3)
+                m1.metric("รวมรายรับ", f"{total_inc:,.0f} บาท")
+                m2.metric("รวมจ่าย", f"{total_exp:,.0f} บาท")
+                m3.metric("กำไรสุทธิ", f"{net:,.0f} บาท")
+
+                st.markdown(f"ช่วงวันที่ {start_d.strftime('%d/%m/%Y')} - {end_d.strftime('%d/%m/%Y')}")
+
+                if len(scope) > 1:
+                    st.markdown("#### แยกตามสาขา")
+                    st.dataframe(
+                        build_branch_totals(start_d, end_d, base_date, scope),
+                        use_container_width=True,
+                        hide_index=True,
+                    )
 
-                try:
-                    inc_val = float(r.get("รวมรับ", 0) or 0)
-                except Exception:
-                    inc_val = 0.0
-                try:
-                    exp_val = float(r.get("รวมจ่าย", 0) or 0)
-                except Exception:
-                    exp_val = 0.0
-                prof_val = inc_val - exp_val
-
-                table_rows += (
-                    f"<tr style='background-color:{bg_color};'>"
-                    f"<td>{day_label}</td>"
-                    f"<td style='text-align:right;'>{inc_val:,.2f}</td>"
-                    f"<td style='text-align:right;'>{exp_val:,.2f}</td>"
-                    f"<td style='text-align:right;'>{prof_val:,.2f}</td>"
-                    f"</tr>"
+                st.markdown("#### ตารางสรุป")
+                st.dataframe(
+                    filtered[["วันที่จริง", "รวมรับ", "รวมจ่าย", "กำไรสุทธิ"]]
+                    .rename(columns={"วันที่จริง": "วันที่"})
+                    .reset_index(drop=True),
+                    use_container_width=True,
                 )
 
+                st.markdown("#### กราฟแท่ง รายรับ-รายจ่ายต่อวัน")
+                chart_data = filtered.melt(
+                    id_vars=["วันที่จริง"],
+                    value_vars=["รวมรับ", "รวมจ่าย"],
+                    var_name="ประเภท",
+                    value_name="ยอด",
+                )
+                bar = (
+                    alt.Chart(chart_data)
+                    .mark_bar()
+                    .encode(
+                        x="วันที่จริง:T",
+                        y="ยอด:Q",
+                        color="ประเภท:N",
+                        tooltip=["วันที่จริง:T", "ประเภท:N", "ยอด:Q"],
+                    )
+                    .properties(height=320)
+                )
+                with track("ui.altair_chart"):
+                    st.altair_chart(bar, use_container_width=True)
+
+                if mode in ("รายไตรมาส", "รายปี"):
+                    st.markdown("#### กราฟแนวโน้มรายเดือน")
+                    trend = build_monthly_trend(filtered)
+                    trend_chart = (
+                        alt.Chart(trend.melt(id_vars=["เดือน"], var_name="ประเภท", value_name="ยอด"))
+                        .mark_bar()
+                        .encode(
+                            x="เดือน:N",
+                            xOffset="ประเภท:N",
+                            y="ยอด:Q",
+                            color="ประเภท:N",
+                            tooltip=["เดือน:N", "ประเภท:N", alt.Tooltip("ยอด:Q", format=",.2f")],
+                        )
+                        .properties(height=320)
+                    )
+                    with track("ui.altair_chart"):
+                        st.altair_chart(trend_chart, use_container_width=True)
+
+                st.markdown("#### กราฟวงกลม รายรับ / รายจ่าย ตามประเภท")
+                col_in, col_ex = st.columns(2)
+
+                with col_in:
+                    pie_inc_df = build_income_pie(start_d, end_d, base_date, scope)
+                    if pie_inc_df.empty:
+                        st.info("ไม่มีข้อมูลรายรับสำหรับทำกราฟวงกลมในช่วงนี้")
+                    else:
+                        pie_inc = (
+                            alt.Chart(pie_inc_df)
+                            .mark_arc()
+                            .encode(
+                                theta="ยอดรวม:Q",
+                                color=alt.Color(
+                                    "ป้ายแสดง:N",
+                                    scale=alt.Scale(
+                                        range=["#006633", "#00FF00", "#EE4D2D", "#87CEFA", "#7B68EE", "#4169E1"],
+                                    ),
+                                    legend=alt.Legend(title="ประเภท"),
+                                ),
+                                tooltip=[
+                                    "ประเภท:N",
+                                    alt.Tooltip("ยอดรวม:Q", title="ยอดรวม (บาท)", format=",.2f"),
+                                    alt.Tooltip("เปอร์เซ็นต์:Q", title="เปอร์เซ็นต์ (%)", format=".1f"),
+                                ],
+                            )
+                            .properties(height=350)
+                        )
+                        with track("ui.altair_chart"):
+                            st.altair_chart(pie_inc, use_container_width=True)
+
+                with col_ex:
+                    pie_df = build_expense_pie(start_d, end_d, base_date, scope)
+                    if pie_df.empty:
+                        st.info("ไม่มีข้อมูลรายจ่ายสำหรับทำกราฟวงกลมในช่วงนี้")
+                    else:
+                        pie = (
+                            alt.Chart(pie_df)
+                            .mark_arc()
+                            .encode(
+                                theta="ยอดรวม:Q",
+                                color=alt.Color(
+                                    "ป้ายแสดง:N",
+                                    legend=alt.Legend(title="รายการ"),
+                                ),
+                                tooltip=[
+                                    "รายการ:N",
+                                    alt.Tooltip("ยอดรวม:Q", title="ยอดรวม (บาท)", format=",.2f"),
+                                    alt.Tooltip("เปอร์เซ็นต์:Q", title="เปอร์เซ็นต์ (%)", format=".1f"),
+                                ],
+                            )
+                            .properties(height=350)
+                        )
+                        with track("ui.altair_chart"):
+                            st.altair_chart(pie, use_container_width=True)
 
-            period_text = start_d.strftime("%d/%m/%Y")
-            if end_d != start_d:
-                period_text = f"{start_d.strftime('%d/%m/%Y')} - {end_d.strftime('%d/%m/%Y')}"
-
-            period_text_str = period_text
-            total_income_str = f"{total_income:,.2f}"
-            total_expense_str = f"{total_expense:,.2f}"
-            profit_str = f"{profit:,.2f}"
-
-            
-            # เตรียมโลโก้สำหรับฝังในรายงาน HTML
-            logo_data_url = ""
-            try:
-                logo_path = Path(__file__).with_name("logo_whale.png")
-                if logo_path.exists():
-                    logo_bytes = logo_path.read_bytes()
-                    logo_b64 = base64.b64encode(logo_bytes).decode("utf-8")
-                    logo_data_url = f"data:image/png;base64,{logo_b64}"
-            except Exception:
-                logo_data_url = ""
-            report_html = """<html><head><meta charset='utf-8'>
-            <style>
-            body {{ font-family: -apple-system,BlinkMacSystemFont,"Segoe UI",sans-serif; padding:16px; color:#222; }}
-            h2 {{ margin-top:0; }}
-            table {{ border-collapse: collapse; width: 100%; margin-top: 12px; }}
-            th, td {{ border: 1px solid #ddd; padding: 6px 8px; font-size: 13px; }}
-            th {{ background:#f1f3ff; text-align:center; }}
-            .summary-box {{ margin-top:12px; padding:10px 12px; background:#f7fbff; border-radius:8px; border:1px solid #dde7ff; }}
-            .btn-print {{ padding:6px 12px; border-radius:6px; border:none; background:#ff4b4b; color:white; cursor:pointer; font-size:13px; }}
-            .btn-print:hover {{ opacity:0.9; }}
-            .header-row {{ display:flex; align-items:center; justify-content:space-between; gap:8px; margin-bottom:4px; }}
-            .logo-box {{ display:flex; align-items:center; gap:8px; margin-bottom:6px; }}
-            .logo-box img {{ max-height:60px; }}
-            </style>
-            </head>
-            <body>
-            <div class='logo-box'>
-              {logo_img_html}
-            </div>
-            <div class='header-row'>
-              <h2>รายงานสรุปรายรับ–รายจ่าย</h2>
-              <button class='btn-print' onclick='window.print()'>🖨️ พิมพ์รายงาน</button>
-            </div>
-            <div>ช่วงวันที่: <b>{period_text}</b></div>
-            <div class='summary-box'>
-              <div>รวมรายรับ: <b>{total_income} บาท</b></div>
-              <div>รวมรายจ่าย: <b>{total_expense} บาท</b></div>
-              <div>กำไรสุทธิ: <b>{profit} บาท</b></div>
-            </div>
-            <table>
-                <thead>
-                    <tr>
-                        <th style='width:60px;'>วันที่</th>
-                        <th>รวมรับ (บาท)</th>
-                        <th>รวมจ่าย (บาท)</th>
-                        <th>กำไรต่อวัน (บาท)</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    {table_rows}
-                </tbody>
-            </table>
-            </body></html>""".format(
-                period_text=period_text_str,
-                total_income=total_income_str,
-                total_expense=total_expense_str,
-                profit=profit_str,
-                table_rows=table_rows,
-                logo_img_html=(
-                    f"<img src='{logo_data_url}' alt='whale logo'>" if logo_data_url else ""
-                ),
-            )
 
-            components.html(report_html, height=500, scrolling=True)
+# ------------------------------
+# UI
+# ------------------------------
+# เริ่มเปิดไฟล์ชีตเบื้องหลังก่อนวาดหน้า (ครั้งแรกของ container เท่านั้น)
+start_workbook_warmup()
 
-        if filtered.empty:
-            st.warning("ไม่มีข้อมูลในช่วงวันที่ที่เลือก")
-        else:
-            total_inc = filtered["รวมรับ"].sum()
-            total_exp = filtered["รวมจ่าย"].sum()
-            net = filtered["กำไรสุทธิ"].sum()
+with st.sidebar:
+    logo_bytes = get_logo_bytes()
+    if logo_bytes is not None:
+        st.image(logo_bytes, use_container_width=True)
+    st.markdown("### 🐳 วาฬวาฬ (Cloud)")
+    st.caption("แอปบันทึกบัญชีรายรับรายจ่ายบน Google Sheets")
+    base_date = st.date_input("เดือนอ้างอิง (ใช้สำหรับคำนวณรายงาน)", value=dt.date.today())
+    if len(get_branches()) > 1:
+        st.selectbox("สาขา (สำหรับบันทึกรายรับ/รายจ่าย)", [b.name for b in get_branches()], key="branch")
+    sync_status_box = st.empty()
+    perf_panel_box = st.empty() if is_admin_mode() else None
+
+for branch in get_branches():
+    with use_branch(branch):
+        # เริ่มตัวซิงก์เบื้องหลังของทุกสาขา (ถ้ายังไม่เริ่ม) เพื่อส่งงานที่ค้างในคิวจากรอบก่อน
+        get_write_flusher()
+        # และตัวสร้างชีตของเดือนถัดไปล่วงหน้า
+        get_month_precreator()
 
-            m1, m2, m3 = st.columns(3)
-            m1.metric("รวมรายรับ", f"{total_inc:,.0f} บาท")
-            m2.metric("รวมจ่าย", f"{total_exp:,.0f} บาท")
-            m3.metric("กำไรสุทธิ", f"{net:,.0f} บาท")
+st.title("🐳 วาฬวาฬ - บัญชีรายรับรายจ่าย (Cloud)")
+st.caption("เวอร์ชัน V.1.2")
 
-            st.markdown(f"ช่วงวันที่ {start_d.strftime('%d/%m/%Y')} - {end_d.strftime('%d/%m/%Y')}")
+# on_change="rerun" ทำให้รู้ว่าแท็บไหนเปิดอยู่ (tab.open) แท็บสรุปจึงคำนวณเฉพาะตอนที่เปิดดู
+tab_income, tab_expense, tab_summary = st.tabs(
+    ["📥 รายรับ", "📤 รายจ่าย", "📊 ผลประกอบการ & กราฟ"], key="main_tabs", on_change="rerun"
+)
 
-            st.markdown("#### ตารางสรุป")
-            st.dataframe(
-                filtered[["วันที่จริง", "รวมรับ", "รวมจ่าย", "กำไรสุทธิ"]]
-                .rename(columns={"วันที่จริง": "วันที่"})
-                .reset_index(drop=True),
-                use_container_width=True,
-            )
+# ดึงชีตที่แท็บต้องใช้พร้อมกันตั้งแต่ต้น rerun (วันที่ของแต่ละแท็บอ่านจาก session_state ตาม key ของ widget)
+month_requests = [
+    ("income", st.session_state.get("income_date", dt.date.today())),
+    ("expense", st.session_state.get("expense_date", dt.date.today())),
+]
+if tab_summary.open:
+    month_requests += [("income", base_date), ("expense", base_date)]
+with use_branch(selected_branch()):
+    prefetch_months(month_requests)
+
+# แท็บบันทึกข้อมูลวาดทุกรอบ (เบา และต้องคงค่าที่พิมพ์ค้างไว้) ส่วนแท็บสรุปวาดเฉพาะตอนเปิดอยู่
+with tab_income:
+    render_income_tab()
 
-            st.markdown("#### กราฟแท่ง รายรับ-รายจ่ายต่อวัน")
-            chart_data = filtered.melt(
-                id_vars=["วันที่จริง"],
-                value_vars=["รวมรับ", "รวมจ่าย"],
-                var_name="ประเภท",
-                value_name="ยอด",
-            )
-            bar = (
-                alt.Chart(chart_data)
-                .mark_bar()
-                .encode(
-                    x="วันที่จริง:T",
-                    y="ยอด:Q",
-                    color="ประเภท:N",
-                    tooltip=["วันที่จริง:T", "ประเภท:N", "ยอด:Q"],
-                )
-                .properties(height=320)
-            )
-            st.altair_chart(bar, use_container_width=True)
+with tab_expense:
+    render_expense_tab()
 
-            st.markdown("#### กราฟวงกลม รายรับ / รายจ่าย ตามประเภท")
-            col_in, col_ex = st.columns(2)
+with tab_summary:
+    if tab_summary.open:
+        render_summary_tab(base_date)
+    else:
+        keep_widget_state(SUMMARY_WIDGET_KEYS)
 
-            with col_in:
-                pie_inc_df = build_income_pie(start_d, end_d, base_date)
-                if pie_inc_df.empty:
-                    st.info("ไม่มีข้อมูลรายรับสำหรับทำกราฟวงกลมในช่วงนี้")
-                else:
-                    pie_inc = (
-                        alt.Chart(pie_inc_df)
-                        .mark_arc()
-                        .encode(
-                            theta="ยอดรวม:Q",
-                            color=alt.Color(
-                                "ป้ายแสดง:N",
-                                scale=alt.Scale(
-                                    range=["#006633", "#00FF00", "#EE4D2D", "#87CEFA", "#7B68EE", "#4169E1"],
-                                ),
-                                legend=alt.Legend(title="ประเภท"),
-                            ),
-                            tooltip=[
-                                "ประเภท:N",
-                                alt.Tooltip("ยอดรวม:Q", title="ยอดรวม (บาท)", format=",.2f"),
-                                alt.Tooltip("เปอร์เซ็นต์:Q", title="เปอร์เซ็นต์ (%)", format=".1f"),
-                            ],
-                        )
-                        .properties(height=350)
-                    )
-                    st.altair_chart(pie_inc, use_container_width=True)
+# แสดงสถานะซิงก์หลังจากทุกแท็บทำงานเสร็จ เพื่อให้นับรวมงานที่เพิ่งบันทึกในรอบนี้ด้วย
+with sync_status_box.container():
+    render_sync_status()
 
-            with col_ex:
-                pie_df = build_expense_pie(start_d, end_d, base_date)
-                if pie_df.empty:
-                    st.info("ไม่มีข้อมูลรายจ่ายสำหรับทำกราฟวงกลมในช่วงนี้")
-                else:
-                    pie = (
-                        alt.Chart(pie_df)
-                        .mark_arc()
-                        .encode(
-                            theta="ยอดรวม:Q",
-                            color=alt.Color(
-                                "ป้ายแสดง:N",
-                                legend=alt.Legend(title="รายการ"),
-                            ),
-                            tooltip=[
-                                "รายการ:N",
-                                alt.Tooltip("ยอดรวม:Q", title="ยอดรวม (บาท)", format=",.2f"),
-                                alt.Tooltip("เปอร์เซ็นต์:Q", title="เปอร์เซ็นต์ (%)", format=".1f"),
-                            ],
-                        )
-                        .properties(height=350)
-                    )
-                    st.altair_chart(pie, use_container_width=True)
+# ปิดการจับเวลาของ rerun นี้ (เขียน log ทุกครั้ง แสดงแผงเฉพาะโหมดผู้ดูแล)
+rerun_metrics = finish_rerun_metrics()
+if perf_panel_box is not None:
+    render_perf_panel(perf_panel_box, rerun_metrics)
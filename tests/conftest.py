@@ -0,0 +1,82 @@
+"""fixture ร่วมของเทสต์: รันฟังก์ชันข้อมูลของแอปกับ fake_gsheets ใน process เดียว
+
+แอปถูก import ครั้งเดียวต่อ session (หน้าแรกรันแบบ bare mode ตอน import) แล้วทุกเทสต์เริ่มจากไฟล์ชีตตัวอย่างใหม่
+คิวงานเขียนว่าง และแคชทุกชั้นถูกล้าง ตัวซิงก์เบื้องหลังถูกปิดไว้ เทสต์สั่งส่งคิวเองด้วย fixture flush
+"""
+import datetime as dt
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import bench_cloud  # noqa: E402
+import fake_gsheets  # noqa: E402
+
+SHEET_ID = bench_cloud.SHEET_ID
+EXPENSE_ITEMS = bench_cloud.BENCH_EXPENSE_ITEMS
+
+
+@pytest.fixture(scope="session")
+def server():
+    server = fake_gsheets.FakeSheetsServer()
+    server.seed_demo(SHEET_ID, expense_items=EXPENSE_ITEMS)
+    fake_gsheets.set_default_server(server)
+    return server
+
+
+@pytest.fixture(scope="session")
+def _app(server, tmp_path_factory):
+    bench_cloud._configure_streamlit(tmp_path_factory.mktemp("whale"), latency_ms=0)
+    import streamlit_app_cloud as app
+
+    # ตัวซิงก์เบื้องหลังไม่ส่งคิวแทรกระหว่างเทสต์ (เช่น ไปกิน error ที่เทสต์ตั้งไว้ให้ request ถัดไป)
+    flush_once = app.WriteFlusher.flush_once
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app.WriteFlusher, "flush_once", lambda self: None)
+        mp.setattr(app.get_rate_limiter(), "base_delay", 0.001)
+        yield app, flush_once
+
+
+@pytest.fixture
+def app(_app, server):
+    app, _ = _app
+    server.seed_demo(SHEET_ID, expense_items=EXPENSE_ITEMS)
+    with app.get_write_queue()._connect() as con:
+        con.execute("DELETE FROM pending")
+    bench_cloud.reset_caches(app)
+    server.reset_counters()
+    return app
+
+
+@pytest.fixture
+def flush(_app, app):
+    """ส่งคิวงานเขียนไปชีตหนึ่งรอบ เหมือนตัวซิงก์เบื้องหลังตื่นขึ้นมาหนึ่งครั้ง"""
+    _, flush_once = _app
+    return lambda: flush_once(app.get_write_flusher())
+
+
+@pytest.fixture
+def today():
+    return dt.date.today()
+
+
+@pytest.fixture
+def last_month(today):
+    """วันที่ 1 ของเดือนก่อน (เดือนที่ปิดแล้ว)"""
+    return (today.replace(day=1) - dt.timedelta(days=1)).replace(day=1)
+
+
+@pytest.fixture
+def sheet_values(server):
+    """ค่าทั้งหมดของชีตชื่อ title ในไฟล์ตัวอย่าง อ่านตรงจาก server (ไม่ผ่านแคชของแอป ไม่นับเป็น call ของแอป)"""
+
+    def read(title):
+        calls = server.calls.copy()
+        values = server.client().open_by_key(SHEET_ID).worksheet(title).get_all_values()
+        server.calls.clear()
+        server.calls.update(calls)
+        return values
+
+    return read
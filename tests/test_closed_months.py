@@ -0,0 +1,100 @@
+"""เดือนที่ปิดแล้วถือว่าไม่เปลี่ยน: ยอดใน AggregateStore และตารางใน MonthArchive ใช้ต่อได้จนกว่าแอปจะเขียนลงเดือนนั้น
+หรือผู้ใช้กดโหลดใหม่ (refresh_closed_months) การบันทึกของเดือนอื่นต้องไม่ทำให้ต้องโหลดเดือนเก่าใหม่
+"""
+import datetime as dt
+
+import pytest
+
+import bench_cloud
+from conftest import SHEET_ID
+
+
+@pytest.fixture
+def closed_day(app, flush, last_month):
+    """วันที่ 5 ของเดือนก่อน ที่มีรายรับเงินสด 666 อยู่ในชีตแล้ว"""
+    day = last_month.replace(day=5)
+    app.update_income_row(day, 666, 0, 0, 0, 0, 0)
+    flush()
+    return day
+
+
+def _cash(app, day):
+    return app.load_income_df(day).loc[day.day - 1, "เงินสด"]
+
+
+def _income_total(app, start, end, today):
+    return float(app.filter_by_range(app.build_daily_summary(start, end, today), start, end)["รวมรับ"].sum())
+
+
+def _edit_directly(server, app, day, value):
+    """แก้ช่องเงินสดของวันนั้นในชีตตรงๆ (เหมือนมีคนแก้ใน Google Sheets เอง)"""
+    title = app._get_monthly_sheet_title(app.INCOME_SHEET_NAME, day)
+    server.client().open_by_key(SHEET_ID).worksheet(title).update_cell(day.day + 1, 2, value)
+
+
+def test_saving_today_does_not_reload_closed_months(app, flush, server, today, closed_day):
+    year = (dt.date(today.year, 1, 1), today)
+    assert _income_total(app, *year, today) == 666
+
+    app.update_income_row(today, 10, 0, 0, 0, 0, 0)
+    flush()
+    bench_cloud.restart_process(app)
+    server.reset_counters()
+
+    assert _income_total(app, *year, today) == 676
+    # อ่านเฉพาะรายรับและรายจ่ายของเดือนนี้
+    assert server.calls["values_get"] == 2
+
+
+def test_direct_edit_of_closed_month_shows_after_refresh(app, server, today, last_month, closed_day):
+    month_end = today.replace(day=1) - dt.timedelta(days=1)
+    assert _income_total(app, last_month, month_end, today) == 666
+
+    _edit_directly(server, app, closed_day, 1565)
+    bench_cloud.restart_process(app)
+    assert _income_total(app, last_month, month_end, today) == 666
+
+    app.refresh_closed_months(last_month, month_end, app.get_branches())
+    assert _income_total(app, last_month, month_end, today) == 1565
+
+
+def test_own_write_to_closed_month_updates_totals(app, flush, today, last_month, closed_day):
+    month_end = today.replace(day=1) - dt.timedelta(days=1)
+    assert _income_total(app, last_month, month_end, today) == 666
+
+    app.update_income_row(closed_day, 100, 0, 0, 0, 0, 0)
+    assert _income_total(app, last_month, month_end, today) == 100
+
+    flush()
+    bench_cloud.restart_process(app)
+    assert _income_total(app, last_month, month_end, today) == 100
+
+
+def test_archived_month_is_not_refetched_after_other_saves(app, flush, server, today, closed_day):
+    assert _cash(app, closed_day) == 666
+
+    app.update_income_row(today, 1, 0, 0, 0, 0, 0)
+    flush()
+    bench_cloud.restart_process(app)
+    server.reset_counters()
+
+    assert _cash(app, closed_day) == 666
+    # เปิดไฟล์และถามเวอร์ชันตามปกติหลังเริ่ม process ใหม่ แต่ไม่อ่านค่าของเดือนนั้นจากชีต
+    assert not {"values_get", "values_batch_get"} & set(server.calls)
+
+
+def test_archived_month_follows_own_writes_and_refresh(app, flush, server, today, last_month, closed_day):
+    assert _cash(app, closed_day) == 666
+
+    app.update_income_row(closed_day, 5, 0, 0, 0, 0, 0)
+    assert _cash(app, closed_day) == 5
+    flush()
+    bench_cloud.restart_process(app)
+    assert _cash(app, closed_day) == 5
+
+    _edit_directly(server, app, closed_day, 42)
+    bench_cloud.restart_process(app)
+    assert _cash(app, closed_day) == 5
+
+    app.refresh_closed_months(last_month, closed_day, app.get_branches())
+    assert _cash(app, closed_day) == 42
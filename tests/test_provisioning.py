@@ -0,0 +1,60 @@
+"""สร้างชีตของเดือนใหม่ด้วย duplicateSheet: หัวตารางและคอลัมน์แรกเหมือนชีตพื้นฐาน ค่าอื่นว่าง"""
+import datetime as dt
+
+import pytest
+
+from conftest import SHEET_ID
+
+
+@pytest.fixture
+def next_month(today):
+    return (today.replace(day=28) + dt.timedelta(days=4)).replace(day=1)
+
+
+@pytest.mark.parametrize("kind", ["income", "expense"])
+def test_new_month_copies_header_and_first_column_only(app, server, next_month, sheet_values, kind):
+    base = app.SHEET_NAMES[kind]
+    # ชีตพื้นฐานมีค่าค้างอยู่ในช่องข้อมูล ชีตของเดือนใหม่ต้องไม่ได้ค่าพวกนี้ไปด้วย
+    template = server.client().open_by_key(SHEET_ID).worksheet(base)
+    template.update("B2", [["99", "98"], ["97", "96"]])
+    template_values = sheet_values(base)
+    server.reset_counters()
+
+    app.get_storage_backend().create_month(kind, next_month)
+
+    assert server.calls["spreadsheets_batch_update"] == 1
+    assert "values_batch_update" not in server.calls
+    title = app._get_monthly_sheet_title(base, next_month)
+    values = sheet_values(title)
+    assert values[0] == template_values[0]
+    assert [row[0] for row in values] == [row[0] for row in template_values]
+    assert all(cell == "" for row in values[1:] for cell in row[1:])
+    ws = app.get_worksheet_registry().get(title)
+    assert ws.id == app.SheetProvisioner.stable_sheet_id(title)
+
+
+def test_existing_month_is_not_created_again(app, server, next_month):
+    app.get_storage_backend().create_month("income", next_month)
+    server.reset_counters()
+
+    app.get_storage_backend().create_month("income", next_month)
+
+    assert server.total_calls == 0
+
+
+def test_sheet_created_by_another_machine_is_reused(app, server, next_month, sheet_values):
+    """อีกเครื่องสร้างชีตเดือนเดียวกันไปหลังเครื่องนี้โหลดรายชื่อชีต: ใช้ชีตนั้นต่อ ไม่สร้างซ้ำหรือล้างค่า"""
+    app.get_worksheet_registry().get(app.INCOME_SHEET_NAME)
+    title = app._get_monthly_sheet_title(app.INCOME_SHEET_NAME, next_month)
+    other = server.client().open_by_key(SHEET_ID)
+    other.batch_update({"requests": app.SheetProvisioner._clone_requests(
+        other.worksheet(app.INCOME_SHEET_NAME).id, title, app.SheetProvisioner.stable_sheet_id(title),
+    )})
+    other.worksheet(title).update("B2", [["7"]])
+    server.reset_counters()
+
+    app.get_storage_backend().create_month("income", next_month)
+
+    assert "spreadsheets_batch_update" not in server.calls
+    assert [ws.title for ws in other.worksheets()].count(title) == 1
+    assert sheet_values(title)[1][1] == "7"
@@ -0,0 +1,127 @@
+"""ยอดสรุปรายวัน/รายเดือน/ช่วงวันที่/รายปี เทียบกับการรวมค่าทีละช่องจากตารางในชีตตรงๆ"""
+import calendar
+import datetime as dt
+import random
+
+import pytest
+
+import bench_cloud
+from conftest import EXPENSE_ITEMS, SHEET_ID
+
+TOTAL_ROW = "รวมทั้งเดือน"
+
+
+def _amount(rng):
+    return rng.choice(["", "", "0", str(rng.randint(1, 900)), f"{rng.uniform(0, 500):.2f}"])
+
+
+def _months(first: dt.date, last: dt.date):
+    month = first
+    while month <= last:
+        yield month
+        month = (month + dt.timedelta(days=32)).replace(day=1)
+
+
+@pytest.fixture
+def seeded(app, server, today):
+    """ไฟล์ที่มีชีตรายเดือนตั้งแต่ ธ.ค. ปีก่อนถึงเดือนนี้ คืนค่า brute-force {(kind, วันที่, ประเภท): ยอด}
+
+    ทุกชีตมีค่าในวันที่ 29-31 ที่เดือนนั้นไม่มีจริง แถว "รวมทั้งเดือน" และแถวที่ไม่มีชื่อรายการ ซึ่งต้องไม่ถูกนับ
+    """
+    rng = random.Random(20261017)
+    sheets = {
+        app.INCOME_SHEET_NAME: [["วันที่"] + app.INCOME_COLUMNS] + [[str(d)] + [""] * 6 for d in range(1, 32)],
+        app.EXPENSE_SHEET_NAME: [["รายการรายจ่าย/วันที่"] + [str(d) for d in range(1, 32)]]
+        + [[item] + [""] * 31 for item in EXPENSE_ITEMS],
+    }
+    expected = {}
+    for month_start in _months(dt.date(today.year - 1, 12, 1), today):
+        last_day = calendar.monthrange(month_start.year, month_start.month)[1]
+        income = [["วันที่"] + app.INCOME_COLUMNS]
+        for day in range(1, 32):
+            row = [str(day)] + [_amount(rng) for _ in app.INCOME_COLUMNS]
+            income.append(row)
+            for name, cell in zip(app.INCOME_COLUMNS, row[1:]):
+                if day <= last_day and cell:
+                    key = ("income", month_start.replace(day=day), name)
+                    expected[key] = expected.get(key, 0.0) + float(cell)
+        expense = [["รายการรายจ่าย/วันที่"] + [str(d) for d in range(1, 32)]]
+        for name in EXPENSE_ITEMS[:8] + ["", TOTAL_ROW]:
+            row = [name] + [_amount(rng) for _ in range(31)]
+            expense.append(row)
+            if name in ("", TOTAL_ROW):
+                continue
+            for day, cell in enumerate(row[1:], start=1):
+                if day <= last_day and cell:
+                    key = ("expense", month_start.replace(day=day), name)
+                    expected[key] = expected.get(key, 0.0) + float(cell)
+        sheets[app._get_monthly_sheet_title(app.INCOME_SHEET_NAME, month_start)] = income
+        sheets[app._get_monthly_sheet_title(app.EXPENSE_SHEET_NAME, month_start)] = expense
+    server.create_spreadsheet(SHEET_ID, sheets)
+    return expected
+
+
+def _brute_total(expected, kind, start, end):
+    return sum(v for (k, day, _), v in expected.items() if k == kind and start <= day <= end)
+
+
+def _brute_by_category(expected, kind, start, end):
+    totals = {}
+    for (k, day, name), v in expected.items():
+        if k == kind and start <= day <= end:
+            totals[name] = totals.get(name, 0.0) + v
+    return {name: v for name, v in totals.items() if v > 0}
+
+
+def _ranges(today):
+    last_month = (today.replace(day=1) - dt.timedelta(days=1)).replace(day=1)
+    return {
+        "this month": (today.replace(day=1), today.replace(day=calendar.monthrange(today.year, today.month)[1])),
+        "closed month": (last_month, today.replace(day=1) - dt.timedelta(days=1)),
+        "across months": (last_month.replace(day=10), today),
+        "across years": (dt.date(today.year - 1, 12, 20), dt.date(today.year, 1, 10)),
+        "one day": (today, today),
+        "year": (dt.date(today.year, 1, 1), dt.date(today.year, 12, 31)),
+    }
+
+
+@pytest.mark.parametrize("name", list(_ranges(dt.date.today())))
+def test_daily_summary_matches_brute_force(app, seeded, today, name):
+    start, end = _ranges(today)[name]
+    for _ in range(2):  # ครั้งแรกโหลดจากชีต ครั้งที่สองจากยอดที่เก็บไว้หลังเริ่ม process ใหม่
+        # แท็บสรุปรวมทั้งเดือนที่ช่วงครอบคลุมแล้วตัดเหลือเฉพาะช่วงด้วย filter_by_range
+        df = app.filter_by_range(app.build_daily_summary(start, end, today), start, end)
+        assert df["รวมรับ"].sum() == pytest.approx(_brute_total(seeded, "income", start, end))
+        assert df["รวมจ่าย"].sum() == pytest.approx(_brute_total(seeded, "expense", start, end))
+        # ชีตมีถึงสิ้นเดือนนี้ เดือนหลังจากนั้นในช่วงรายปีไม่มีแถว
+        last_day = min(end, today.replace(day=calendar.monthrange(today.year, today.month)[1]))
+        assert list(df["วันที่จริง"]) == [start + dt.timedelta(days=i) for i in range((last_day - start).days + 1)]
+        for day, income, expense in zip(df["วันที่จริง"], df["รวมรับ"], df["รวมจ่าย"]):
+            assert start <= day <= end
+            assert income == pytest.approx(_brute_total(seeded, "income", day, day))
+            assert expense == pytest.approx(_brute_total(seeded, "expense", day, day))
+        bench_cloud.restart_process(app)
+
+
+@pytest.mark.parametrize("name", ["this month", "across months", "year"])
+def test_category_totals_match_brute_force(app, seeded, today, name):
+    start, end = _ranges(today)[name]
+
+    income = app.build_income_pie(start, end, today)
+    expense = app.build_expense_pie(start, end, today)
+
+    assert dict(zip(income["ประเภท"], income["ยอดรวม"])) == pytest.approx(
+        _brute_by_category(seeded, "income", start, end)
+    )
+    assert dict(zip(expense["รายการ"], expense["ยอดรวม"])) == pytest.approx(
+        _brute_by_category(seeded, "expense", start, end)
+    )
+
+
+def test_branch_totals_match_brute_force(app, seeded, today):
+    start, end = _ranges(today)["year"]
+
+    totals = app.build_branch_totals(start, end, today, app.get_branches())
+
+    assert totals["รวมรับ"].tolist() == pytest.approx([_brute_total(seeded, "income", start, end)])
+    assert totals["รวมจ่าย"].tolist() == pytest.approx([_brute_total(seeded, "expense", start, end)])
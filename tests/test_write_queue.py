@@ -0,0 +1,101 @@
+"""คิวงานเขียน: ส่งลงช่องที่ถูกต้อง, แสดงค่าที่ยังไม่ส่งทับข้อมูลที่โหลด, retry ตอนโดน quota"""
+import pytest
+from gspread.exceptions import APIError
+
+from conftest import EXPENSE_ITEMS
+
+
+def _title(app, kind, date):
+    return app._get_monthly_sheet_title(app.SHEET_NAMES[kind], date)
+
+
+def test_flush_writes_income_row_into_day_row(app, flush, today, sheet_values):
+    app.update_income_row(today, 250.5, 3, 0, 0, 0, 12)
+    flush()
+
+    assert sheet_values(_title(app, "income", today))[today.day] == [str(today.day), "250.5", "3", "0", "0", "0", "12"]
+    assert app.get_write_queue().status()["pending"] == 0
+
+
+def test_flush_writes_expenses_into_item_rows_and_day_columns(app, flush, today, sheet_values):
+    app.update_expense_cells(today, [(EXPENSE_ITEMS[2], 4, 12.25), (EXPENSE_ITEMS[0], 31, 7)])
+    flush()
+
+    values = sheet_values(_title(app, "expense", today))
+    assert values[3][0] == EXPENSE_ITEMS[2] and values[3][4] == "12.25"
+    assert values[1][0] == EXPENSE_ITEMS[0] and values[1][31] == "7"
+    assert sum(cell not in ("", "0") for row in values[1:] for cell in row[1:]) == 2
+
+
+def test_flush_sends_one_batch_per_month(app, flush, today, server):
+    app.update_income_row(today, 1, 2, 3, 4, 5, 6)
+    app.update_expense_cells(today, [(item, today.day, 10 + i) for i, item in enumerate(EXPENSE_ITEMS[:20])])
+    server.reset_counters()
+    flush()
+
+    assert server.calls["values_batch_update"] == 2
+
+
+def test_unknown_item_is_marked_failed_and_the_rest_is_written(app, flush, today, sheet_values):
+    app.update_expense_cells(today, [(EXPENSE_ITEMS[0], 1, 5), ("ไม่มีรายการนี้", 1, 9)])
+    flush()
+
+    status = app.get_write_queue().status()
+    assert status["pending"] == 0
+    assert [row[4] for row in status["failed"]] == ["ไม่มีรายการนี้"]
+    assert sheet_values(_title(app, "expense", today))[1][1] == "5"
+
+
+def test_pending_save_shows_before_flush(app, today):
+    app.update_income_row(today, 250, 0, 0, 0, 0, 0)
+
+    assert app.load_income_df(today).loc[today.day - 1, "เงินสด"] == 250
+
+
+def test_save_flushed_while_month_reloads_is_not_lost(app, flush, today, monkeypatch):
+    """ตัวซิงก์ส่งคิวเสร็จหลังโหลดชีต แต่ก่อนอ่านคิว: ค่าที่เพิ่งบันทึกต้องยังเห็นอยู่"""
+    app.get_storage_backend().create_month("income", today)
+    backend = type(app.get_storage_backend())
+    load_values = backend.load_values
+
+    def load_then_flush(self, kind, month_start):
+        values = load_values(self, kind, month_start)
+        flush()
+        return values
+
+    app.update_income_row(today, 250, 0, 0, 0, 0, 0)
+    app.get_month_cache().invalidate(app._month_key("income", today))
+    monkeypatch.setattr(backend, "load_values", load_then_flush)
+
+    assert app.load_income_df(today).loc[today.day - 1, "เงินสด"] == 250
+    assert app.get_write_queue().status()["pending"] == 0
+
+    monkeypatch.setattr(backend, "load_values", load_values)
+    assert app.load_income_df(today).loc[today.day - 1, "เงินสด"] == 250
+
+
+def test_rate_limited_write_is_retried_once_with_the_same_range(app, flush, today, server, sheet_values):
+    app.get_storage_backend().create_month("income", today)
+    app.update_income_row(today, 321, 0, 0, 0, 0, 0)
+    server.reset_counters()
+    server.fail_next(1, 429, request="values_batch_update")
+    flush()
+
+    assert server.calls["values_batch_update"] == 2
+    assert sheet_values(_title(app, "income", today))[today.day][1] == "321"
+    assert app.get_write_queue().status()["pending"] == 0
+
+
+def test_server_error_on_sheet_creation_is_not_repeated(app, flush, today, server):
+    """สร้างชีตไม่ใช่ request ที่ส่งซ้ำได้ปลอดภัย: 503 ต้องไม่ retry ทันที งานยังค้างในคิวรอรอบหน้า"""
+    app.update_income_row(today, 5, 0, 0, 0, 0, 0)
+    server.fail_next(1, 503, request="spreadsheets_batch_update")
+
+    with pytest.raises(APIError):
+        flush()
+
+    assert server.calls["spreadsheets_batch_update"] == 1
+    assert app.get_write_queue().status()["pending"] == 6
+
+    flush()
+    assert app.get_write_queue().status()["pending"] == 0